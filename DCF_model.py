@@ -10,6 +10,76 @@ from scipy.stats import norm
 from math import log, exp, sqrt
 
 from stock import Stock
+from root_finding import brent
+
+
+def _geometric_sum(ratio, n):
+    '''
+    sum of ratio**i for i = 1..n, elementwise, exact n where ratio is 1
+    '''
+    ratio = np.asarray(ratio, dtype = np.float64)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        result = ratio * (1 - ratio**n) / (1 - ratio)
+    return(np.where(ratio == 1, float(n), result))
+
+
+def calc_fair_value_batch(free_cashflow, cash, total_debt, shares, wacc,
+                          short_term_growth_rate, medium_term_growth_rate, long_term_growth_rate):
+    '''
+    DCF fair value per share for a whole universe at once, every argument is a scalar or an array
+    (broadcast together). Same model as DiscountedCashFlowModel.calc_fair_value: free cash flow
+    grows at the short term rate for 5 years, the medium term rate for the next 5 and the long
+    term rate for the last 10, each year discounted at the WACC. Each period is a geometric
+    series, so the 20 year sum is computed in closed form.
+    '''
+    discount_factor = 1 / (1 + np.asarray(wacc, dtype = np.float64))
+    short_ratio = (1 + np.asarray(short_term_growth_rate, dtype = np.float64)) * discount_factor
+    medium_ratio = (1 + np.asarray(medium_term_growth_rate, dtype = np.float64)) * discount_factor
+    long_ratio = (1 + np.asarray(long_term_growth_rate, dtype = np.float64)) * discount_factor
+
+    # discounted cash flow of year 5 and year 10 relative to today's free cash flow
+    year5 = short_ratio**5
+    year10 = year5 * medium_ratio**5
+    DCF = np.asarray(free_cashflow, dtype = np.float64) * (_geometric_sum(short_ratio, 5) +
+                                                           year5 * _geometric_sum(medium_ratio, 5) +
+                                                           year10 * _geometric_sum(long_ratio, 10))
+
+    PresentValue = np.asarray(cash, dtype = np.float64) - total_debt + DCF
+    return(PresentValue / shares)
+
+
+def calc_implied_growth_batch(price, free_cashflow, cash, total_debt, shares, wacc,
+                              long_term_growth_rate = 0.04, medium_term_ratio = 0.5,
+                              lower = -0.99, upper = 2.0, xtol = 1.0e-10):
+    '''
+    Reverse DCF for a whole universe at once: the short term growth rate that makes
+    calc_fair_value_batch equal to price, with the medium term rate linked to it as
+    short term rate * medium_term_ratio (run_analysis3 uses half the short term rate).
+
+    All symbols are solved together with the vectorized Brent method on [lower, upper].
+    Returns a numpy masked array, masked where there is no solution in the interval, e.g. a
+    negative free cash flow with a net cash per share below the price, or missing inputs.
+    '''
+    arrays = np.broadcast_arrays(*[np.asarray(v, dtype = np.float64) for v in
+                                   (price, free_cashflow, cash, total_debt, shares, wacc, long_term_growth_rate)])
+    price, free_cashflow, cash, total_debt, shares, wacc, long_term = [np.atleast_1d(a).ravel() for a in arrays]
+
+    # only solve the symbols with complete inputs
+    valid = np.flatnonzero(np.all(np.isfinite([price, free_cashflow, cash, total_debt, shares, wacc, long_term]),
+                                  axis = 0) & (shares != 0))
+
+    def price_error(growth, index):
+        i = valid[index]
+        return(calc_fair_value_batch(free_cashflow[i], cash[i], total_debt[i], shares[i], wacc[i],
+                                     growth, growth * medium_term_ratio, long_term[i]) - price[i])
+
+    result = brent(price_error, np.full(len(valid), lower), np.full(len(valid), upper), xtol = xtol)
+    growth = np.full(len(price), np.nan)
+    solved = np.zeros(len(price), dtype = bool)
+    growth[valid] = result.root
+    solved[valid] = result.converged
+    return(np.ma.masked_array(growth, mask = ~solved))
+
 
 class DiscountedCashFlowModel(object):
     '''
@@ -36,6 +106,24 @@ class DiscountedCashFlowModel(object):
         self.long_term_growth_rate = long_term_rate
 
 
+    def _model_inputs(self):
+        '''
+        free cash flow, cash, WACC, total debt and shares outstanding of the stock; raises
+        when any of them is not available rather than letting it turn into a nan fair value
+        '''
+        beta = self.stock.get_beta()
+        inputs = {'free cash flow': self.stock.get_free_cashflow(),
+                  'cash and cash equivalent': self.stock.get_cash_and_cash_equivalent(),
+                  'WACC': None if beta is None else self.stock.lookup_wacc_by_beta(beta),
+                  'total debt': self.stock.get_total_debt(),
+                  'shares outstanding': self.stock.get_num_shares_outstanding()}
+        missing = [name for name, value in inputs.items() if value is None]
+        if beta is None:
+            missing[missing.index('WACC')] = 'WACC (no beta)'
+        if missing:
+            raise Exception(f"Missing DCF inputs for {self.stock.symbol}: {', '.join(missing)}")
+        return(tuple(inputs.values()))
+
     def calc_fair_value(self):
         '''
         calculate the fair_value using DCF model as follows
@@ -47,33 +135,113 @@ class DiscountedCashFlowModel(object):
         5. Return the stock fair value of the stock
         '''
         results = None
-        FreeCashFlow = self.stock.get_free_cashflow()
-        CurrentCash = self.stock.get_cash_and_cash_equivalent()
-        WACC = self.stock.lookup_wacc_by_beta(self.stock.get_beta())
-        TotalDebt = self.stock.get_total_debt()
-        Shares = self.stock.get_num_shares_outstanding()
-        DiscountFactor = 1 / (1 + WACC)
-        EPS5Y = self.short_term_growth_rate
-        EPS6To10Y = self.medium_term_growth_rate
-        EPS10To20Y = self.long_term_growth_rate
-        DCF = 0
-        for i in range(1, 6):
-            DCF += FreeCashFlow * (1 + EPS5Y) ** i * DiscountFactor ** i
-
-        CF5 = FreeCashFlow * (1 + EPS5Y) ** 5
-        for i in range(1, 6):
-            DCF += CF5 * (1 + EPS6To10Y) ** i * DiscountFactor ** (i + 5)
-
-        CF10 = CF5 * (1 + EPS6To10Y) ** 5
-        for i in range(1, 11):
-            DCF += CF10 * (1 + EPS10To20Y) ** i * DiscountFactor ** (i + 10)
-
-        PresentValue = CurrentCash - TotalDebt + DCF
-        results = PresentValue / Shares
+        FreeCashFlow, CurrentCash, WACC, TotalDebt, Shares = self._model_inputs()
+        results = float(calc_fair_value_batch(FreeCashFlow, CurrentCash, TotalDebt, Shares, WACC,
+                                              self.short_term_growth_rate, self.medium_term_growth_rate,
+                                              self.long_term_growth_rate))
         return(results)
 
 
+    def calc_implied_growth_rate(self, price, medium_term_ratio = 0.5):
+        '''
+        short term growth rate at which the fair value equals price, the medium term rate
+        being short term rate * medium_term_ratio and the long term rate the one set by
+        set_FCC_growth_rate. Returns None when there is no such growth rate.
+        '''
+        FreeCashFlow, CurrentCash, WACC, TotalDebt, Shares = self._model_inputs()
+        result = calc_implied_growth_batch(price, FreeCashFlow, CurrentCash, TotalDebt, Shares, WACC,
+                                           self.long_term_growth_rate, medium_term_ratio)
+        return(None if result.mask[0] else float(result[0]))
+
+
+def _calc_fair_value_loop(free_cashflow, cash, total_debt, shares, wacc, eps5y, eps6to10y, eps10to20y):
+    # the year by year sum calc_fair_value used before the closed form, kept as a reference
+    discount_factor = 1 / (1 + wacc)
+    DCF = 0
+    for i in range(1, 6):
+        DCF += free_cashflow * (1 + eps5y) ** i * discount_factor ** i
+    CF5 = free_cashflow * (1 + eps5y) ** 5
+    for i in range(1, 6):
+        DCF += CF5 * (1 + eps6to10y) ** i * discount_factor ** (i + 5)
+    CF10 = CF5 * (1 + eps6to10y) ** 5
+    for i in range(1, 11):
+        DCF += CF10 * (1 + eps10to20y) ** i * discount_factor ** (i + 10)
+    return((cash - total_debt + DCF) / shares)
+
+
+def _example_batch(n = 100000):
+    import time
+
+    rng = np.random.default_rng(0)
+    free_cashflow = rng.normal(5e9, 5e9, n)
+    cash = rng.uniform(1e9, 5e10, n)
+    total_debt = rng.uniform(0, 1e11, n)
+    shares = rng.uniform(1e8, 1e10, n)
+    wacc = rng.choice([0.05, 0.06, 0.065, 0.07, 0.075, 0.08, 0.085, 0.09], n)
+    short_term = rng.uniform(-0.1, 0.4, n)
+    # include growth rates where (1 + g) / (1 + wacc) is exactly 1
+    short_term[:10] = wacc[:10]
+
+    start = time.perf_counter()
+    fair_values = calc_fair_value_batch(free_cashflow, cash, total_debt, shares, wacc,
+                                        short_term, short_term / 2, 0.04)
+    t_batch = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = [_calc_fair_value_loop(free_cashflow[i], cash[i], total_debt[i], shares[i], wacc[i],
+                                      short_term[i], short_term[i] / 2, 0.04) for i in range(n)]
+    t_loop = time.perf_counter() - start
+
+    assert(np.allclose(fair_values, expected, rtol = 1e-10, atol = 1e-8))
+    print(f"DCF for {n} symbols: batch {t_batch:.4f}s, loop {t_loop:.2f}s")
+
+
+def _example_implied_growth(output_fname = "StockOutput.csv"):
+    import time
+
+    # the net cash of each symbol is backed out from the saved DCF value, so solving at the
+    # saved DCF value must give back the EPS growth used in the run
+    df = pd.read_csv(output_fname)
+    beta = df['Beta'].values
+    wacc = np.array([0.05, 0.06, 0.065, 0.07, 0.075, 0.08, 0.085, 0.09])[
+        np.searchsorted([0.8, 1.0, 1.1, 1.2, 1.3, 1.5, 1.6], beta, side = 'right')]
+    shares = df['Market Cap'].values / df['Current Price'].values
+    free_cashflow = df['Free Cash Flow'].values
+    growth = df['EPS Next 5Y in percent'].values / 100
+    net_cash = df['DCF value'].values * shares - free_cashflow * calc_fair_value_batch(
+        1, 0, 0, 1, wacc, growth, growth / 2, 0.04)
+
+    implied = calc_implied_growth_batch(df['DCF value'].values, free_cashflow, net_cash, 0, shares, wacc)
+    assert(np.allclose(implied, growth))
+
+    start = time.perf_counter()
+    implied = calc_implied_growth_batch(df['Current Price'].values, free_cashflow, net_cash, 0, shares, wacc)
+    t_solve = time.perf_counter() - start
+    print(f"Implied growth for {len(df)} symbols in {t_solve:.4f}s")
+    for symbol, g, solved in zip(df['Symbol'], implied.filled(np.nan), ~np.ma.getmaskarray(implied)):
+        print(f"  {symbol}: {g:.2%}" if solved else f"  {symbol}: no solution")
+
+
+def _example_missing_inputs():
+    # a stock without a cash flow statement has no free cash flow to value
+    stock = Stock('AAPL')
+    stock.load_fundamentals({'balanceSheetHistory': {'AAPL': [{'2021-09-25': {'cash': 3.5e10}}]}},
+                            {'beta': 1.2, 'marketCap': 2.5e12}, {'regularMarketPrice': 150.0})
+    model = DiscountedCashFlowModel(stock, datetime.date(2021, 12, 1))
+    model.set_FCC_growth_rate(0.1, 0.05, 0.04)
+    try:
+        model.calc_fair_value()
+        raise AssertionError("fair value computed without a free cash flow")
+    except Exception as e:
+        assert('free cash flow' in str(e) and 'total debt' in str(e)), e
+        print(e)
+
+
 def _test():
+    _example_missing_inputs()
+    _example_batch()
+    _example_implied_growth()
+
     symbol = 'AAPL'
     as_of_date = datetime.date(2021, 11, 1)
 
@@ -0,0 +1,132 @@
+import time
+import numpy as np
+import pandas as pd
+
+from DCF_model import calc_fair_value_batch
+
+
+class GrowthDistribution(object):
+    '''
+    Joint normal distribution of the shocks to the short, medium and long term growth rates
+    and to the WACC, added to each symbol's point estimates
+
+    vols are the standard deviations of the four shocks and correlation their 4x4 correlation
+    matrix, in the order short, medium, long, WACC. The default makes the three growth rates
+    move together and the WACC move mostly on its own.
+    '''
+    def __init__(self, vols = (0.05, 0.03, 0.01, 0.01), correlation = None):
+        self.vols = np.asarray(vols, dtype = np.float64)
+        if correlation is None:
+            correlation = [[1.0, 0.7, 0.3, 0.0],
+                           [0.7, 1.0, 0.5, 0.0],
+                           [0.3, 0.5, 1.0, 0.2],
+                           [0.0, 0.0, 0.2, 1.0]]
+        self.correlation = np.asarray(correlation, dtype = np.float64)
+        self._cholesky = np.linalg.cholesky(self.correlation)
+
+    def draw(self, n_scenarios, seed = None):
+        '''
+        (n_scenarios x 4) shocks to short, medium, long growth rates and WACC
+        '''
+        rng = np.random.default_rng(seed)
+        normals = rng.standard_normal((n_scenarios, 4))
+        return((normals @ self._cholesky.T) * self.vols)
+
+
+def _universe_arrays(free_cashflow, cash, total_debt, shares, wacc, short_term_growth_rate,
+                     medium_term_growth_rate, long_term_growth_rate):
+    short_term_growth_rate = np.asarray(short_term_growth_rate, dtype = np.float64)
+    if medium_term_growth_rate is None:
+        # the convention of run_analysis3: the medium term rate is half the short term rate
+        medium_term_growth_rate = short_term_growth_rate / 2
+    arrays = np.broadcast_arrays(*[np.asarray(v, dtype = np.float64) for v in
+                                   (free_cashflow, cash, total_debt, shares, wacc, short_term_growth_rate,
+                                    medium_term_growth_rate, long_term_growth_rate)])
+    return([np.atleast_1d(a) for a in arrays])
+
+
+def simulate_fair_values(free_cashflow, cash, total_debt, shares, wacc, short_term_growth_rate,
+                         medium_term_growth_rate = None, long_term_growth_rate = 0.04,
+                         distribution = None, n_scenarios = 100000, percentiles = (5, 25, 50, 75, 95),
+                         max_chunk_elements = 2**23, seed = None):
+    '''
+    Monte Carlo DCF: fair value percentiles per symbol under joint growth rate and WACC scenarios
+
+    the fundamentals and point estimates are scalars or one value per symbol. The same
+    n_scenarios shocks from distribution are applied to every symbol, and symbols are valued
+    in chunks of at most max_chunk_elements (symbol, scenario) pairs to bound memory.
+    Returns a (symbols x percentiles) array
+    '''
+    distribution = GrowthDistribution() if distribution is None else distribution
+    arrays = _universe_arrays(free_cashflow, cash, total_debt, shares, wacc, short_term_growth_rate,
+                              medium_term_growth_rate, long_term_growth_rate)
+    free_cashflow, cash, total_debt, shares, wacc, short_term, medium_term, long_term = arrays
+    shocks = distribution.draw(n_scenarios, seed)
+
+    n_symbols = len(free_cashflow)
+    result = np.empty((n_symbols, len(percentiles)))
+    symbols_per_chunk = max(1, max_chunk_elements // n_scenarios)
+    for start in range(0, n_symbols, symbols_per_chunk):
+        rows = slice(start, min(start + symbols_per_chunk, n_symbols))
+        column = lambda values: values[rows, np.newaxis]
+        fair_values = calc_fair_value_batch(column(free_cashflow), column(cash), column(total_debt),
+                                            column(shares), column(wacc) + shocks[:, 3],
+                                            column(short_term) + shocks[:, 0],
+                                            column(medium_term) + shocks[:, 1],
+                                            column(long_term) + shocks[:, 2])
+        result[rows] = np.percentile(fair_values, percentiles, axis = 1).T
+    return(result)
+
+
+def sensitivity_grid(free_cashflow, cash, total_debt, shares, short_term_growth_rates, waccs,
+                     medium_term_ratio = 0.5, long_term_growth_rate = 0.04):
+    '''
+    fair value per symbol on a short term growth x WACC grid, shape (symbols, growth rates, waccs)
+    the medium term rate follows the short term rate through medium_term_ratio
+    '''
+    column = lambda values: np.atleast_1d(np.asarray(values, dtype = np.float64))[:, np.newaxis, np.newaxis]
+    growth = np.asarray(short_term_growth_rates, dtype = np.float64)[:, np.newaxis]
+    waccs = np.asarray(waccs, dtype = np.float64)[np.newaxis, :]
+    return(calc_fair_value_batch(column(free_cashflow), column(cash), column(total_debt), column(shares),
+                                 waccs, growth, growth * medium_term_ratio, long_term_growth_rate))
+
+
+def _example(input_fname = "StockInput.csv"):
+    # the growth estimates of the input universe, with made up fundamentals of similar size
+    df = pd.read_csv(input_fname)
+    n = len(df)
+    rng = np.random.default_rng(0)
+    short_term = df['EPS Next 5Y in percent'].astype(float).values / 100
+    free_cashflow = rng.normal(5e9, 1e10, n)
+    cash = rng.uniform(1e9, 5e10, n)
+    total_debt = rng.uniform(0, 1e11, n)
+    shares = rng.uniform(1e8, 1e10, n)
+    wacc = rng.choice([0.05, 0.06, 0.065, 0.07, 0.075, 0.08, 0.085, 0.09], n)
+
+    start = time.perf_counter()
+    bands = simulate_fair_values(free_cashflow, cash, total_debt, shares, wacc, short_term, seed = 0)
+    t_simulation = time.perf_counter() - start
+
+    start = time.perf_counter()
+    grid = sensitivity_grid(free_cashflow, cash, total_debt, shares,
+                            np.arange(-0.05, 0.40, 0.0025), np.arange(0.04, 0.12, 0.0025))
+    t_grid = time.perf_counter() - start
+
+    # with no shocks every percentile is the point estimate
+    point = calc_fair_value_batch(free_cashflow, cash, total_debt, shares, wacc, short_term, short_term / 2, 0.04)
+    flat = simulate_fair_values(free_cashflow, cash, total_debt, shares, wacc, short_term,
+                                distribution = GrowthDistribution(vols = (0, 0, 0, 0)), n_scenarios = 10)
+    assert(np.allclose(flat, point[:, np.newaxis]))
+
+    print(f"{n} symbols x 100000 scenarios in {t_simulation:.2f}s, "
+          f"{grid.shape[1]} x {grid.shape[2]} grid in {t_grid:.4f}s")
+    for symbol, band in list(zip(df['Symbol'], bands))[:5]:
+        print(symbol, "5/25/50/75/95%:", np.round(band, 2))
+
+
+def _test():
+    _example()
+
+
+if __name__ == "__main__":
+    _test()
@@ -6,15 +6,72 @@ import numpy as np
 
 from datetime import date
 from scipy.stats import norm
+from scipy.signal import lfilter
 from dateutil.relativedelta import relativedelta
 
 from math import log, exp, sqrt
 
 from stock import *
+from TA_streaming import ChunkedVWAP
+
+def calc_smas(values, periods, min_periods = 1):
+    '''
+    simple moving averages of values for all periods from one cumulative sum pass
+
+    values is a 1D price array or a 2D (dates x symbols) panel, the result has one more axis
+    with one column per period: (dates x periods) or (dates x symbols x periods), each
+    result[..., k] being contiguous. Like
+    pandas rolling(period, min_periods).mean(), nan prices are skipped and a window with
+    fewer than min_periods prices is nan. The prices are shifted by their first valid value
+    before summing, so the running sums stay small and the differences keep their precision.
+    '''
+    values = np.asarray(values, dtype = np.float64)
+    # one contiguous block per period, returned with the period axis last
+    result = np.empty((len(periods),) + values.shape)
+    if values.ndim == 2:
+        # a few hundred symbols at a time, so the running sums stay in cache
+        for start in range(0, values.shape[1], 256):
+            _calc_smas_into(values[:, start:start + 256], periods, min_periods, result[:, :, start:start + 256])
+    else:
+        _calc_smas_into(values, periods, min_periods, result)
+    return(np.moveaxis(result, 0, -1))
+
+
+def _calc_smas_into(values, periods, min_periods, out):
+    valid = ~np.isnan(values)
+    first_valid = np.argmax(valid, axis = 0)
+    offset = np.take_along_axis(values, np.expand_dims(first_valid, 0), axis = 0)
+    offset = np.where(np.isnan(offset), 0.0, offset)
+
+    n = len(values)
+    # running sums with a leading zero row: the window (t - period, t] is sums[t + 1] - sums[max(t + 1 - period, 0)]
+    sums = np.zeros((n + 1,) + values.shape[1:])
+    np.cumsum(np.where(valid, values - offset, 0.0), axis = 0, out = sums[1:])
+    if valid.all():
+        counts = np.arange(n + 1, dtype = np.float64).reshape((n + 1,) + (1,) * (values.ndim - 1))
+    else:
+        counts = np.zeros((n + 1,) + values.shape[1:])
+        np.cumsum(valid, axis = 0, out = counts[1:])
+
+    window_count = np.empty((n,) + counts.shape[1:])
+    for k, period in enumerate(periods):
+        p = min(period, n + 1)
+        window_sum = out[k]
+        window_sum[:p - 1] = sums[1:p]
+        window_count[:p - 1] = counts[1:p]
+        np.subtract(sums[p:], sums[:n + 1 - p], out = window_sum[p - 1:])
+        np.subtract(counts[p:], counts[:n + 1 - p], out = window_count[p - 1:])
+        # an empty window is 0 / 0 = nan already
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            np.divide(window_sum, window_count, out = window_sum)
+        window_sum += offset
+        if min_periods > 1:
+            window_sum[np.broadcast_to(window_count < min_periods, values.shape)] = np.nan
+
 
 class SimpleMovingAverages(object):
     '''
-    On given a OHLCV data frame, calculate corresponding simple moving averages
+    On given a OHLCV data frame (or a PricePanel.symbol_view), calculate corresponding simple moving averages
     '''
     def __init__(self, ohlcv_df, periods):
         #
@@ -22,20 +79,16 @@ class SimpleMovingAverages(object):
         self.periods = periods
         self._sma = {}
 
-    def _calc(self, period, price_source):
+    def run(self, price_source = 'Close', periods = None):
         '''
-        for a given period, calc the SMA as a pandas series from the price_source
-        which can be  open, high, low or close
+        Calculate all the simple moving averages as a dict, in one pass with calc_smas
+        periods restricts the calculation to the periods actually used (default all)
         '''
-        result = self.ohlcv_df[price_source].rolling(period, min_periods = 1).mean()
-        return(result)
-        
-    def run(self, price_source = 'Close'):
-        '''
-        Calculate all the simple moving averages as a dict
-        '''
-        for period in self.periods:
-            self._sma[period] = self._calc(period, price_source)
+        periods = self.periods if periods is None else periods
+        prices = self.ohlcv_df[price_source]
+        smas = calc_smas(prices.values, periods)
+        for k, period in enumerate(periods):
+            self._sma[period] = pd.Series(smas[:, k], index = prices.index, name = prices.name)
     
     def get_series(self, period):
         return(self._sma[period])
@@ -43,7 +96,7 @@ class SimpleMovingAverages(object):
     
 class ExponentialMovingAverages(object):
     '''
-    On given a OHLCV data frame, calculate corresponding simple moving averages
+    On given a OHLCV data frame (or a PricePanel.symbol_view), calculate corresponding simple moving averages
     '''
     def __init__(self, ohlcv_df, periods):
         #
@@ -69,48 +122,182 @@ class ExponentialMovingAverages(object):
         return(self._ema[period])
 
 
+def decay_filter(x, decay, block = 16):
+    '''
+    y[t] = decay * y[t - 1] + x[t] along the first axis of x (starting from y[-1] = 0), as
+    lfilter([1], [1, -decay], x, axis = 0). Panels of many symbols are run block rows of
+    dates at a time as small matrix products, several times faster than lfilter's loop; the
+    block matrix only holds powers of decay, so the precision is the same.
+    '''
+    x = np.asarray(x, dtype = np.float64)
+    if x.ndim == 1 or x[0].size < 64:
+        return(lfilter([1.0], [1.0, -decay], x, axis = 0))
+    n = len(x)
+    x_2d = x.reshape(n, -1)
+    y = np.empty(x_2d.shape)
+    k = np.arange(block)
+    lower = np.tril(decay**np.maximum(k[:, np.newaxis] - k, 0))
+    carry = decay**(k + 1)
+    for start in range(0, n, block):
+        end = min(start + block, n)
+        np.matmul(lower[:end - start, :end - start], x_2d[start:end], out = y[start:end])
+        if start > 0:
+            y[start:end] += carry[:end - start, np.newaxis] * y[start - 1]
+    return(y.reshape(x.shape))
+
+
+def _smoothed_moves(changes, period, smoothing, normalize = True):
+    '''
+    average up and down moves of a block of price changes (dates x symbols) in which every
+    nan is leading (before the first change of a symbol); changes is overwritten.
+    Returns (up, down, ready), ready flagging the rows where period changes have been seen.
+
+    'ema' is pandas ewm(com = period - 1, adjust = True), the smoothing TA.RSI always used;
+    'wilder' starts from the mean of the first period changes and then applies
+    avg = (avg * (period - 1) + change) / period. Both are the linear recurrence
+    y[t] = decay * y[t - 1] + x[t], run by decay_filter along the dates. With normalize =
+    False up and down are left scaled by the same factor per row, enough for their ratio.
+    '''
+    n = len(changes)
+    if n == 0:
+        return(np.zeros(changes.shape), np.zeros(changes.shape), np.zeros(changes.shape, dtype = bool))
+    decay = 1 - 1 / period
+    valid = ~np.isnan(changes)
+    first = np.argmax(valid, axis = 0)
+    first[~valid.any(axis = 0)] = n
+    rows = np.arange(n)[:, np.newaxis]
+    ready = rows >= first + period - 1
+
+    up = np.fmax(changes, 0.0)
+    down = np.fmin(changes, 0.0, out = changes)
+    if smoothing == 'ema':
+        up = decay_filter(up, decay)
+        down = decay_filter(down, decay)
+        if normalize:
+            # sum of the weights decay**k of the changes seen so far
+            weight = (1 - decay**np.maximum(rows - first + 1, 0)) / (1 - decay)
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                up /= weight
+                down /= weight
+    elif smoothing == 'wilder':
+        seed_row = np.minimum(first + period - 1, n - 1)
+        columns = np.arange(changes.shape[1])
+        for moves in (up, down):
+            # start the recurrence at the seed row with the sum of the first period changes,
+            # decay_filter(moves) / period is then the running average
+            seed = np.cumsum(moves, axis = 0)[seed_row, columns]
+            moves[rows < seed_row] = 0.0
+            moves[seed_row, columns] = seed
+        up = decay_filter(up, decay)
+        down = decay_filter(down, decay)
+        if normalize:
+            up /= period
+            down /= period
+    else:
+        raise Exception("Unsupported RSI smoothing")
+    return(up, down, ready)
+
+
+def _rsi_from_moves(up, down, ready):
+    # 100 - 100 / (1 + |up / down|), computed in place in up
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        np.divide(up, down, out = up)
+    np.abs(up, out = up)
+    up += 1
+    np.divide(100.0, up, out = up)
+    np.subtract(100.0, up, out = up)
+    up[~ready] = np.nan
+    return(up)
+
+
+def calc_rsi(prices, period = 14, smoothing = 'ema', out = None, block_size = 256):
+    '''
+    RSI of a 1D price array or of a 2D (dates x symbols) panel, in a preallocated out array
+    of the same shape (allocated if None). out[0] is nan, there is no price change yet.
+
+    smoothing is 'ema' (TA.RSI's pandas ewm with alpha 1 / period) or 'wilder' (Wilder's
+    original running average seeded with a simple mean), see _smoothed_moves. Symbols are
+    processed block_size columns at a time, so the temporaries stay a few (dates x block_size)
+    arrays whatever the panel size. nan price changes are skipped, as TA.RSI drops them, and
+    their rows are nan in out.
+    '''
+    prices = np.asarray(prices, dtype = np.float64)
+    if out is None:
+        out = np.empty(prices.shape)
+    n = len(prices)
+    prices_2d = prices.reshape(n, -1)
+    out_2d = out.reshape(n, -1)
+    out_2d[0] = np.nan
+    if n < 2:
+        return(out)
+
+    for start in range(0, prices_2d.shape[1], block_size):
+        block = slice(start, start + block_size)
+        changes = np.subtract(prices_2d[1:, block], prices_2d[:-1, block])
+        result = out_2d[1:, block]
+
+        # symbols with a gap after their first change: move their nan changes to the top of the
+        # column (a stable sort keeps the order of the others), so all the nans are leading, and
+        # scatter the RSI back; the rows of the nan changes are not ready, so nan
+        valid = ~np.isnan(changes)
+        gaps = np.flatnonzero((len(changes) - valid.sum(axis = 0) > np.argmax(valid, axis = 0)) & valid.any(axis = 0))
+        if len(gaps):
+            order = np.argsort(valid[:, gaps], axis = 0, kind = 'stable')
+            gap_changes = np.take_along_axis(changes[:, gaps], order, axis = 0)
+            gap_result = np.empty(gap_changes.shape)
+            np.put_along_axis(gap_result, order, _rsi_from_moves(*_smoothed_moves(gap_changes, period, smoothing,
+                                                                                  normalize = False)), axis = 0)
+        # the columns are independent, those with gaps are overwritten below
+        result[:] = _rsi_from_moves(*_smoothed_moves(changes, period, smoothing, normalize = False))
+        if len(gaps):
+            result[:, gaps] = gap_result
+    return(out)
+
+
 class RSI(object):
 
-    def __init__(self, ohlcv_df, period = 14):
+    def __init__(self, ohlcv_df, period = 14, price_source = 'Adj Close', smoothing = 'ema'):
         self.ohlcv_df = ohlcv_df
         self.period = period
+        self.price_source = price_source
+        self.smoothing = smoothing
         self.rsi = None
+        self.up_chg_avg = None
+        self.down_chg_avg = None
 
     def get_series(self):
         return(self.rsi)
 
     def run(self):
         '''
-        calculate RSI
+        calculate RSI, on the days with a price change (see calc_rsi for the smoothing)
         '''
-        diff = self.ohlcv_df['Adj Close'].diff(1).dropna()  # diff in one field(one day)
-
-        # this preservers dimensions off diff values
-        up_chg = 0 * diff
-        down_chg = 0 * diff
-
-        # up change is equal to the positive difference, otherwise equal to zero
-        up_chg[diff > 0] = diff[diff > 0]
-
-        # down change is equal to negative deifference, otherwise equal to zero
-        down_chg[diff < 0] = diff[diff < 0]
-
-        # check pandas documentation for ewm
-        # https://pandas.pydata.org/pandas-docs/stable/reference/api/pandas.DataFrame.ewm.html
-        # values are related to exponential decay
-        # we set com=time_window-1 so we get decay alpha=1/time_window
-        up_chg_avg = up_chg.ewm(com=self.period - 1, min_periods=self.period).mean()
-        down_chg_avg = down_chg.ewm(com=self.period - 1, min_periods=self.period).mean()
-
-        rs = abs(up_chg_avg / down_chg_avg)
-        self.rsi = 100 - 100 / (1 + rs)
+        prices = self.ohlcv_df[self.price_source]
+        diff = np.diff(np.asarray(prices.values, dtype = np.float64))  # diff in one field(one day)
+        valid = ~np.isnan(diff)
+        index = prices.index[1:][valid]
+
+        up_chg_avg, down_chg_avg, ready = _smoothed_moves(diff[valid][:, np.newaxis], self.period, self.smoothing)
+        # kept to seed TA_streaming.StreamingRSI
+        self.up_chg_avg = pd.Series(np.where(ready, up_chg_avg, np.nan)[:, 0], index = index)
+        self.down_chg_avg = pd.Series(np.where(ready, down_chg_avg, np.nan)[:, 0], index = index)
+
+        self.rsi = pd.Series(_rsi_from_moves(up_chg_avg, down_chg_avg, ready)[:, 0], index = index,
+                             name = prices.name)
         return (self.rsi)
 
 class VWAP(object):
-
-    def __init__(self, ohlcv_df):
+    '''
+    VWAP of the typical price, cumulative over the whole data frame by default; with
+    session = True it restarts every day and window = N adds the VWAP of the last N bars
+    (see TA_streaming.ChunkedVWAP, which streams large intraday files in chunks)
+    '''
+    def __init__(self, ohlcv_df, session = False, window = None):
         self.ohlcv_df = ohlcv_df
+        self.session = session
+        self.window = window
         self.vwap = None
+        self.rolling_vwap = None
 
     def get_series(self):
         return(self.vwap)
@@ -119,12 +306,129 @@ class VWAP(object):
         '''
         calculate VWAP
         '''
+        if self.session or self.window is not None:
+            result = ChunkedVWAP(self.session, self.window).update(self.ohlcv_df)
+            self.vwap = result['VWAP']
+            if self.window is not None:
+                self.rolling_vwap = result[f'VWAP{self.window}']
+            return(self.vwap)
         Price = (self.ohlcv_df['High'] + self.ohlcv_df['Low'] + self.ohlcv_df['Close']) / 3
         self.vwap = ((self.ohlcv_df['Volume'] * Price).cumsum()) / self.ohlcv_df['Volume'].cumsum()
         return(self.vwap)
 
 
+def _benchmark_sma(n_dates = 5000, n_symbols = 1000, periods = [9, 10, 20, 50, 100, 200]):
+    import time
+
+    rng = np.random.default_rng(0)
+    panel = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, (n_dates, n_symbols)), axis = 0))
+    panel[:rng.integers(0, n_dates // 2), 0] = np.nan
+    df = pd.DataFrame(panel)
+
+    start = time.perf_counter()
+    expected = [df.rolling(period, min_periods = 1).mean().values for period in periods]
+    t_loop = time.perf_counter() - start
+
+    start = time.perf_counter()
+    smas = calc_smas(panel, periods)
+    t_fused = time.perf_counter() - start
+
+    for k in range(len(periods)):
+        assert(np.allclose(smas[..., k], expected[k], rtol = 1e-12, atol = 1e-10, equal_nan = True))
+    print(f"{len(periods)} SMAs of {n_dates} x {n_symbols}: rolling loop {t_loop:.3f}s, fused {t_fused:.3f}s")
+
+    series = df[1]
+    start = time.perf_counter()
+    for period in periods:
+        series.rolling(period, min_periods = 1).mean()
+    t_loop = time.perf_counter() - start
+    start = time.perf_counter()
+    calc_smas(series.values, periods)
+    t_fused = time.perf_counter() - start
+    print(f"{len(periods)} SMAs of one series: rolling loop {t_loop * 1e3:.2f}ms, fused {t_fused * 1e3:.2f}ms")
+
+
+def _calc_rsi_pandas(prices, period = 14):
+    # the pandas implementation RSI.run used before calc_rsi, kept as a reference
+    diff = prices.diff(1).dropna()
+    up_chg = 0 * diff
+    down_chg = 0 * diff
+    up_chg[diff > 0] = diff[diff > 0]
+    down_chg[diff < 0] = diff[diff < 0]
+    up_chg_avg = up_chg.ewm(com=period - 1, min_periods=period).mean()
+    down_chg_avg = down_chg.ewm(com=period - 1, min_periods=period).mean()
+    return(100 - 100 / (1 + abs(up_chg_avg / down_chg_avg)))
+
+
+def _calc_rsi_wilder_loop(prices, period = 14):
+    # Wilder's RSI day by day, reference for calc_rsi(smoothing = 'wilder')
+    changes = np.diff(prices)
+    result = np.full(len(prices), np.nan)
+    up = np.mean(np.maximum(changes[:period], 0))
+    down = np.mean(np.minimum(changes[:period], 0))
+    for t in range(period - 1, len(changes)):
+        if t >= period:
+            up = (up * (period - 1) + max(changes[t], 0)) / period
+            down = (down * (period - 1) + min(changes[t], 0)) / period
+        result[t + 1] = 100 - 100 / (1 + abs(up / down))
+    return(result)
+
+
+def _benchmark_rsi(n_dates = 5000, n_symbols = 5000, n_loop = 50):
+    import time
+    import tracemalloc
+
+    rng = np.random.default_rng(0)
+    panel = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, (n_dates, n_symbols)), axis = 0))
+    # ragged listings, a trading halt and a symbol without prices
+    panel[:rng.integers(0, n_dates // 2), 1] = np.nan
+    panel[100:110, 2] = np.nan
+    panel[:, 3] = np.nan
+    out = np.empty_like(panel)
+
+    for j in range(5):
+        expected = _calc_rsi_pandas(pd.Series(panel[:, j]))
+        result = calc_rsi(panel[:, j])
+        assert(np.allclose(result[expected.index], expected.values, rtol = 1e-10, equal_nan = True))
+        assert(np.isnan(np.delete(result, expected.index)).all())
+    assert(np.allclose(calc_rsi(panel[:, 0], smoothing = 'wilder'), _calc_rsi_wilder_loop(panel[:, 0]),
+                       rtol = 1e-10, equal_nan = True))
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    calc_rsi(panel, out = out)
+    t_kernel = time.perf_counter() - start
+    peak_kernel = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    frame = pd.DataFrame(panel[:, :n_loop])
+    tracemalloc.start()
+    start = time.perf_counter()
+    for j in range(n_loop):
+        _calc_rsi_pandas(frame[j])
+    t_loop = (time.perf_counter() - start) * n_symbols / n_loop
+    peak_loop = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(f"RSI of {n_dates} x {n_symbols}: kernel {t_kernel:.2f}s, peak {peak_kernel / 2**20:.0f}MB "
+          f"over a {out.nbytes / 2**20:.0f}MB output; pandas per symbol {t_loop:.1f}s (from {n_loop} symbols), "
+          f"peak {peak_loop / 2**20:.1f}MB")
+
+
+def _example_short_rsi():
+    # one price, or no price at all: no change to average, an empty RSI as pandas gives
+    index = pd.bdate_range('2021-11-01', periods = 5)
+    for prices in ([101.0], [np.nan] * 5):
+        df = pd.DataFrame({'Adj Close': prices}, index = index[:len(prices)])
+        for smoothing in ('ema', 'wilder'):
+            rsi = RSI(df, smoothing = smoothing)
+            assert(len(rsi.run()) == 0 and len(rsi.up_chg_avg) == 0)
+    assert(np.isnan(calc_rsi([101.0, np.nan, np.nan])).all())
+
+
 def _test():
+    _example_short_rsi()
+
     # simple test cases
     symbol = 'AAPL'
     stock = Stock(symbol)
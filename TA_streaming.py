@@ -0,0 +1,488 @@
+import math
+import numpy as np
+import pandas as pd
+
+
+class _EWMean(object):
+    '''
+    pandas ewm(alpha = alpha, adjust = True, min_periods = min_periods).mean(), one value at a time
+    state is the current mean and the total weight of the past observations
+    '''
+    def __init__(self, alpha, min_periods = 0):
+        self.decay = 1 - alpha
+        self.min_periods = max(min_periods, 1)
+        self.weighted = math.nan
+        self.old_weight = 1.0
+        self.n_observations = 0
+
+    def seed(self, mean, n_observations):
+        # the weight of n observations without gaps: 1 + decay + ... + decay**(n - 1)
+        self.weighted = mean
+        self.n_observations = n_observations
+        self.old_weight = (1 - self.decay**n_observations) / (1 - self.decay)
+
+    def update(self, value):
+        is_observation = value == value
+        self.n_observations += is_observation
+        if self.weighted == self.weighted:
+            self.old_weight *= self.decay
+            if is_observation:
+                if self.weighted != value:
+                    self.weighted = (self.old_weight * self.weighted + value) / (self.old_weight + 1)
+                self.old_weight += 1
+        elif is_observation:
+            self.weighted = value
+        return(self.value)
+
+    @property
+    def value(self):
+        return(self.weighted if self.n_observations >= self.min_periods else math.nan)
+
+
+class _WilderMean(object):
+    '''
+    Wilder's running average: the mean of the first period values, then
+    avg = (avg * (period - 1) + value) / period; nan values are skipped
+    '''
+    def __init__(self, period):
+        self.period = period
+        self.mean = 0.0
+        self.n_observations = 0
+
+    def seed(self, mean, n_observations):
+        self.mean = mean
+        self.n_observations = n_observations
+
+    def update(self, value):
+        if value == value:
+            self.n_observations += 1
+            if self.n_observations <= self.period:
+                self.mean += (value - self.mean) / self.n_observations
+            else:
+                self.mean = (self.mean * (self.period - 1) + value) / self.period
+        return(self.value)
+
+    @property
+    def value(self):
+        return(self.mean if self.n_observations >= self.period else math.nan)
+
+
+class StreamingSMA(object):
+    '''
+    Simple moving average over the last period prices, updated in O(1) per bar from a
+    ring buffer; matches SimpleMovingAverages (nan prices are skipped, shorter windows are
+    averaged at the start). The running sum is recomputed from the buffer each time it
+    wraps around, so rounding errors do not build up.
+    '''
+    def __init__(self, period):
+        self.period = period
+        self._buffer = np.full(period, np.nan)
+        self._position = 0
+        self._sum = 0.0
+        self._count = 0
+
+    @classmethod
+    def from_prices(cls, prices, period):
+        '''
+        seeded with the last period prices of a history, eg ohlcv_df['Close']
+        '''
+        result = cls(period)
+        for price in np.asarray(prices, dtype = np.float64)[-period:]:
+            result.update(price)
+        return(result)
+
+    def update(self, price):
+        old = self._buffer[self._position]
+        if old == old:
+            self._sum -= old
+            self._count -= 1
+        if price == price:
+            self._sum += price
+            self._count += 1
+        self._buffer[self._position] = price
+        self._position += 1
+        if self._position == self.period:
+            self._position = 0
+            self._sum = float(np.nansum(self._buffer))
+        return(self.value)
+
+    @property
+    def value(self):
+        return(self._sum / self._count if self._count > 0 else math.nan)
+
+
+class StreamingEMA(object):
+    '''
+    Exponential moving average with span period, updated in O(1) per bar; matches
+    ExponentialMovingAverages (pandas ewm(span = period).mean())
+    '''
+    def __init__(self, period):
+        self.period = period
+        self._mean = _EWMean(2 / (period + 1))
+
+    @classmethod
+    def from_batch(cls, ema_series, period):
+        '''
+        seeded from a batch EMA series, eg ExponentialMovingAverages.get_series(period),
+        computed on prices without missing values
+        '''
+        result = cls(period)
+        valid = ema_series.dropna()
+        if len(valid) > 0:
+            result._mean.seed(float(valid.iloc[-1]), len(valid))
+        return(result)
+
+    def update(self, price):
+        return(self._mean.update(price))
+
+    @property
+    def value(self):
+        return(self._mean.value)
+
+
+class StreamingRSI(object):
+    '''
+    RSI updated in O(1) per bar; matches TA.RSI with the same smoothing: 'ema' averages
+    the up and down moves with pandas' ewm(alpha = 1 / period, adjust = True), 'wilder' with
+    Wilder's running average. The RSI is nan until period price changes have been seen
+    '''
+    def __init__(self, period = 14, smoothing = 'ema'):
+        self.period = period
+        self.smoothing = smoothing
+        if smoothing == 'ema':
+            self._up = _EWMean(1 / period, period)
+            self._down = _EWMean(1 / period, period)
+        elif smoothing == 'wilder':
+            self._up = _WilderMean(period)
+            self._down = _WilderMean(period)
+        else:
+            raise Exception("Unsupported RSI smoothing")
+        self._last_price = math.nan
+
+    @classmethod
+    def from_prices(cls, prices, period = 14, smoothing = 'ema'):
+        result = cls(period, smoothing)
+        for price in np.asarray(prices, dtype = np.float64):
+            result.update(price)
+        return(result)
+
+    @classmethod
+    def from_batch(cls, rsi):
+        '''
+        seeded from a TA.RSI object after run(), using its average up and down moves
+        '''
+        prices = rsi.ohlcv_df[rsi.price_source]
+        if len(rsi.up_chg_avg) < rsi.period:
+            return(cls.from_prices(prices.values, rsi.period, rsi.smoothing))
+        result = cls(rsi.period, rsi.smoothing)
+        result._up.seed(float(rsi.up_chg_avg.iloc[-1]), len(rsi.up_chg_avg))
+        result._down.seed(float(rsi.down_chg_avg.iloc[-1]), len(rsi.down_chg_avg))
+        result._last_price = float(prices.iloc[-1])
+        return(result)
+
+    def update(self, price):
+        change = price - self._last_price
+        self._last_price = price
+        if change == change:
+            self._up.update(max(change, 0.0))
+            self._down.update(min(change, 0.0))
+        return(self.value)
+
+    @property
+    def value(self):
+        up, down = self._up.value, self._down.value
+        if up != up or down != down:
+            return(math.nan)
+        if down == 0:
+            return(100.0 if up > 0 else math.nan)
+        return(100 - 100 / (1 + abs(up / down)))
+
+
+class StreamingVWAP(object):
+    '''
+    Volume weighted average of the typical price (high + low + close) / 3, updated in O(1)
+    per bar. Cumulative over all bars like TA.VWAP, or with session = True reset whenever
+    the date of the bar's timestamp changes
+    '''
+    def __init__(self, session = False):
+        self.session = session
+        self._price_volume = 0.0
+        self._volume = 0.0
+        self._session_date = None
+
+    @classmethod
+    def from_batch(cls, vwap):
+        '''
+        seeded from a TA.VWAP object after run() (cumulative VWAP only)
+        '''
+        result = cls()
+        volume = vwap.ohlcv_df['Volume']
+        result._volume = float(volume.sum())
+        result._price_volume = float(vwap.vwap.dropna().iloc[-1]) * result._volume if result._volume > 0 else 0.0
+        return(result)
+
+    @classmethod
+    def from_bars(cls, ohlcv_df, session = False):
+        result = cls(session)
+        timestamps = ohlcv_df.index if session else [None] * len(ohlcv_df)
+        for timestamp, high, low, close, volume in zip(timestamps, ohlcv_df['High'].values, ohlcv_df['Low'].values,
+                                                       ohlcv_df['Close'].values, ohlcv_df['Volume'].values):
+            result.update(high, low, close, volume, timestamp)
+        return(result)
+
+    def update(self, high, low, close, volume, timestamp = None):
+        if self.session:
+            session_date = pd.Timestamp(timestamp).date()
+            if session_date != self._session_date:
+                self._session_date = session_date
+                self._price_volume = self._volume = 0.0
+        price_volume = volume * (high + low + close) / 3
+        if price_volume == price_volume:
+            self._price_volume += price_volume
+            self._volume += volume
+        return(self.value if price_volume == price_volume else math.nan)
+
+    @property
+    def value(self):
+        return(self._price_volume / self._volume if self._volume > 0 else math.nan)
+
+
+def _local_dates(index):
+    # datetime64[D] session dates in the index's own time zone, as pd.Timestamp(t).date()
+    index = pd.DatetimeIndex(index)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    return(index.values.astype('datetime64[D]'))
+
+
+class ChunkedVWAP(object):
+    '''
+    VWAP of the typical price (high + low + close) / 3 over a stream of bar chunks (data
+    frames indexed by timestamp), vectorized within each chunk. The running sums are carried
+    from one chunk to the next, so the values do not depend on where the chunks are cut.
+
+    session = True resets the VWAP whenever the date changes, otherwise it is cumulative
+    like TA.VWAP. window = N adds the VWAP of the last N bars, across sessions. Only the
+    running sums and the last N - 1 bars are kept between chunks.
+    '''
+    def __init__(self, session = True, window = None):
+        self.session = session
+        self.window = window
+        self._price_volume = 0.0
+        self._volume = 0.0
+        self._session_date = None
+        self._tail_price_volume = np.zeros(0)
+        self._tail_volume = np.zeros(0)
+
+    def update(self, chunk):
+        '''
+        data frame of the VWAP (and VWAP<window>) of every bar of chunk
+        '''
+        volume = np.nan_to_num(chunk['Volume'].values.astype(np.float64))
+        price_volume = np.nan_to_num(volume * (chunk['High'].values + chunk['Low'].values + chunk['Close'].values) / 3)
+        n = len(volume)
+        result = pd.DataFrame(index = chunk.index)
+        if n == 0:
+            return(result)
+
+        # running sums, restarted at each new session; summing each session separately keeps
+        # the early values of a session as precise as in a groupby cumsum
+        if self.session:
+            dates = _local_dates(chunk.index)
+            new_session = np.empty(n, dtype = bool)
+            new_session[0] = self._session_date is None or dates[0] != self._session_date
+            new_session[1:] = dates[1:] != dates[:-1]
+            self._session_date = dates[-1]
+            if new_session[0]:
+                self._price_volume = self._volume = 0.0
+            bounds = np.concatenate([[0], np.flatnonzero(new_session[1:]) + 1, [n]])
+        else:
+            bounds = np.array([0, n])
+
+        session_price_volume = np.empty(n)
+        session_volume = np.empty(n)
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            np.cumsum(price_volume[lo:hi], out = session_price_volume[lo:hi])
+            np.cumsum(volume[lo:hi], out = session_volume[lo:hi])
+        # the session carried in from the previous chunk
+        session_price_volume[:bounds[1]] += self._price_volume
+        session_volume[:bounds[1]] += self._volume
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            result['VWAP'] = session_price_volume / session_volume
+        self._price_volume = session_price_volume[-1]
+        self._volume = session_volume[-1]
+
+        if self.window is not None:
+            window_price_volume = np.concatenate([self._tail_price_volume, price_volume])
+            window_volume = np.concatenate([self._tail_volume, volume])
+            carried = len(self._tail_volume)
+            result[f'VWAP{self.window}'] = self._rolling_ratio(window_price_volume, window_volume)[carried:]
+            self._tail_price_volume = window_price_volume[-(self.window - 1):] if self.window > 1 else np.zeros(0)
+            self._tail_volume = window_volume[-(self.window - 1):] if self.window > 1 else np.zeros(0)
+        return(result)
+
+    def _rolling_ratio(self, price_volume, volume):
+        # sums over the last window bars (fewer at the very start), from one cumulative sum each
+        sums = []
+        for values in (price_volume, volume):
+            totals = np.concatenate([[0.0], np.cumsum(values)])
+            lagged = np.concatenate([np.zeros(min(self.window, len(values))), totals[1:max(len(values) + 1 - self.window, 1)]])
+            sums.append(totals[1:] - lagged)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return(sums[0] / sums[1])
+
+
+def read_bar_chunks(fname, chunk_size = 1000000, timestamp_column = 'Datetime', fields = ('High', 'Low', 'Close', 'Volume')):
+    '''
+    minute bars of a csv or parquet file, chunk_size rows at a time, indexed by timestamp
+    parquet files are read by row batches with pyarrow, which is then required
+    '''
+    columns = [timestamp_column] + list(fields)
+    if fname.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(fname).iter_batches(batch_size = chunk_size, columns = columns):
+            chunk = batch.to_pandas()
+            yield(chunk.set_index(pd.DatetimeIndex(chunk.pop(timestamp_column))))
+    else:
+        for chunk in pd.read_csv(fname, chunksize = chunk_size, usecols = columns):
+            yield(chunk.set_index(pd.DatetimeIndex(chunk.pop(timestamp_column))))
+
+
+def iter_file_vwap(fname, session = True, window = None, chunk_size = 1000000, timestamp_column = 'Datetime'):
+    '''
+    stream the VWAP of a large intraday file, one data frame per chunk (see ChunkedVWAP)
+    '''
+    vwap = ChunkedVWAP(session, window)
+    for chunk in read_bar_chunks(fname, chunk_size, timestamp_column):
+        yield(vwap.update(chunk))
+
+
+def write_file_vwap(fname, output_fname, session = True, window = None, chunk_size = 1000000,
+                    timestamp_column = 'Datetime'):
+    '''
+    write the VWAP of every bar of fname to the csv output_fname, chunk by chunk
+    '''
+    header = True
+    for result in iter_file_vwap(fname, session, window, chunk_size, timestamp_column):
+        result.to_csv(output_fname, mode = 'w' if header else 'a', header = header, index_label = timestamp_column)
+        header = False
+
+
+
+def _random_bars(n, start = '2021-11-01 09:30', freq = 'min', seed = 0):
+    rng = np.random.default_rng(seed)
+    index = pd.date_range(start, periods = n, freq = freq)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.001, n)))
+    return(pd.DataFrame({'High': close * 1.001, 'Low': close * 0.999, 'Open': close, 'Close': close,
+                         'Adj Close': close, 'Volume': rng.integers(100, 10000, n).astype(float)}, index = index))
+
+
+def _example(n_seed = 500, n_live = 1500):
+    from TA import SimpleMovingAverages, ExponentialMovingAverages, RSI, VWAP
+
+    bars = _random_bars(n_seed + n_live)
+    history, live = bars.iloc[:n_seed], bars.iloc[n_seed:]
+
+    smas = SimpleMovingAverages(history, [20])
+    emas = ExponentialMovingAverages(history, [10])
+    rsi = RSI(history, 14)
+    vwap = VWAP(history)
+    for indicator in (smas, emas, rsi, vwap):
+        indicator.run()
+
+    sma = StreamingSMA.from_prices(history['Close'], 20)
+    ema = StreamingEMA.from_batch(emas.get_series(10), 10)
+    streaming_rsi = StreamingRSI.from_batch(rsi)
+    streaming_vwap = StreamingVWAP.from_batch(vwap)
+    session_vwap = StreamingVWAP.from_bars(history, session = True)
+    values = []
+    for timestamp, high, low, close, adj_close, volume in zip(live.index, live['High'], live['Low'], live['Close'],
+                                                             live['Adj Close'], live['Volume']):
+        values.append((sma.update(close), ema.update(close), streaming_rsi.update(adj_close),
+                       streaming_vwap.update(high, low, close, volume),
+                       session_vwap.update(high, low, close, volume, timestamp)))
+    values = np.array(values)
+
+    # the batch classes over the whole series
+    smas, emas, rsi, vwap = SimpleMovingAverages(bars, [20]), ExponentialMovingAverages(bars, [10]), RSI(bars), VWAP(bars)
+    for indicator in (smas, emas, rsi, vwap):
+        indicator.run()
+    typical_volume = bars['Volume'] * (bars['High'] + bars['Low'] + bars['Close']) / 3
+    day = bars.index.date
+    session = typical_volume.groupby(day).cumsum() / bars['Volume'].groupby(day).cumsum()
+    for k, expected in enumerate([smas.get_series(20), emas.get_series(10), rsi.get_series().reindex(bars.index),
+                                    vwap.get_series(), session]):
+        assert(np.allclose(values[:, k], expected.iloc[n_seed:].values, rtol = 1e-10))
+    print(f"streaming SMA, EMA, RSI, VWAP and session VWAP match the batch classes over {n_live} bars")
+
+
+def _example_chunked_vwap(n_bars = 1000000, chunk_size = 100000):
+    import os
+    import time
+    import tempfile
+    import tracemalloc
+
+    with tempfile.TemporaryDirectory() as path:
+        fname = os.path.join(path, "bars.csv")
+        bars = _random_bars(n_bars)
+        bars.to_csv(fname, index_label = 'Datetime')
+
+        # whole frame at once, the reference
+        day = bars.index.date
+        typical_volume = bars['Volume'] * (bars['High'] + bars['Low'] + bars['Close']) / 3
+        session = (typical_volume.groupby(day).cumsum() / bars['Volume'].groupby(day).cumsum()).values
+        rolling = (typical_volume.rolling(390, min_periods = 1).sum() /
+                   bars['Volume'].rolling(390, min_periods = 1).sum()).values
+        del bars, typical_volume
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        results = []
+        for result in iter_file_vwap(fname, window = 390, chunk_size = chunk_size):
+            results.append(result.values)
+        t_stream = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results = np.concatenate(results)
+        assert(np.allclose(results[:, 0], session, rtol = 1e-10))
+        assert(np.allclose(results[:, 1], rolling, rtol = 1e-10))
+        print(f"session and 390 bar VWAP of {n_bars} bars in {t_stream:.2f}s, "
+              f"traced peak {peak / 2**20:.0f}MB (with the {results.nbytes / 2**20:.0f}MB kept for the check)")
+
+
+def _example_local_sessions():
+    # New York evening bars cross midnight UTC: sessions follow the local date
+    bars = _random_bars(3000, start = '2021-11-10 16:00', freq = '5min')
+    bars.index = bars.index.tz_localize('America/New_York')
+    vwap = ChunkedVWAP()
+    chunked = pd.concat([vwap.update(bars.iloc[i:i + 700]) for i in range(0, len(bars), 700)])['VWAP']
+    streaming = StreamingVWAP(session = True)
+    expected = [streaming.update(*row, timestamp = t)
+                for t, row in zip(bars.index, bars[['High', 'Low', 'Close', 'Volume']].values)]
+    assert(np.allclose(chunked.values, expected, rtol = 1e-12))
+
+
+def _example_short_first_chunk():
+    # a first chunk shorter than the window, then chunks of any size
+    bars = _random_bars(1000)
+    typical_volume = bars['Volume'] * (bars['High'] + bars['Low'] + bars['Close']) / 3
+    rolling = (typical_volume.rolling(390, min_periods = 1).sum() /
+               bars['Volume'].rolling(390, min_periods = 1).sum()).values
+    vwap = ChunkedVWAP(window = 390)
+    bounds = [0, 250, 260, 700, 1000]
+    chunked = pd.concat([vwap.update(bars.iloc[lo:hi]) for lo, hi in zip(bounds[:-1], bounds[1:])])['VWAP390']
+    assert(np.allclose(chunked.values, rolling, rtol = 1e-12))
+
+
+def _test():
+    _example()
+    _example_local_sessions()
+    _example_short_first_chunk()
+    _example_chunked_vwap()
+
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,142 @@
+import time
+import numpy as np
+import pandas as pd
+
+from TA import calc_smas, calc_rsi, decay_filter
+
+
+def _as_panel(values):
+    '''
+    (float64 array, wrap) for a 2D array or a wide data frame, wrap turning a 2D result
+    back into the type of values
+    '''
+    if isinstance(values, pd.DataFrame):
+        return(np.asarray(values.values, dtype = np.float64),
+               lambda result: pd.DataFrame(result, index = values.index, columns = values.columns, copy = False))
+    return(np.asarray(values, dtype = np.float64), lambda result: result)
+
+
+def universe_sma(prices, period):
+    '''
+    simple moving average of every symbol of a (dates x symbols) array or wide data frame,
+    as SimpleMovingAverages: nan prices are skipped and the first windows are shorter
+    '''
+    return(universe_smas(prices, [period])[period])
+
+
+def universe_smas(prices, periods):
+    '''
+    {period: simple moving averages} of every symbol, all periods from one cumulative sum
+    '''
+    values, wrap = _as_panel(prices)
+    smas = calc_smas(values, periods)
+    return({period: wrap(np.ascontiguousarray(smas[..., k])) for k, period in enumerate(periods)})
+
+
+def universe_ema(prices, period):
+    '''
+    exponential moving average with span period of every symbol, as ExponentialMovingAverages
+    (pandas ewm(span = period).mean()): nan before a symbol's first price, and over a missing
+    price the previous value while the weights keep decaying
+    '''
+    values, wrap = _as_panel(prices)
+    decay = 1 - 2 / (period + 1)
+    valid = ~np.isnan(values)
+    weighted_sum = decay_filter(np.where(valid, values, 0.0), decay)
+    weight = decay_filter(valid.astype(np.float64), decay)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        np.divide(weighted_sum, weight, out = weighted_sum)
+    return(wrap(weighted_sum))
+
+
+def universe_rsi(prices, period = 14, smoothing = 'ema'):
+    '''
+    RSI of every symbol, see TA.calc_rsi; rows without a price change are nan
+    '''
+    values, wrap = _as_panel(prices)
+    return(wrap(calc_rsi(values, period, smoothing)))
+
+
+def universe_vwap(high, low, close, volume):
+    '''
+    cumulative VWAP of the typical price of every symbol, as TA.VWAP: the sums skip missing
+    bars and the VWAP is nan on them
+    '''
+    high_values, wrap = _as_panel(high)
+    low_values, close_values, volume_values = (_as_panel(values)[0] for values in (low, close, volume))
+    result = np.empty(high_values.shape)
+    # a few hundred symbols at a time, so the temporaries stay in cache
+    for start in range(0, high_values.shape[-1], 256):
+        block = (Ellipsis, slice(start, start + 256))
+        volume_block = volume_values[block]
+        price_volume = high_values[block] + low_values[block]
+        price_volume += close_values[block]
+        price_volume *= volume_block
+        price_volume /= 3
+        missing = np.isnan(price_volume)
+        price_volume[missing] = 0.0
+        cum_volume = np.where(missing, 0.0, volume_block)
+        np.cumsum(price_volume, axis = 0, out = price_volume)
+        np.cumsum(cum_volume, axis = 0, out = cum_volume)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            np.divide(price_volume, cum_volume, out = result[block])
+        result[block][missing] = np.nan
+    return(wrap(result))
+
+
+def _random_universe(n_dates, n_symbols, seed = 0):
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, (n_dates, n_symbols)), axis = 0))
+    # ragged listing histories and a few missing days
+    listed = rng.integers(0, n_dates // 2, n_symbols)
+    close[np.arange(n_dates)[:, np.newaxis] < listed] = np.nan
+    close[rng.integers(0, n_dates, n_symbols // 10), rng.integers(0, n_symbols, n_symbols // 10)] = np.nan
+    volume = np.where(np.isnan(close), np.nan, rng.integers(1e5, 1e7, (n_dates, n_symbols)))
+    index = pd.bdate_range('2002-01-01', periods = n_dates, name = 'Date')
+    return({field: pd.DataFrame(values, index = index, columns = [f"S{j:04d}" for j in range(n_symbols)])
+            for field, values in [('High', close * 1.01), ('Low', close * 0.99), ('Close', close),
+                                  ('Adj Close', close), ('Volume', volume)]})
+
+
+def _report_indicators(panel):
+    smas = universe_smas(panel['Close'], [20, 50, 200])
+    return([universe_rsi(panel['Adj Close']), universe_ema(panel['Close'], 10), smas[20], smas[50], smas[200],
+            universe_vwap(panel['High'], panel['Low'], panel['Close'], panel['Volume'])])
+
+
+def _benchmark(n_dates = 500, n_symbols = 5000, n_loop = 50):
+    from TA import SimpleMovingAverages, ExponentialMovingAverages, RSI, VWAP
+
+    panel = _random_universe(n_dates, n_symbols)
+
+    start = time.perf_counter()
+    results = _report_indicators(panel)
+    t_universe = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = {}
+    for symbol in panel['Close'].columns[:n_loop]:
+        df = pd.DataFrame({field: frame[symbol] for field, frame in panel.items()})
+        smas, emas, rsi, vwap = SimpleMovingAverages(df, [20, 50, 200]), ExponentialMovingAverages(df, [10]), \
+                                RSI(df), VWAP(df)
+        for indicator in (smas, emas, rsi, vwap):
+            indicator.run()
+        expected[symbol] = [rsi.get_series(), emas.get_series(10), smas.get_series(20), smas.get_series(50),
+                            smas.get_series(200), vwap.get_series()]
+    t_loop = time.perf_counter() - start
+
+    for symbol, series_list in expected.items():
+        for result, series in zip(results, series_list):
+            assert(np.allclose(result.loc[series.index, symbol], series, rtol = 1e-9, equal_nan = True))
+
+    print(f"report indicators, {n_dates} days: {n_symbols} symbols at once {t_universe:.2f}s, "
+          f"{n_loop} symbols one by one {t_loop:.2f}s, "
+          f"{(t_loop / n_loop) / (t_universe / n_symbols):.0f}x faster per symbol")
+
+
+def _test():
+    _benchmark()
+
+
+if __name__ == "__main__":
+    _test()
@@ -1,9 +1,14 @@
+from root_finding import RootFindingError
+
+
 def bisection(f, x_L, x_R, eps, return_x_list=False):
+    '''
+    scalar bisection, see root_finding for the vectorized solvers
+    raises RootFindingError when the interval does not bracket a root
+    '''
     f_L = f(x_L)
     if f_L*f(x_R) > 0:
-        print ("Error! Function does not have opposite \
-                 signs at interval endpoints!")
-        sys.exit(1)
+        raise RootFindingError("Function does not have opposite signs at interval endpoints!")
     x_M = float(x_L + x_R)/2.0
     f_M = f(x_M)
     iteration_counter = 1
@@ -7,12 +7,30 @@ import enum
 import calendar
 
 from datetime import date
+from functools import lru_cache
 
 class DayCount(enum.Enum):
     DAYCOUNT_30360 = "30/360"
     DAYCOUNT_ACTUAL_360 = "Actual/360"
     DAYCOUNT_ACTUAL_ACTUAL = "Actual/Actual"
 
+    def year_fraction(self, start, end):
+        '''
+        year fraction from start to end under this day count
+        start and end are dates or arrays of dates / datetime64 and are broadcast together
+        returns a float64 array, nan where either date is NaT
+        '''
+        start = np.asarray(start).astype('datetime64[D]')
+        end = np.asarray(end).astype('datetime64[D]')
+        if self == DayCount.DAYCOUNT_30360:
+            return(get_30360_daycount_frac_array(start, end))
+        elif self == DayCount.DAYCOUNT_ACTUAL_360:
+            return(get_actual360_daycount_frac_array(start, end))
+        elif self == DayCount.DAYCOUNT_ACTUAL_ACTUAL:
+            return(get_actualactual_daycount_frac_array(start, end))
+        else:
+            raise Exception("Unsupported day count")
+
 class PaymentFrequency(enum.Enum):
     ANNUAL     = "Annual"
     SEMIANNUAL = "Semi-annual"
@@ -21,12 +39,216 @@ class PaymentFrequency(enum.Enum):
     CONTINUOUS = "Continuous"
 
 
+def get_actual360_daycount_frac(start, end):
+    day_in_year = 360
+    day_count = (end - start).days
+    return(day_count / day_in_year)
+
+def get_30360_daycount_frac(start, end):
+    day_in_year = 360
+    day_count = 360*(end.year - start.year) + 30*(end.month - start.month - 1) + \
+                max(0, 30 - start.day) + min(30, end.day)
+    return(day_count / day_in_year )
+    
+
+def _days_in_year(year):
+    return((date(year, 12, 31) - date(year, 1, 1)).days + 1)
+
+def get_actualactual_daycount_frac(start, end):
+    '''
+    days in each calendar year are divided by the number of days in that year,
+    so a period spanning a year end is split at January 1st
+    '''
+    if start.year == end.year:
+        return((end - start).days / _days_in_year(start.year))
+
+    first_year = (date(start.year + 1, 1, 1) - start).days / _days_in_year(start.year)
+    last_year = (end - date(end.year, 1, 1)).days / _days_in_year(end.year)
+    result = first_year + (end.year - start.year - 1) + last_year
+    return(result)
+
+
+# array versions of the day count functions above, operating elementwise on datetime64[D]
+# arrays with numpy broadcasting. NaT in either date gives nan
+
+def _civil_from_days(dates):
+    # integer year, month and day of a datetime64[D] array from its day number
+    z = dates.astype(np.int64) + 719468
+    era = z // 146097
+    day_of_era = z - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    shifted_month = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * shifted_month + 2) // 5 + 1
+    month = np.where(shifted_month < 10, shifted_month + 3, shifted_month - 9)
+    year = year_of_era + era * 400 + (month <= 2)
+    return(year, month, day)
+
+_CALENDAR_START = np.datetime64('1900-01-01')
+_CALENDAR_END = np.datetime64('2200-01-01')
+
+@lru_cache(maxsize = 1)
+def _calendar_table():
+    # year, month and day of every date in [_CALENDAR_START, _CALENDAR_END)
+    return(np.stack(_civil_from_days(np.arange(_CALENDAR_START, _CALENDAR_END))))
+
+def _year_month_day(dates):
+    # split a datetime64[D] array into integer year, month and day arrays
+    # dates inside the calendar table are a single lookup, others are computed
+    offsets = np.where(np.isnat(dates), 0, (dates - _CALENDAR_START).astype(np.int64))
+    if offsets.size == 0 or offsets.min() < 0 or offsets.max() >= (_CALENDAR_END - _CALENDAR_START).astype(np.int64):
+        return(_civil_from_days(dates))
+    year, month, day = _calendar_table()[:, offsets]
+    return(year, month, day)
+
+def _mask_nat(result, start, end):
+    return(np.where(np.isnat(start) | np.isnat(end), np.nan, result))
+
+def get_actual360_daycount_frac_array(start, end):
+    day_in_year = 360
+    day_count = (end - start).astype(np.int64)
+    return(_mask_nat(day_count / day_in_year, start, end))
+
+def get_30360_daycount_frac_array(start, end):
+    day_in_year = 360
+    start_year, start_month, start_day = _year_month_day(start)
+    end_year, end_month, end_day = _year_month_day(end)
+    day_count = 360*(end_year - start_year) + 30*(end_month - start_month - 1) + \
+                np.maximum(0, 30 - start_day) + np.minimum(30, end_day)
+    return(_mask_nat(day_count / day_in_year, start, end))
+
+def _first_day_of_year(year):
+    # day number (days since 1970-01-01) of January 1st of an integer year array
+    year = year - 1
+    era = year // 400
+    year_of_era = year - era * 400
+    return(era * 146097 + year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + 306 - 719468)
+
+def get_actualactual_daycount_frac_array(start, end):
+    start_days = start.astype(np.int64)
+    end_days = end.astype(np.int64)
+    start_year = _year_month_day(start)[0]
+    end_year = _year_month_day(end)[0]
+    start_of_start_year = _first_day_of_year(start_year)
+    start_of_next_year = _first_day_of_year(start_year + 1)
+    start_of_end_year = _first_day_of_year(end_year)
+    days_in_start_year = start_of_next_year - start_of_start_year
+    days_in_end_year = _first_day_of_year(end_year + 1) - start_of_end_year
+
+    same_year = (end_days - start_days) / days_in_start_year
+    first_year = (start_of_next_year - start_days) / days_in_start_year
+    last_year = (end_days - start_of_end_year) / days_in_end_year
+    spanning = first_year + (end_year - start_year - 1) + last_year
+    result = np.where(start_year == end_year, same_year, spanning)
+    return(_mask_nat(result, start, end))
+
+
+SCHEDULE_CACHE_SIZE = 4096
+
+
+class BondSchedule(object):
+    '''
+    Immutable cash flow schedule shared by all the bonds with the same terms
+    payment_dates is a datetime64[D] array, payment_times_in_year and coupon_payment are float64 arrays
+    '''
+    __slots__ = ('maturity_date', 'payment_dates', 'payment_times_in_year', 'coupon_payment')
+
+    def __init__(self, maturity_date, payment_dates, payment_times_in_year, coupon_payment):
+        self.maturity_date = maturity_date
+        self.payment_dates = payment_dates
+        self.payment_times_in_year = payment_times_in_year
+        self.coupon_payment = coupon_payment
+        for values in (payment_dates, payment_times_in_year, coupon_payment):
+            values.flags.writeable = False
+
+
+def _add_months(dt, n_months):
+    # helper method to add n_months to date dt
+    return(dt + relativedelta(months = n_months))
+
+
+@lru_cache(maxsize = SCHEDULE_CACHE_SIZE)
+def _build_schedule(issue_date, term, payment_freq, coupon, principal):
+    '''
+    build the BondSchedule for the given terms, least recently used schedules are evicted
+    '''
+    # calculate maturity date
+    maturity_date = _add_months(issue_date, 12 * term)
+
+    # calculate all the payment dates
+    payment_dates = []
+    dt = issue_date
+    while dt < maturity_date:
+        if payment_freq == PaymentFrequency.ANNUAL:
+            next_dt = _add_months(dt, 12)
+        elif payment_freq == PaymentFrequency.SEMIANNUAL:
+            next_dt = _add_months(dt, 6)
+        elif payment_freq == PaymentFrequency.QUARTERLY:
+            next_dt = _add_months(dt, 4)
+        elif payment_freq == PaymentFrequency.MONTHLY:
+            next_dt = _add_months(dt, 1)
+        else:
+            raise Exception("Unsupported Payment frequency")
+
+        if next_dt <= maturity_date:
+            payment_dates.append(next_dt)
+
+        dt = next_dt
+
+    # calculate the future cashflow vectors
+    if payment_freq == PaymentFrequency.ANNUAL:
+        coupon_cf = principal * coupon
+    elif payment_freq == PaymentFrequency.SEMIANNUAL:
+        coupon_cf = principal * coupon / 2
+    elif payment_freq == PaymentFrequency.QUARTERLY:
+        coupon_cf = principal * coupon / 4
+    elif payment_freq == PaymentFrequency.MONTHLY:
+        coupon_cf = principal * coupon / 12
+    else:
+        raise Exception("Unsupported Payment frequency")
+
+    coupon_payment = np.full(len(payment_dates), coupon_cf, dtype = np.float64)
+
+    # calculate payment_time in years
+    if payment_freq == PaymentFrequency.ANNUAL:
+        period = 1
+    elif payment_freq == PaymentFrequency.SEMIANNUAL:
+        period = 1/2
+    elif payment_freq == PaymentFrequency.QUARTERLY:
+        period = 1/4
+    elif payment_freq == PaymentFrequency.MONTHLY:
+        period = 1/12
+    else:
+        raise Exception("Unsupported Payment frequency")
+
+    payment_times_in_year = np.array([period * (i+1) for i in range(len(payment_dates))], dtype = np.float64)
+
+    return(BondSchedule(maturity_date, np.array(payment_dates, dtype = 'datetime64[D]'),
+                        payment_times_in_year, coupon_payment))
+
+
+def schedule_cache_info():
+    '''
+    hits, misses and size of the bond schedule cache
+    '''
+    return(_build_schedule.cache_info())
+
+
+def clear_schedule_cache():
+    _build_schedule.cache_clear()
+
+
 class Bond(object):
     '''
     term is maturity term in years
     coupon is the coupon in fraction (decimal) eg 5% should be expressed as 0.05
     maturity date will be issue_date + term
+
+    the payment schedule is looked up in a cache shared by all bonds with the same
+    issue_date, term, payment_freq, coupon and principal, so it must not be modified
     '''
+    __slots__ = ('issue_date', 'term', 'day_count', 'payment_freq', 'coupon', 'principal', '_schedule')
+
     def __init__(self, issue_date, term, day_count, payment_freq, coupon, principal = 100):
         self.issue_date = issue_date
         self.term = term
@@ -34,84 +256,38 @@ class Bond(object):
         self.payment_freq = payment_freq
         self.coupon = coupon
         self.principal = principal
-        # internal data structures
-        self.payment_times_in_year = []
-        self.payment_dates = []
-        self.coupon_payment = []
         self._calc()
 
-    def _add_months(self, dt, n_months):
-        # helper method to add n_months to date dt
-        return(dt + relativedelta(months = n_months))
-
     def _calc(self):
-        # calculate maturity date
-        self.maturity_date = self._add_months(self.issue_date, 12 * self.term)
-
-        # calculate all the payment dates
-        dt = self.issue_date
-        while dt < self.maturity_date:
-            if self.payment_freq == PaymentFrequency.ANNUAL:
-                next_dt = self._add_months(dt, 12)
-            elif self.payment_freq == PaymentFrequency.SEMIANNUAL:
-                next_dt = self._add_months(dt, 6)
-            elif self.payment_freq == PaymentFrequency.QUARTERLY:
-                next_dt = self._add_months(dt, 4)
-            elif self.payment_freq == PaymentFrequency.MONTHLY:
-                next_dt = self._add_months(dt, 1)
-            else:
-                raise Exception("Unsupported Payment frequency")
-                
-            if next_dt <= self.maturity_date:
-                self.payment_dates.append(next_dt)
-                
-            dt = next_dt
-
-        # calculate the future cashflow vectors
-        if self.payment_freq == PaymentFrequency.ANNUAL:
-            coupon_cf = self.principal * self.coupon 
-        elif self.payment_freq == PaymentFrequency.SEMIANNUAL:
-            coupon_cf = self.principal * self.coupon / 2
-        elif self.payment_freq == PaymentFrequency.QUARTERLY:
-            coupon_cf = self.principal * self.coupon / 4 
-        elif self.payment_freq == PaymentFrequency.MONTHLY:
-            coupon_cf = self.principal * self.coupon / 12 
-        else:
-            raise Exception("Unsupported Payment frequency")
-            
-        self.coupon_payment = [ coupon_cf for i in range(len(self.payment_dates))]
-        
-        # calculate payment_time in years
-        if self.payment_freq == PaymentFrequency.ANNUAL:
-            period = 1
-        elif self.payment_freq == PaymentFrequency.SEMIANNUAL:
-            period = 1/2
-        elif self.payment_freq == PaymentFrequency.QUARTERLY:
-            period = 1/4
-        elif self.payment_freq == PaymentFrequency.MONTHLY:
-            period = 1/12
-        else:
-            raise Exception("Unsupported Payment frequency")
+        self._schedule = _build_schedule(self.issue_date, self.term, self.payment_freq,
+                                         self.coupon, self.principal)
+
+    @property
+    def maturity_date(self):
+        return(self._schedule.maturity_date)
+
+    @property
+    def payment_dates(self):
+        return(self._schedule.payment_dates)
+
+    @property
+    def payment_times_in_year(self):
+        return(self._schedule.payment_times_in_year)
 
-        self.payment_times_in_year = [ period * (i+1) for i in range(len(self.payment_dates))]
+    @property
+    def coupon_payment(self):
+        return(self._schedule.coupon_payment)
 
     def get_next_payment_date(self, as_of_date):
         '''
         return the next payment date after as_of_date
         '''
         if as_of_date <= self.issue_date:
-            return(self.payment_dates[0])
-        elif as_of_date > self.payment_dates[-1]:
-            return(None)
-        else:
-            i = 0
-            while i < len(self.payment_dates):
-                dt = self.payment_dates[i]
-                if as_of_date <= dt:
-                    return(dt)
-                else:
-                    i += 1
+            return(self.payment_dates[0].item())
+        i = np.searchsorted(self.payment_dates, np.datetime64(as_of_date, 'D'), side = 'left')
+        if i == len(self.payment_dates):
             return(None)
+        return(self.payment_dates[i].item())
 
     def get_previous_payment_date(self, as_of_date):
         '''
@@ -120,17 +296,46 @@ class Bond(object):
         '''
         if as_of_date < self.issue_date:
             return(None)
-        elif as_of_date < self.payment_dates[0]:
+        elif as_of_date < self.payment_dates[0].item():
             return(self.issue_date)
-        else:
-            i = 1
-            while i < len(self.payment_dates):
-                dt = self.payment_dates[i]
-                if as_of_date <= dt:
-                    return(self.payment_dates[i-1])
-                else:
-                    i += 1
+        # first payment date on or after as_of_date, searching from the second one
+        i = max(np.searchsorted(self.payment_dates, np.datetime64(as_of_date, 'D'), side = 'left'), 1)
+        if i == len(self.payment_dates):
             return(None)
+        return(self.payment_dates[i-1].item())
+
+    def get_next_payment_dates(self, as_of_dates):
+        '''
+        vectorized get_next_payment_date, returns a datetime64[D] array with NaT instead of None
+        '''
+        as_of_dates = to_datetime64(as_of_dates)
+        payment_dates = self.payment_dates
+        i = np.searchsorted(payment_dates, as_of_dates, side = 'left')
+        i[as_of_dates <= np.datetime64(self.issue_date, 'D')] = 0
+        result = payment_dates[np.minimum(i, len(payment_dates) - 1)]
+        result[i == len(payment_dates)] = np.datetime64('NaT')
+        return(result)
+
+    def get_previous_payment_dates(self, as_of_dates):
+        '''
+        vectorized get_previous_payment_date, returns a datetime64[D] array with NaT instead of None
+        '''
+        as_of_dates = to_datetime64(as_of_dates)
+        payment_dates = self.payment_dates
+        issue_date = np.datetime64(self.issue_date, 'D')
+        i = np.maximum(np.searchsorted(payment_dates, as_of_dates, side = 'left'), 1)
+        result = payment_dates[np.minimum(i, len(payment_dates)) - 1]
+        result[i == len(payment_dates)] = np.datetime64('NaT')
+        result[as_of_dates < payment_dates[0]] = issue_date
+        result[as_of_dates < issue_date] = np.datetime64('NaT')
+        return(result)
+
+
+def to_datetime64(dates):
+    '''
+    convert a date, a list of dates or a datetime array to a 1-d datetime64[D] array
+    '''
+    return(np.atleast_1d(np.asarray(dates)).astype('datetime64[D]'))
 
 
 def _example2():
@@ -160,10 +365,71 @@ def _example3():
     print("Payment time in year:", bond.payment_times_in_year)
 
     
+def _benchmark(n = 1000000):
+    '''
+    construction time and memory of a book of n bonds drawn from a few thousand distinct terms
+    '''
+    import time
+    import tracemalloc
+
+    clear_schedule_cache()
+    tracemalloc.start()
+    start = time.perf_counter()
+    bonds = [Bond(date(2021, 1 + i % 12, 1 + i % 28), term = 1 + i % 30, day_count = DayCount.DAYCOUNT_30360,
+                  payment_freq = PaymentFrequency.SEMIANNUAL, coupon = 0.0025 * (i % 40))
+             for i in range(n)]
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{n} bonds built in {elapsed:.2f}s, {current / n:.0f} bytes per bond, peak {peak / 1e6:.0f}MB")
+    print(schedule_cache_info())
+
+
+def _example_daycount():
+    starts = [date(2020, 1, 31), date(2020, 2, 29), date(2020, 12, 15), date(2019, 7, 1)]
+    ends = [date(2020, 7, 31), date(2020, 8, 31), date(2021, 1, 15), date(2022, 3, 1)]
+    for day_count, scalar in [(DayCount.DAYCOUNT_30360, get_30360_daycount_frac),
+                              (DayCount.DAYCOUNT_ACTUAL_360, get_actual360_daycount_frac),
+                              (DayCount.DAYCOUNT_ACTUAL_ACTUAL, get_actualactual_daycount_frac)]:
+        fracs = day_count.year_fraction(starts, ends)
+        assert(list(fracs) == [scalar(start, end) for start, end in zip(starts, ends)])
+        print(day_count.value, fracs)
+
+
+def _benchmark_daycount(n = 1000000):
+    '''
+    array day count functions against the scalar ones on n date pairs
+    '''
+    import time
+
+    rng = np.random.default_rng(0)
+    start = np.datetime64('2000-01-01') + rng.integers(0, 9000, n)
+    end = start + rng.integers(0, 400, n)
+    start_dates, end_dates = start.tolist(), end.tolist()
+
+    for day_count, scalar in [(DayCount.DAYCOUNT_30360, get_30360_daycount_frac),
+                              (DayCount.DAYCOUNT_ACTUAL_360, get_actual360_daycount_frac),
+                              (DayCount.DAYCOUNT_ACTUAL_ACTUAL, get_actualactual_daycount_frac)]:
+        t = time.perf_counter()
+        fracs = day_count.year_fraction(start, end)
+        t_array = time.perf_counter() - t
+
+        t = time.perf_counter()
+        scalar_fracs = [scalar(s, e) for s, e in zip(start_dates, end_dates)]
+        t_scalar = time.perf_counter() - t
+
+        assert(np.array_equal(fracs, scalar_fracs))
+        print(f"{day_count.value:>13}: array {t_array:.3f}s, scalar {t_scalar:.3f}s, "
+              f"speedup {t_scalar / t_array:.0f}x")
+
+
 def _test():
     # unit test
     _example2()
     _example3()
+    _example_daycount()
+    #_benchmark()
+    #_benchmark_daycount()
 
 
 
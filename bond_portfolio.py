@@ -0,0 +1,132 @@
+import numpy as np
+
+from datetime import date
+
+from bond import Bond, DayCount, PaymentFrequency
+
+
+_PERIODS_PER_YEAR = {
+    PaymentFrequency.ANNUAL: 1.0,
+    PaymentFrequency.SEMIANNUAL: 2.0,
+    PaymentFrequency.QUARTERLY: 4.0,
+    PaymentFrequency.MONTHLY: 12.0,
+}
+
+
+def get_periods_per_year(payment_freq):
+    '''
+    number of coupon periods per year for a payment frequency
+    '''
+    if payment_freq not in _PERIODS_PER_YEAR:
+        raise Exception("Unsupported Payment frequency")
+    return(_PERIODS_PER_YEAR[payment_freq])
+
+
+class BondPortfolio(object):
+    '''
+    Padded cash-flow matrices for a list of bonds so that they can be priced in one numpy pass
+
+    cash_flows[i, j] is the j-th cash flow of bond i (coupon plus principal on the last one)
+    times[i, j] is the matching entry of bond.payment_times_in_year
+    columns past the last cash flow of a bond are zero padded
+
+    bonds with the same payment times (e.g. same frequency and term, whatever the issue date
+    or coupon) share a row of group_times, time_group[i] being the row used by the bond in
+    sorted row i.
+    Curve pricing evaluates the curve on group_times only and gathers the result.
+
+    rows are kept sorted by number of cash flows (longest first) and the matrices are stored
+    column major, so column j of the first active_rows[j] bonds is one contiguous slice.
+    Inputs and outputs of the public methods are always in the original bond order.
+    '''
+    def __init__(self, bonds):
+        self.bonds = list(bonds)
+        n_bonds = len(self.bonds)
+
+        self.n_periods = np.fromiter((len(b.coupon_payment) for b in self.bonds), dtype = np.int64, count = n_bonds)
+        if n_bonds > 0 and self.n_periods.min() == 0:
+            raise Exception("Bond without any cash flow")
+        self.principal = np.fromiter((b.principal for b in self.bonds), dtype = np.float64, count = n_bonds)
+        self.periods_per_year = np.fromiter((get_periods_per_year(b.payment_freq) for b in self.bonds),
+                                            dtype = np.float64, count = n_bonds)
+        self._build_matrices()
+
+    def __len__(self):
+        return(len(self.bonds))
+
+    def _build_matrices(self):
+        n_bonds = len(self.bonds)
+        n_cols = int(self.n_periods.max()) if n_bonds > 0 else 0
+        total = int(self.n_periods.sum())
+
+        # longest bonds first, so each column only touches a prefix of the rows
+        self._order = np.argsort(-self.n_periods, kind = 'stable')
+        self._rank = np.empty(n_bonds, dtype = np.int64)
+        self._rank[self._order] = np.arange(n_bonds)
+        counts = np.bincount(self.n_periods, minlength = n_cols + 1)
+        self.active_rows = n_bonds - np.cumsum(counts)[:n_cols]
+
+        # scatter the ragged cash flow lists into the padded matrices
+        starts = np.cumsum(self.n_periods) - self.n_periods
+        rows = np.repeat(self._rank, self.n_periods)
+        cols = np.arange(total) - np.repeat(starts, self.n_periods)
+
+        coupons = np.concatenate([b.coupon_payment for b in self.bonds]) if n_bonds > 0 else np.zeros(0)
+        times = np.concatenate([b.payment_times_in_year for b in self.bonds]) if n_bonds > 0 else np.zeros(0)
+
+        self.cash_flows = np.zeros((n_bonds, n_cols), order = 'F')
+        self.cash_flows[rows, cols] = coupons
+        self.cash_flows[self._rank, self.n_periods - 1] += self.principal
+
+        self.times = np.zeros((n_bonds, n_cols), order = 'F')
+        self.times[rows, cols] = times
+
+        # distinct padded time rows, whatever schedule objects the bonds hold. Payment times
+        # are set by the frequency and number of periods, so group on those first and only
+        # fall back to comparing whole rows if a bond's times differ from its group's
+        key = self.n_periods[self._order] * 1000.0 + self.periods_per_year[self._order]
+        _, first, group = np.unique(key, return_index = True, return_inverse = True)
+        group = group.ravel()
+        group_times = self.times[first]
+        if not all((self.times[:, j] == group_times[group, j]).all() for j in range(n_cols)):
+            group_times, group = np.unique(np.ascontiguousarray(self.times), axis = 0, return_inverse = True)
+            group = group.ravel()
+        self.group_times = np.ascontiguousarray(group_times)
+        self.time_group = group
+
+    def to_sorted(self, values):
+        '''
+        broadcast a scalar or per-bond vector to the internal (sorted) row order
+        '''
+        values = np.asarray(values, dtype = np.float64)
+        if values.ndim == 0:
+            return(np.full(len(self.bonds), float(values)))
+        if values.shape != (len(self.bonds),):
+            raise Exception("Expected one value per bond")
+        return(values[self._order])
+
+    def from_sorted(self, values):
+        '''
+        map a vector in the internal row order back to the original bond order
+        '''
+        return(values[self._rank])
+
+
+def _example():
+    issue_date = date(2021, 1, 1)
+    bonds = [Bond(issue_date, term = 2, day_count = DayCount.DAYCOUNT_30360,
+                  payment_freq = PaymentFrequency.SEMIANNUAL, coupon = 0.08),
+             Bond(issue_date, term = 10, day_count = DayCount.DAYCOUNT_30360,
+                  payment_freq = PaymentFrequency.ANNUAL, coupon = 0.05, principal = 1000)]
+    portfolio = BondPortfolio(bonds)
+    print("Number of cash flows:", portfolio.n_periods)
+    print("Cash flows (sorted rows):")
+    print(portfolio.cash_flows)
+
+
+def _test():
+    _example()
+
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,197 @@
+import os
+import csv
+import json
+import hashlib
+
+
+class CheckpointedOutput(object):
+    '''
+    CSV output written one row at a time, resumable after a crash
+
+    rows are appended to fname as they are written; every flush_every rows the file is
+    flushed to disk and the checkpoint (fname + '.checkpoint.json') records the symbols
+    completed with a hash of their inputs. Opening the output again with the same run_key
+    (e.g. the as-of date and indicator list) keeps the rows of the completed symbols, so
+    done(symbol, inputs) tells which symbols can be skipped; rows written after the last
+    checkpoint, partial lines included, are dropped and redone. The row of a symbol whose
+    inputs changed is stale: close() rewrites the file without it, keeping the new row when
+    the symbol was written again. With another run_key the output starts over.
+    '''
+    def __init__(self, fname, columns, run_key, flush_every = 25):
+        self.fname = fname
+        self.checkpoint_fname = fname + '.checkpoint.json'
+        self.columns = list(columns)
+        self.run_key = run_key
+        self.flush_every = flush_every
+        self._done = {}
+        self._rows = 0
+        self._pending = 0
+        self._stale = set()
+        self._file = None
+        self._writer = None
+
+    @staticmethod
+    def input_key(inputs):
+        return(hashlib.sha1(json.dumps(inputs, sort_keys = True, default = str).encode()).hexdigest())
+
+    def _read_checkpoint(self):
+        if not os.path.exists(self.checkpoint_fname) or not os.path.exists(self.fname):
+            return({}, 0)
+        with open(self.checkpoint_fname) as f:
+            checkpoint = json.load(f)
+        if checkpoint['run_key'] != json.loads(json.dumps(self.run_key, default = str)):
+            return({}, 0)
+        return(checkpoint['done'], checkpoint['rows'])
+
+    def _rewrite(self):
+        # keep the rows written up to the last checkpoint, the last one of each symbol done
+        done, n_rows = self._read_checkpoint()
+        rows = {}
+        if done:
+            with open(self.fname, newline = '') as f:
+                reader = csv.reader(f)
+                if next(reader, None) == self.columns:
+                    for row, _ in zip(reader, range(n_rows)):
+                        if row:
+                            rows[row[0]] = row
+        done = {symbol: done[symbol] for symbol in rows if symbol in done}
+        rows = [row for symbol, row in rows.items() if symbol in done]
+
+        # rewrite the kept rows atomically
+        tmp_fname = self.fname + '.tmp'
+        with open(tmp_fname, 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.columns)
+            writer.writerows(rows)
+        os.replace(tmp_fname, self.fname)
+        self._done = done
+        self._rows = len(rows)
+        self._stale = set()
+        self._write_checkpoint()
+
+    def open(self):
+        '''
+        keep the rows written up to the last checkpoint, the last one of each symbol, and
+        reopen for appending
+        '''
+        self._rewrite()
+        self._file = open(self.fname, 'a', newline = '')
+        self._writer = csv.writer(self._file)
+        return(self)
+
+    def done(self, symbol, inputs):
+        '''
+        True when symbol was completed with the same inputs; a row written with other inputs
+        is stale from then on, and dropped by close() if the symbol is not written again
+        '''
+        key = self.input_key(inputs)
+        if symbol in self._done and self._done[symbol] != key:
+            del self._done[symbol]
+            self._stale.add(symbol)
+        return(self._done.get(symbol) == key)
+
+    def write(self, symbol, inputs, row):
+        '''
+        append the row of symbol (its first value is the symbol)
+        '''
+        if len(row) != len(self.columns):
+            raise Exception(f"Expected {len(self.columns)} values for {symbol}, got {len(row)}")
+        if symbol in self._done:
+            self._stale.add(symbol)
+        self._writer.writerow(row)
+        self._done[symbol] = self.input_key(inputs)
+        self._rows += 1
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        '''
+        rows to disk first, then the checkpoint that refers to them
+        '''
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._write_checkpoint()
+        self._pending = 0
+
+    def _write_checkpoint(self):
+        tmp_fname = self.checkpoint_fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump({'run_key': self.run_key, 'done': self._done, 'rows': self._rows}, f, default = str)
+        os.replace(tmp_fname, self.checkpoint_fname)
+
+    def close(self):
+        '''
+        flush and close; the file is rewritten only when it holds stale rows
+        '''
+        if self._file is not None:
+            self.flush()
+            self.close_file()
+            if self._stale:
+                self._rewrite()
+
+    def close_file(self):
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return(self.open())
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _example():
+    import tempfile
+    import pandas as pd
+
+    columns = ['Symbol', 'Growth', 'Value']
+    symbols = [f"S{i:03d}" for i in range(100)]
+    growth = {symbol: i / 100 for i, symbol in enumerate(symbols)}
+    run_key = {'as_of_date': '2021-12-01'}
+
+    def run(fname, growth, run_key, crash_at = None, failing = ()):
+        computed = []
+        with CheckpointedOutput(fname, columns, run_key, flush_every = 10) as output:
+            for i, symbol in enumerate(symbols):
+                if output.done(symbol, [growth[symbol]]):
+                    continue
+                if i == crash_at:
+                    # rows since the last checkpoint are lost with the process
+                    output._file.write("S999,0.5")
+                    output.close_file()
+                    return(computed)
+                computed.append(symbol)
+                if symbol in failing:
+                    continue
+                output.write(symbol, [growth[symbol]], [symbol, growth[symbol], 2 * growth[symbol]])
+        return(computed)
+
+    with tempfile.TemporaryDirectory() as path:
+        fname = os.path.join(path, "output.csv")
+        assert(run(fname, growth, run_key, crash_at = 57) == symbols[:57])
+        # resumes from the checkpoint at 50 rows
+        assert(run(fname, growth, run_key) == symbols[50:])
+        output_df = pd.read_csv(fname)
+        assert(sorted(output_df['Symbol']) == symbols and output_df['Symbol'].is_unique)
+
+        assert(run(fname, growth, run_key) == [])
+        changed = dict(growth, S010 = 0.5)
+        assert(run(fname, changed, run_key) == ['S010'])
+        output_df = pd.read_csv(fname)
+        assert(output_df.set_index('Symbol').loc['S010', 'Value'] == 1.0 and len(output_df) == len(symbols))
+        # a symbol whose recompute fails loses its stale row
+        changed = dict(changed, S011 = 0.5)
+        assert(run(fname, changed, run_key, failing = ['S011']) == ['S011'])
+        assert('S011' not in set(pd.read_csv(fname)['Symbol']))
+        assert(run(fname, changed, run_key) == ['S011'])
+        assert(run(fname, changed, {'as_of_date': '2022-01-03'}) == symbols)
+        print(f"resumed after a crash, {len(pd.read_csv(fname))} rows")
+
+
+def _test():
+    _example()
+
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,181 @@
+import time
+import random
+import threading
+
+from itertools import islice
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+FetchResult = namedtuple('FetchResult', ['symbol', 'value', 'error', 'attempts'])
+
+
+class TokenBucket(object):
+    '''
+    Rate limiter shared by threads: tokens refill at rate per second up to capacity (the
+    largest burst), acquire(tokens) blocks until that many are available and takes them;
+    more than capacity tokens are taken capacity at a time
+    '''
+    def __init__(self, rate, capacity = None):
+        if rate <= 0:
+            raise Exception("Token bucket rate must be positive")
+        self.rate = rate
+        self.capacity = max(rate, 1) if capacity is None else capacity
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens = 1):
+        while tokens > self.capacity:
+            self.acquire(self.capacity)
+            tokens -= self.capacity
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class FetchStage(object):
+    '''
+    Fetches the data of many symbols concurrently with fetch(symbol), in a pool of workers
+    threads (the calls are I/O bound)
+
+    every attempt first takes tokens_per_fetch tokens from rate_limiter (a TokenBucket, e.g.
+    one token per Yahoo request the fetch makes), tokens_per_fetch being a number or a
+    function of the symbol. Failed attempts raising one of retry_on
+    (by default network errors: OSError covers ConnectionError, TimeoutError and the requests
+    and urllib errors) are retried up to retries times, waiting backoff * 2**k seconds (capped
+    at max_backoff, with jitter so the workers do not retry in lockstep); other errors are
+    not retried. The error of a symbol is kept in its FetchResult and never stops the other
+    symbols. At most max_pending fetches (2 * workers by default) run or wait ahead of the
+    caller, so a slow consumer does not pile up fetched data.
+    '''
+    def __init__(self, fetch, workers = 8, rate_limiter = None, tokens_per_fetch = 1, retries = 3,
+                 backoff = 0.5, max_backoff = 30, retry_on = (OSError,), max_pending = None):
+        self.fetch = fetch
+        self.workers = workers
+        self.max_pending = 2 * workers if max_pending is None else max_pending
+        self.rate_limiter = rate_limiter
+        self.tokens_per_fetch = tokens_per_fetch
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_on = retry_on
+
+    def fetch_one(self, symbol):
+        '''
+        FetchResult of one symbol, after the retries
+        '''
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(self.tokens_per_fetch(symbol) if callable(self.tokens_per_fetch)
+                                          else self.tokens_per_fetch)
+            try:
+                return(FetchResult(symbol, self.fetch(symbol), None, attempt))
+            except self.retry_on as e:
+                if attempt > self.retries:
+                    return(FetchResult(symbol, None, e, attempt))
+                delay = min(self.backoff * 2**(attempt - 1), self.max_backoff)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+            except Exception as e:
+                return(FetchResult(symbol, None, e, attempt))
+
+    def run(self, symbols):
+        '''
+        iterator over the FetchResults in the order of symbols; results are yielded as soon as
+        they are in, so the caller's compute stage overlaps with the fetches still running.
+        Stopping early (break, or an exception in the caller) cancels the fetches not started.
+        '''
+        symbols = iter(symbols)
+        executor = ThreadPoolExecutor(self.workers)
+        try:
+            pending = deque(executor.submit(self.fetch_one, symbol) for symbol in islice(symbols, self.max_pending))
+            while pending:
+                result = pending.popleft().result()
+                for symbol in islice(symbols, 1):
+                    pending.append(executor.submit(self.fetch_one, symbol))
+                yield result
+        finally:
+            executor.shutdown(wait = False, cancel_futures = True)
+
+
+class _FakeSymbolProvider(object):
+    '''
+    local stand-in for Yahoo: every call sleeps latency seconds, fails with a ConnectionError
+    with probability failure_rate, and always fails for the symbols of broken
+    '''
+    def __init__(self, latency = 0.05, failure_rate = 0.1, broken = (), seed = 0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.broken = set(broken)
+        self.calls = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def fetch(self, symbol):
+        with self._lock:
+            self.calls.append(time.monotonic())
+            failed = self._random.random() < self.failure_rate
+        time.sleep(self.latency)
+        if symbol in self.broken:
+            raise KeyError(f"No data for {symbol}")
+        if failed:
+            raise ConnectionError(f"Connection reset fetching {symbol}")
+        return({'symbol': symbol, 'price': 100.0 + len(symbol)})
+
+
+def _example(n_symbols = 200, latency = 0.05):
+    symbols = [f"S{i:04d}" for i in range(n_symbols)]
+
+    provider = _FakeSymbolProvider(latency, failure_rate = 0, seed = 1)
+    start = time.perf_counter()
+    sequential = [provider.fetch(symbol) for symbol in symbols[:20]]
+    t_sequential = (time.perf_counter() - start) * n_symbols / 20
+
+    rate = 100
+    provider = _FakeSymbolProvider(latency, failure_rate = 0.1, broken = ['S0007'], seed = 1)
+    stage = FetchStage(provider.fetch, workers = 16, rate_limiter = TokenBucket(rate, capacity = 10),
+                       retries = 5, backoff = 0.01)
+    start = time.perf_counter()
+    results = list(stage.run(symbols))
+    t_concurrent = time.perf_counter() - start
+    print(f"{n_symbols} symbols, {latency}s per call: sequential {t_sequential:.1f}s, "
+          f"concurrent {t_concurrent:.1f}s for {len(provider.calls)} calls")
+
+    # results in order, the broken symbol isolated and not retried, transient errors retried
+    assert([result.symbol for result in results] == symbols)
+    assert(isinstance(results[7].error, KeyError) and results[7].attempts == 1)
+    assert(all(result.error is None for i, result in enumerate(results) if i != 7))
+    assert(any(result.attempts > 1 for result in results))
+    assert(results[0].value == sequential[0])
+
+    # no more than capacity + rate * t calls in any window of t seconds
+    calls = sorted(provider.calls)
+    for i in range(len(calls)):
+        for j in range(i + 1, len(calls)):
+            assert(j - i + 1 <= 10 + rate * (calls[j] - calls[i]) + 1)
+
+    # a consumer stopping early leaves the symbols beyond the window unfetched
+    provider = _FakeSymbolProvider(latency, failure_rate = 0)
+    stage = FetchStage(provider.fetch, workers = 4)
+    for result in stage.run(symbols):
+        if result.symbol == symbols[9]:
+            break
+    time.sleep(2 * latency)
+    assert(len(provider.calls) <= 10 + stage.max_pending)
+
+
+def _test():
+    _example()
+
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,341 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from collections import OrderedDict, namedtuple
+
+
+CacheInfo = namedtuple('CacheInfo', ['memory_hits', 'disk_hits', 'misses', 'evictions', 'entries', 'size_bytes'])
+
+# statement code of each statement type in get_financial_stmts payloads, for annual statements
+STATEMENT_CODES = {'balance': 'balanceSheetHistory', 'cash': 'cashflowStatementHistory',
+                   'income': 'incomeStatementHistory'}
+
+# YahooFinancials methods of the per symbol quote data
+QUOTE_METHODS = {'summary': 'get_summary_data', 'price': 'get_stock_price_data', 'profile': 'get_stock_profile_data'}
+
+
+def _statement_code(statement_type, frequency):
+    return(STATEMENT_CODES[statement_type] + ('Quarterly' if frequency == 'quarterly' else ''))
+
+
+class YahooStatementProvider(object):
+    '''
+    Live provider: fetches one financial statement of one symbol from Yahoo Finance
+    fetch returns {statement code: data of the symbol}, the per symbol slice of
+    YahooFinancials.get_financial_stmts
+
+    fetch_statements and fetch_quotes make one multi-ticker YahooFinancials call for many
+    symbols (see request_planner)
+    '''
+    def fetch(self, symbol, statement_type, frequency):
+        from yahoofinancials import YahooFinancials
+
+        yahoo = YahooFinancials(symbol)
+        data = yahoo.get_financial_stmts(frequency, statement_type)
+        return({code: by_symbol.get(yahoo.ticker) for code, by_symbol in data.items()})
+
+    def fetch_statements(self, symbols, statement_types, frequency):
+        '''
+        {(symbol, statement type): payload as returned by fetch}
+        '''
+        from yahoofinancials import YahooFinancials
+
+        yahoo = YahooFinancials(list(symbols))
+        data = yahoo.get_financial_stmts(frequency, list(statement_types))
+        payloads = {}
+        for symbol, ticker in zip(symbols, yahoo.ticker):
+            for statement_type in statement_types:
+                code = _statement_code(statement_type, frequency)
+                payloads[(symbol, statement_type)] = {code: (data.get(code) or {}).get(ticker)}
+        return(payloads)
+
+    def fetch_quotes(self, symbols, quote_type):
+        '''
+        {symbol: data} of one of the QUOTE_METHODS
+        '''
+        from yahoofinancials import YahooFinancials
+
+        yahoo = YahooFinancials(list(symbols))
+        data = getattr(yahoo, QUOTE_METHODS[quote_type])()
+        return({symbol: data.get(ticker) for symbol, ticker in zip(symbols, yahoo.ticker)})
+
+
+class RecordedStatementProvider(object):
+    '''
+    Offline provider replaying payloads recorded as json files in a directory, one file per
+    (symbol, statement type, frequency), quote data being recorded with frequency None.
+    With a source provider, payloads that are not recorded yet are fetched from it and
+    recorded; without one they raise KeyError. requests counts the calls made to the
+    provider, a multi-ticker call counting as one.
+    '''
+    def __init__(self, path, source = None):
+        self.path = path
+        self.source = source
+        self.requests = 0
+        os.makedirs(path, exist_ok = True)
+
+    def _fname(self, symbol, statement_type, frequency):
+        if frequency is None:
+            return(os.path.join(self.path, f"{symbol}_{statement_type}.json"))
+        return(os.path.join(self.path, f"{symbol}_{statement_type}_{frequency}.json"))
+
+    def recorded(self, symbol, statement_type, frequency):
+        return(os.path.exists(self._fname(symbol, statement_type, frequency)))
+
+    def _replay(self, symbol, statement_type, frequency):
+        with open(self._fname(symbol, statement_type, frequency)) as f:
+            return(json.load(f))
+
+    def record(self, symbol, statement_type, frequency, payload):
+        with open(self._fname(symbol, statement_type, frequency), 'w') as f:
+            json.dump(payload, f)
+
+    def forget(self, symbol, statement_type, frequency):
+        '''
+        drop a recorded payload, fetched again from the source (or missing) afterwards
+        '''
+        if self.recorded(symbol, statement_type, frequency):
+            os.remove(self._fname(symbol, statement_type, frequency))
+
+    def fetch(self, symbol, statement_type, frequency):
+        self.requests += 1
+        if self.recorded(symbol, statement_type, frequency):
+            return(self._replay(symbol, statement_type, frequency))
+        if self.source is None:
+            raise KeyError(f"No recorded {frequency} {statement_type} statement for {symbol}")
+        payload = self.source.fetch(symbol, statement_type, frequency)
+        self.record(symbol, statement_type, frequency, payload)
+        return(payload)
+
+    def fetch_statements(self, symbols, statement_types, frequency):
+        self.requests += 1
+        missing = [symbol for symbol in symbols
+                   if not all(self.recorded(symbol, statement_type, frequency) for statement_type in statement_types)]
+        payloads = {(symbol, statement_type): self._replay(symbol, statement_type, frequency)
+                    for symbol in symbols if symbol not in missing for statement_type in statement_types}
+        if missing:
+            if self.source is None:
+                raise KeyError(f"No recorded {frequency} {statement_types} statements for {missing}")
+            for (symbol, statement_type), payload in \
+                    self.source.fetch_statements(missing, statement_types, frequency).items():
+                self.record(symbol, statement_type, frequency, payload)
+                payloads[(symbol, statement_type)] = payload
+        return(payloads)
+
+    def fetch_quotes(self, symbols, quote_type):
+        self.requests += 1
+        missing = [symbol for symbol in symbols if not self.recorded(symbol, quote_type, None)]
+        quotes = {symbol: self._replay(symbol, quote_type, None) for symbol in symbols if symbol not in missing}
+        if missing:
+            if self.source is None:
+                raise KeyError(f"No recorded {quote_type} data for {missing}")
+            for symbol, data in self.source.fetch_quotes(missing, quote_type).items():
+                self.record(symbol, quote_type, None, data)
+                quotes[symbol] = data
+        return(quotes)
+
+
+class FundamentalsCache(object):
+    '''
+    Two level cache of financial statement payloads keyed by (symbol, statement type, frequency)
+
+    an in-process LRU of memory_size payloads sits in front of a SQLite file. Entries older
+    than ttl seconds are refetched from the provider, and when the payloads stored on disk
+    exceed max_bytes the least recently used ones are evicted. With offline = True expired
+    entries are served as they are and the provider is only used for missing keys.
+    Hits and misses are counted, see info().
+    '''
+    def __init__(self, path = "fundamentals_cache.sqlite", provider = None, ttl = 7 * 24 * 3600,
+                 max_bytes = 256 * 2**20, memory_size = 1024, offline = False):
+        self.path = path
+        self.provider = YahooStatementProvider() if provider is None else provider
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.memory_size = memory_size
+        self.offline = offline
+
+        self._memory = OrderedDict()
+        self._lock = threading.RLock()
+        self._memory_hits = self._disk_hits = self._misses = self._evictions = 0
+
+        self._db = sqlite3.connect(path, check_same_thread = False)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS statements (
+                                symbol TEXT, statement_type TEXT, frequency TEXT,
+                                fetched_at REAL, accessed_at REAL, size INTEGER, payload TEXT,
+                                PRIMARY KEY (symbol, statement_type, frequency))''')
+        self._db.commit()
+
+    def _expired(self, fetched_at):
+        return(not self.offline and time.time() - fetched_at > self.ttl)
+
+    def _remember(self, key, fetched_at, payload):
+        self._memory[key] = (fetched_at, payload)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last = False)
+
+    def _load(self, key):
+        '''
+        cached payload for key, or None when it is missing or expired
+        '''
+        if key in self._memory:
+            fetched_at, payload = self._memory[key]
+            if not self._expired(fetched_at):
+                self._memory.move_to_end(key)
+                self._memory_hits += 1
+                return(payload)
+            del self._memory[key]
+
+        row = self._db.execute('SELECT fetched_at, payload FROM statements '
+                               'WHERE symbol = ? AND statement_type = ? AND frequency = ?', key).fetchone()
+        if row is None or self._expired(row[0]):
+            return(None)
+        self._db.execute('UPDATE statements SET accessed_at = ? '
+                         'WHERE symbol = ? AND statement_type = ? AND frequency = ?', (time.time(),) + key)
+        self._db.commit()
+        payload = json.loads(row[1])
+        self._remember(key, row[0], payload)
+        self._disk_hits += 1
+        return(payload)
+
+    def store(self, symbol, statement_type, frequency, payload):
+        key = (symbol, statement_type, frequency)
+        text = json.dumps(payload)
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO statements VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             key + (now, now, len(text), text))
+            self._evict()
+            self._db.commit()
+            self._remember(key, now, payload)
+
+    def _evict(self):
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM statements').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute('SELECT symbol, statement_type, frequency, size FROM statements '
+                                'ORDER BY accessed_at').fetchall()
+        for symbol, statement_type, frequency, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._db.execute('DELETE FROM statements WHERE symbol = ? AND statement_type = ? AND frequency = ?',
+                             (symbol, statement_type, frequency))
+            self._memory.pop((symbol, statement_type, frequency), None)
+            total -= size
+            self._evictions += 1
+
+    def peek(self, symbol, statement_type, frequency):
+        '''
+        cached payload, or None when it is missing or expired; never fetches
+        '''
+        with self._lock:
+            return(self._load((symbol, statement_type, frequency)))
+
+    def get(self, symbol, statement_type, frequency):
+        '''
+        {statement code: data} for one symbol, from the cache or else from the provider
+        '''
+        key = (symbol, statement_type, frequency)
+        with self._lock:
+            payload = self._load(key)
+            if payload is not None:
+                return(payload)
+            self._misses += 1
+        # fetch outside the lock, so concurrent misses on other symbols do not wait
+        payload = self.provider.fetch(symbol, statement_type, frequency)
+        self.store(symbol, statement_type, frequency, payload)
+        return(payload)
+
+    def info(self):
+        with self._lock:
+            entries, size = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM statements').fetchone()
+            return(CacheInfo(self._memory_hits, self._disk_hits, self._misses, self._evictions, entries, size))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM statements')
+            self._db.commit()
+            self._memory.clear()
+
+    def close(self):
+        self._db.close()
+
+
+_default_cache = None
+
+
+def get_default_cache():
+    '''
+    the FundamentalsCache shared by MyYahooFinancials objects created without one
+    '''
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = FundamentalsCache()
+    return(_default_cache)
+
+
+def set_default_cache(cache):
+    global _default_cache
+    _default_cache = cache
+
+
+class _FakeProvider(object):
+    # counts fetches and returns a small balance sheet like payload
+    def __init__(self):
+        self.fetches = 0
+
+    def fetch(self, symbol, statement_type, frequency):
+        self.fetches += 1
+        return({'balanceSheetHistory': [{'2021-09-25': {'cash': 34940000000, 'longTermDebt': 109106000000}}]})
+
+
+def _example():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as path:
+        provider = _FakeProvider()
+        cache = FundamentalsCache(os.path.join(path, "cache.sqlite"), provider, memory_size = 2)
+        for symbol in ['AAPL', 'MSFT', 'KO']:
+            for i in range(3):
+                cache.get(symbol, 'balance', 'annual')
+        print(cache.info())
+        assert(provider.fetches == 3)
+
+        # a new process only has the disk cache
+        cache.close()
+        cache = FundamentalsCache(os.path.join(path, "cache.sqlite"), provider)
+        cache.get('AAPL', 'balance', 'annual')
+        assert(provider.fetches == 3 and cache.info().disk_hits == 1)
+
+        # expired entries are refetched, unless offline
+        cache.ttl = -1
+        cache._memory.clear()
+        cache.get('AAPL', 'balance', 'annual')
+        assert(provider.fetches == 4)
+        cache.offline = True
+        cache.get('MSFT', 'balance', 'annual')
+        assert(provider.fetches == 4)
+
+        # size based eviction keeps the most recently used entries
+        cache.max_bytes = 2 * cache.info().size_bytes // 3
+        cache.store('KO', 'balance', 'annual', provider.fetch('KO', 'balance', 'annual'))
+        print(cache.info())
+        assert(cache.info().entries == 2 and cache.info().evictions == 1)
+
+        # recorded payloads replay without a source
+        recorder = RecordedStatementProvider(os.path.join(path, "recorded"), source = provider)
+        recorded = recorder.fetch('AAPL', 'balance', 'annual')
+        replay = RecordedStatementProvider(os.path.join(path, "recorded"))
+        assert(replay.fetch('AAPL', 'balance', 'annual') == recorded)
+        cache.close()
+
+
+def _test():
+    _example()
+
+
+if __name__ == "__main__":
+    _test()
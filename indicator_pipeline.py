@@ -0,0 +1,185 @@
+import re
+import math
+import numpy as np
+import pandas as pd
+
+from TA import _smoothed_moves, _rsi_from_moves
+
+
+class _Node(object):
+    '''
+    one step of the pipeline: function(*values of inputs), and the number of trailing rows
+    of history it needs for the as-of value (None for the whole history)
+    '''
+    __slots__ = ('key', 'inputs', 'function', 'window')
+
+    def __init__(self, key, inputs, function, window):
+        self.key = key
+        self.inputs = inputs
+        self.function = function
+        self.window = window
+
+
+def _ewm_window(alpha, tolerance):
+    # rows after which the weight of older prices is below tolerance
+    return(int(math.ceil(math.log(tolerance) / math.log(1 - alpha))) + 1)
+
+
+class IndicatorPipeline(object):
+    '''
+    As-of values of a list of indicators, e.g. ['RSI14', 'EMA10', 'SMA20', 'SMA200', 'VWAP']
+
+    the specs are turned into a DAG of nodes (prices, running sums, price changes, average
+    moves, typical price, ...) so that intermediates shared by several outputs are computed
+    once and nothing unused is. evaluate only reads the trailing rows the requested values
+    need: period rows for an SMA, and for the exponential averages the rows after which the
+    weight of older prices is below tolerance; the cumulative VWAP needs the whole history.
+    Values match the TA classes: SMA and EMA of 'Close', RSI of 'Adj Close', VWAP of the
+    typical price.
+    '''
+    SPEC = re.compile(r'^(SMA|EMA|RSI|VWAP)(\d*)$')
+
+    def __init__(self, specs, tolerance = 1.0e-12, rsi_smoothing = 'ema'):
+        self.specs = list(specs)
+        self.tolerance = tolerance
+        self.rsi_smoothing = rsi_smoothing
+        self.nodes = {}
+        self.outputs = {spec: self._add_spec(spec) for spec in self.specs}
+
+    def _add(self, key, inputs, function, window):
+        if key not in self.nodes:
+            self.nodes[key] = _Node(key, inputs, function, window)
+        return(key)
+
+    def _price(self, source):
+        return(self._add(('price', source), (), None, 1))
+
+    def _add_spec(self, spec):
+        match = self.SPEC.match(spec)
+        if match is None:
+            raise Exception(f"Unsupported indicator {spec}")
+        name, period = match.group(1), int(match.group(2) or 14)
+
+        if name == 'SMA':
+            sums = self._add(('sums', 'Close'), (self._price('Close'),), _running_sums, 1)
+            return(self._add(('SMA', period), (sums,), lambda sums: _window_mean(sums, period), period))
+        if name == 'EMA':
+            alpha = 2 / (period + 1)
+            return(self._add(('EMA', period), (self._price('Close'),), lambda prices: _ewm_last(prices, alpha),
+                             _ewm_window(alpha, self.tolerance)))
+        if name == 'RSI':
+            changes = self._add(('changes', 'Adj Close'), (self._price('Adj Close'),), _valid_changes, 2)
+            window = _ewm_window(1 / period, self.tolerance) + period + 1
+            moves = self._add(('moves', period), (changes,),
+                              lambda changes: _smoothed_moves(changes[:, np.newaxis].copy(), period, self.rsi_smoothing),
+                              window)
+            return(self._add(('RSI', period), (moves,), _last_rsi, window))
+        # cumulative VWAP
+        typical = self._add(('typical',), (self._price('High'), self._price('Low'), self._price('Close')),
+                            lambda high, low, close: (high + low + close) / 3, 1)
+        return(self._add(('VWAP',), (typical, self._price('Volume')),
+                         lambda typical, volume: np.nansum(typical * volume) / np.nansum(volume), None))
+
+    def window(self):
+        '''
+        trailing rows needed for the as-of values, None for the whole history
+        '''
+        windows = [self.nodes[key].window for key in self.nodes]
+        return(None if None in windows else max(windows))
+
+    def evaluate(self, ohlcv_df, as_of_date = None):
+        '''
+        {spec: value} as of the last row of ohlcv_df on or before as_of_date (default the last row)
+        '''
+        end = len(ohlcv_df) if as_of_date is None else \
+            int(np.searchsorted(ohlcv_df.index.values, np.datetime64(pd.Timestamp(as_of_date)), side = 'right'))
+        window = self.window()
+        start = 0 if window is None else max(end - window, 0)
+        rows = ohlcv_df.iloc[start:end]
+
+        values = {}
+        def value(key):
+            if key not in values:
+                node = self.nodes[key]
+                if node.function is None:
+                    values[key] = np.asarray(rows[key[1]].values, dtype = np.float64)
+                else:
+                    values[key] = node.function(*[value(k) for k in node.inputs])
+            return(values[key])
+
+        if end == 0:
+            return({spec: math.nan for spec in self.specs})
+        return({spec: float(value(key)) for spec, key in self.outputs.items()})
+
+
+def _running_sums(prices):
+    valid = ~np.isnan(prices)
+    sums = np.concatenate([[0.0], np.cumsum(np.where(valid, prices, 0.0))])
+    counts = np.concatenate([[0], np.cumsum(valid)])
+    return(sums, counts)
+
+
+def _window_mean(sums, period):
+    # mean of the valid prices in the last period rows, as rolling(period, min_periods = 1).mean()
+    sums, counts = sums
+    start = max(len(sums) - 1 - period, 0)
+    count = counts[-1] - counts[start]
+    return((sums[-1] - sums[start]) / count if count > 0 else math.nan)
+
+
+def _ewm_last(prices, alpha):
+    # last value of ewm(alpha = alpha, adjust = True).mean(): weights by position, nan prices skipped
+    valid = ~np.isnan(prices)
+    if not valid.any():
+        return(math.nan)
+    weights = (1 - alpha)**np.arange(len(prices) - 1, -1, -1)
+    return(np.sum(weights[valid] * prices[valid]) / np.sum(weights[valid]))
+
+
+def _valid_changes(prices):
+    changes = np.diff(prices)
+    return(changes[~np.isnan(changes)])
+
+
+def _last_rsi(moves):
+    # nan without any valid price change
+    rsi = _rsi_from_moves(*moves)
+    return(float(rsi[-1, 0]) if len(rsi) > 0 else math.nan)
+
+
+def _example():
+    from TA import SimpleMovingAverages, ExponentialMovingAverages, RSI, VWAP
+    from price_store import _random_history
+
+    df = _random_history('AAPL', '2015-01-01', '2021-12-01')
+    df.iloc[100:105] = np.nan
+    as_of_date = '2021-11-15'
+    specs = ['RSI14', 'EMA10', 'SMA20', 'SMA50', 'SMA200', 'VWAP']
+
+    pipeline = IndicatorPipeline(specs[:-1])
+    values = pipeline.evaluate(df, as_of_date)
+    print(f"{len(pipeline.nodes)} nodes, {pipeline.window()} trailing rows:", values)
+    print("with VWAP:", IndicatorPipeline(specs).evaluate(df, as_of_date))
+
+    smas, emas, rsi, vwap = SimpleMovingAverages(df, [20, 50, 200]), ExponentialMovingAverages(df, [10]), RSI(df), VWAP(df)
+    for indicator in (smas, emas, rsi, vwap):
+        indicator.run()
+    expected = {'RSI14': rsi.get_series()[as_of_date], 'EMA10': emas.get_series(10)[as_of_date],
+                'SMA20': smas.get_series(20)[as_of_date], 'SMA50': smas.get_series(50)[as_of_date],
+                'SMA200': smas.get_series(200)[as_of_date], 'VWAP': vwap.get_series()[as_of_date]}
+    values = IndicatorPipeline(specs).evaluate(df, as_of_date)
+    for spec in specs:
+        assert(math.isclose(values[spec], expected[spec], rel_tol = 1e-9)), spec
+
+    # fewer than two valid prices: no RSI yet, the other values still computed
+    for rows in (df.iloc[:1], df.iloc[99:105]):
+        values = IndicatorPipeline(specs).evaluate(rows)
+        assert(math.isnan(values['RSI14']) and not math.isnan(values['SMA20'])), values
+
+
+def _test():
+    _example()
+
+
+if __name__ == "__main__":
+    _test()
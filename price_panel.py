@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import pickle
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+from price_store import FIELDS
+
+
+class SymbolView(object):
+    '''
+    One symbol of a PricePanel, usable in place of an OHLCV data frame by the TA classes:
+    view[field] is a pandas Series over the panel's memory, no data is copied
+    '''
+    def __init__(self, panel, symbol):
+        self.panel = panel
+        self.symbol = symbol
+        self._column = panel.symbol_index(symbol)
+
+    def __getitem__(self, field):
+        values = self.panel.values[:, self._column, self.panel.field_index(field)]
+        return(pd.Series(values, index = self.panel.index, name = field, copy = False))
+
+    @property
+    def index(self):
+        return(self.panel.index)
+
+    @property
+    def columns(self):
+        return(list(self.panel.fields))
+
+
+class PricePanel(object):
+    '''
+    dates x symbols x fields prices in one contiguous float64 (or float32) array, stored as
+    a raw file of path and memory mapped, with the dates, symbols and fields in path.json
+
+    field(name) is a (dates x symbols) view and symbol_view(symbol) a SymbolView, both
+    without copy. Dates where a symbol has no data are nan. The panel pickles as its path,
+    so worker processes reopen the same mapping instead of receiving the data.
+    '''
+    def __init__(self, path, mode = 'r'):
+        with open(path + '.json') as f:
+            header = json.load(f)
+        self.path = path
+        self.mode = mode
+        self.dates = np.array(header['dates'], dtype = 'datetime64[D]')
+        self.symbols = list(header['symbols'])
+        self.fields = list(header['fields'])
+        self.index = pd.DatetimeIndex(self.dates, name = 'Date')
+        self._symbol_index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.values = np.memmap(path, dtype = header['dtype'], mode = mode,
+                                shape = (len(self.dates), len(self.symbols), len(self.fields)))
+
+    @classmethod
+    def create(cls, path, dates, symbols, fields = FIELDS, dtype = np.float64):
+        '''
+        new panel filled with nan, opened for writing
+        '''
+        dates = np.asarray(dates, dtype = 'datetime64[D]')
+        header = {'dates': [str(d) for d in dates], 'symbols': list(symbols), 'fields': list(fields),
+                  'dtype': np.dtype(dtype).name}
+        with open(path + '.json', 'w') as f:
+            json.dump(header, f)
+        values = np.memmap(path, dtype = dtype, mode = 'w+', shape = (len(dates), len(symbols), len(fields)))
+        values[:] = np.nan
+        values.flush()
+        del values
+        return(cls(path, mode = 'r+'))
+
+    @classmethod
+    def from_store(cls, path, store, symbols, start, end, fields = FIELDS, dtype = np.float64, update = True):
+        '''
+        build a panel of symbols over [start, end] from a PriceStore, the dates being the
+        union of the symbols' trading dates
+        '''
+        histories = [store.load_arrays(symbol, start, end, update = update, mmap_mode = 'r') for symbol in symbols]
+        dates = np.unique(np.concatenate([dates for dates, columns in histories])) if histories else []
+        panel = cls.create(path, dates, symbols, fields, dtype)
+        for j, (symbol_dates, columns) in enumerate(histories):
+            rows = np.searchsorted(panel.dates, symbol_dates)
+            for k, field in enumerate(fields):
+                panel.values[rows, j, k] = columns[field]
+        panel.flush()
+        return(cls(path))
+
+    def __reduce__(self):
+        return(PricePanel, (self.path, 'r'))
+
+    def __len__(self):
+        return(len(self.dates))
+
+    def flush(self):
+        if self.mode != 'r':
+            self.values.flush()
+
+    def symbol_index(self, symbol):
+        return(self._symbol_index[symbol])
+
+    def field_index(self, field):
+        return(self.fields.index(field))
+
+    def field(self, field):
+        '''
+        (dates x symbols) view of one field
+        '''
+        return(self.values[:, :, self.field_index(field)])
+
+    def field_frame(self, field):
+        '''
+        wide data frame (dates x symbols) of one field, over the panel's memory
+        '''
+        return(pd.DataFrame(self.field(field), index = self.index, columns = self.symbols, copy = False))
+
+    def symbol_view(self, symbol):
+        return(SymbolView(self, symbol))
+
+
+def _last_sma(view, period):
+    # worker of the example: the panel arrives pickled by path
+    from TA import SimpleMovingAverages
+
+    smas = SimpleMovingAverages(view, [period])
+    smas.run()
+    return(smas.get_series(period).iloc[-1])
+
+
+def _example(n_symbols = 200):
+    import tempfile
+    from price_store import PriceStore, CSVSource, _random_history
+    from TA import SimpleMovingAverages, RSI, VWAP
+
+    with tempfile.TemporaryDirectory() as path:
+        csv_path = os.path.join(path, "csv")
+        os.makedirs(csv_path)
+        symbols = [f"S{i:04d}" for i in range(n_symbols)]
+        for i, symbol in enumerate(symbols):
+            # ragged histories: later symbols list later
+            _random_history(symbol, f"{2010 + i % 10}-01-01", '2021-12-01').to_csv(
+                os.path.join(csv_path, f"{symbol}.csv"))
+        store = PriceStore(os.path.join(path, "store"), CSVSource(csv_path))
+
+        start = time.perf_counter()
+        panel = PricePanel.from_store(os.path.join(path, "panel.bin"), store, symbols, '2010-01-01', '2021-12-01')
+        t_build = time.perf_counter() - start
+        print(f"panel {panel.values.shape} built in {t_build:.2f}s")
+
+        # indicators on a view match the ones on the data frame
+        view = panel.symbol_view('S0003')
+        df = store.load('S0003', '2010-01-01', '2021-12-01')
+        for indicator in [SimpleMovingAverages(view, [20]), RSI(view), VWAP(view)]:
+            indicator.run()
+        expected = SimpleMovingAverages(df, [20])
+        expected.run()
+        sma = SimpleMovingAverages(view, [20])
+        sma.run()
+        assert(np.allclose(sma.get_series(20).dropna().values, expected.get_series(20).values))
+        assert(np.shares_memory(view['Close'].values, panel.values))
+
+        # pickles as the path
+        assert(len(pickle.dumps(view)) < 1000)
+        with ProcessPoolExecutor(2) as executor:
+            last = list(executor.map(_last_sma, [panel.symbol_view(s) for s in symbols[:4]], [50] * 4))
+        assert(np.allclose(last, [panel.field_frame('Close')[s].iloc[-50:].mean() for s in symbols[:4]]))
+
+
+def _test():
+    _example()
+
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import datetime
+import numpy as np
+import pandas as pd
+
+
+FIELDS = ('High', 'Low', 'Open', 'Close', 'Volume', 'Adj Close')
+
+_ONE_DAY = np.timedelta64(1, 'D')
+
+
+def _to_day(value):
+    return(np.datetime64(pd.Timestamp(value).date(), 'D'))
+
+
+class DataReaderSource(object):
+    '''
+    Daily OHLCV from Yahoo through pandas_datareader, the source Stock.get_daily_hist_price used
+    '''
+    def fetch(self, symbol, start, end):
+        import pandas_datareader.data as web
+
+        return(web.DataReader(symbol, 'yahoo', pd.Timestamp(start), pd.Timestamp(end)))
+
+
+class CSVSource(object):
+    '''
+    Daily OHLCV read from one csv file per symbol, as written by DataFrame.to_csv of a
+    DataReader frame (a Date column and the FIELDS columns)
+    '''
+    def __init__(self, path, pattern = "{symbol}.csv"):
+        self.path = path
+        self.pattern = pattern
+
+    def fetch(self, symbol, start, end):
+        fname = os.path.join(self.path, self.pattern.format(symbol = symbol))
+        df = pd.read_csv(fname, index_col = 'Date', parse_dates = True)
+        return(df.loc[pd.Timestamp(start):pd.Timestamp(end)])
+
+
+class PriceStore(object):
+    '''
+    Local columnar store of daily OHLCV, one directory per symbol holding a .npy file per
+    field, the dates (datetime64[D]) and ranges.json, the date ranges already fetched
+
+    load only asks the source for the parts of the requested range that are not covered
+    yet, so reloading a stored history is a read of the .npy files. Ranges are inclusive
+    and cover calendar days, so weekends and holidays inside a fetched range are not
+    fetched again; days after yesterday are never marked as covered.
+    '''
+    def __init__(self, root = "price_store", source = None):
+        self.root = root
+        self.source = DataReaderSource() if source is None else source
+        self.fetches = 0
+        os.makedirs(root, exist_ok = True)
+
+    def _dir(self, symbol):
+        return(os.path.join(self.root, symbol))
+
+    def _fname(self, symbol, name):
+        return(os.path.join(self._dir(symbol), name.replace(' ', '_') + '.npy'))
+
+    def covered_ranges(self, symbol):
+        '''
+        list of (start, end) datetime64[D] pairs already in the store, sorted and disjoint
+        '''
+        fname = os.path.join(self._dir(symbol), 'ranges.json')
+        if not os.path.exists(fname):
+            return([])
+        with open(fname) as f:
+            return([(np.datetime64(start, 'D'), np.datetime64(end, 'D')) for start, end in json.load(f)])
+
+    def missing_ranges(self, symbol, start, end):
+        '''
+        the parts of [start, end] not covered yet
+        '''
+        start, end = _to_day(start), _to_day(end)
+        gaps = []
+        for covered_start, covered_end in self.covered_ranges(symbol):
+            if covered_end < start or covered_start > end:
+                continue
+            if covered_start > start:
+                gaps.append((start, covered_start - _ONE_DAY))
+            start = max(start, covered_end + _ONE_DAY)
+        if start <= end:
+            gaps.append((start, end))
+        return(gaps)
+
+    def _read_columns(self, symbol, mmap_mode = None):
+        if not os.path.exists(self._fname(symbol, 'Date')):
+            return(np.zeros(0, dtype = 'datetime64[D]'), {field: np.zeros(0) for field in FIELDS})
+        dates = np.load(self._fname(symbol, 'Date'), mmap_mode = mmap_mode)
+        return(dates, {field: np.load(self._fname(symbol, field), mmap_mode = mmap_mode) for field in FIELDS})
+
+    def _save(self, fname, values):
+        # write then rename, so readers never see a partly written file
+        tmp = fname + '.tmp.npy'
+        np.save(tmp, values)
+        os.replace(tmp, fname)
+
+    def _merge(self, symbol, frames, ranges):
+        dates, columns = self._read_columns(symbol)
+        for df in frames:
+            new_dates = df.index.values.astype('datetime64[D]')
+            keep = ~np.isin(dates, new_dates)
+            dates = np.concatenate([dates[keep], new_dates])
+            columns = {field: np.concatenate([columns[field][keep], df[field].values.astype(np.float64)])
+                       for field in FIELDS}
+        order = np.argsort(dates, kind = 'stable')
+
+        os.makedirs(self._dir(symbol), exist_ok = True)
+        for field in FIELDS:
+            self._save(self._fname(symbol, field), columns[field][order])
+        self._save(self._fname(symbol, 'Date'), dates[order])
+
+        merged = []
+        for start, end in sorted(self.covered_ranges(symbol) + ranges):
+            if merged and start <= merged[-1][1] + _ONE_DAY:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        with open(os.path.join(self._dir(symbol), 'ranges.json'), 'w') as f:
+            json.dump([(str(start), str(end)) for start, end in merged], f)
+
+    def update(self, symbol, start, end):
+        '''
+        fetch the missing parts of [start, end] from the source and add them to the store
+        '''
+        last_complete_day = np.datetime64(datetime.date.today(), 'D') - _ONE_DAY
+        gaps = self.missing_ranges(symbol, start, end)
+        if len(gaps) == 0:
+            return
+        frames = []
+        for gap_start, gap_end in gaps:
+            self.fetches += 1
+            frames.append(self.source.fetch(symbol, str(gap_start), str(gap_end)))
+        ranges = [(s, min(e, last_complete_day)) for s, e in gaps if s <= last_complete_day]
+        self._merge(symbol, frames, ranges)
+
+    def load_arrays(self, symbol, start, end, update = True, mmap_mode = None):
+        '''
+        dates (datetime64[D]) and {field: float64 array} of symbol over [start, end]
+        with mmap_mode = 'r' the arrays are read only views of the memory mapped files
+        '''
+        if update:
+            self.update(symbol, start, end)
+        dates, columns = self._read_columns(symbol, mmap_mode)
+        lo = np.searchsorted(dates, _to_day(start), side = 'left')
+        hi = np.searchsorted(dates, _to_day(end), side = 'right')
+        return(dates[lo:hi], {field: values[lo:hi] for field, values in columns.items()})
+
+    def load(self, symbol, start, end, update = True):
+        '''
+        OHLCV data frame of symbol over [start, end] indexed by Date, like DataReader
+        '''
+        dates, columns = self.load_arrays(symbol, start, end, update)
+        index = pd.DatetimeIndex(dates, name = 'Date')
+        return(pd.DataFrame(np.column_stack([columns[field] for field in FIELDS]), index = index,
+                            columns = list(FIELDS)))
+
+
+_default_store = None
+
+
+def get_default_store():
+    '''
+    the PriceStore used by Stock objects created without one
+    '''
+    global _default_store
+    if _default_store is None:
+        _default_store = PriceStore()
+    return(_default_store)
+
+
+def _random_history(symbol, start, end):
+    rng = np.random.default_rng(sum(map(ord, symbol)))
+    index = pd.bdate_range(start, end, name = 'Date')
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, len(index))))
+    return(pd.DataFrame({'High': close * 1.01, 'Low': close * 0.99, 'Open': close, 'Close': close,
+                         'Volume': rng.integers(1e5, 1e7, len(index)).astype(float), 'Adj Close': close},
+                        index = index))
+
+
+def _example(n_symbols = 500):
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as path:
+        csv_path = os.path.join(path, "csv")
+        os.makedirs(csv_path)
+        symbols = [f"S{i:04d}" for i in range(n_symbols)]
+        for symbol in symbols:
+            _random_history(symbol, '2019-11-01', '2021-12-01').to_csv(os.path.join(csv_path, f"{symbol}.csv"))
+
+        store = PriceStore(os.path.join(path, "store"), CSVSource(csv_path))
+        store.load('S0000', '2020-06-01', '2020-12-31')
+        store.load('S0000', '2021-03-01', '2021-06-30')
+        assert(store.missing_ranges('S0000', '2020-01-01', '2021-12-01') ==
+               [(np.datetime64('2020-01-01'), np.datetime64('2020-05-31')),
+                (np.datetime64('2021-01-01'), np.datetime64('2021-02-28')),
+                (np.datetime64('2021-07-01'), np.datetime64('2021-12-01'))])
+        fetches = store.fetches
+        df = store.load('S0000', '2020-01-01', '2021-12-01')
+        assert(store.fetches == fetches + 3 and store.covered_ranges('S0000') ==
+               [(np.datetime64('2020-01-01'), np.datetime64('2021-12-01'))])
+        expected = CSVSource(csv_path).fetch('S0000', '2020-01-01', '2021-12-01')
+        assert(np.allclose(df.values, expected[list(FIELDS)].values) and (df.index == expected.index).all())
+
+        start = time.perf_counter()
+        for symbol in symbols:
+            store.load(symbol, '2020-01-01', '2021-12-01')
+        t_import = time.perf_counter() - start
+
+        fetches = store.fetches
+        start = time.perf_counter()
+        for symbol in symbols:
+            store.load(symbol, '2020-01-01', '2021-12-01')
+        t_reload = time.perf_counter() - start
+        assert(store.fetches == fetches)
+        print(f"2 years of {n_symbols} symbols: import from csv {t_import:.2f}s, reload {t_reload:.2f}s")
+
+
+def _test():
+    _example()
+
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,188 @@
+import math
+import threading
+
+from collections import namedtuple, OrderedDict
+
+from fundamentals_cache import get_default_cache
+from fetch_stage import FetchStage
+
+
+PlannedRequest = namedtuple('PlannedRequest', ['kind', 'request_types', 'frequency', 'symbols'])
+
+
+class RequestPlanner(object):
+    '''
+    Loads the fundamentals of many Stocks with the fewest Yahoo calls
+
+    plan(stocks) collects what Stock.fundamentals and the report need for every symbol (the
+    statements of Stock.statement_groups, the summary, price and profile data), drops the
+    symbols repeated or whose statements are already in the cache, and merges the rest into
+    multi-ticker requests of at most batch_size symbols: one per group of statements of the
+    same frequency, and one per quote type. load(stocks) runs them and distributes the
+    results: statements go to the FundamentalsCache, each Stock gets its Fundamentals
+    (Stock.load_fundamentals) and its profile. requests counts the calls made.
+    '''
+    QUOTE_TYPES = ('summary', 'price', 'profile')
+
+    def __init__(self, cache = None, provider = None, batch_size = 50):
+        self.cache = get_default_cache() if cache is None else cache
+        self.provider = self.cache.provider if provider is None else provider
+        self.batch_size = batch_size
+        self.requests = 0
+        self._quotes = {quote_type: {} for quote_type in self.QUOTE_TYPES}
+        self._lock = threading.Lock()
+
+    def _batches(self, symbols):
+        n_batches = math.ceil(len(symbols) / self.batch_size)
+        return([symbols[i * self.batch_size:(i + 1) * self.batch_size] for i in range(n_batches)])
+
+    def plan(self, stocks):
+        '''
+        list of PlannedRequests covering stocks
+        '''
+        groups = OrderedDict()
+        symbols = []
+        for stock in stocks:
+            symbol = stock.yfinancial.ticker
+            if symbol in symbols:
+                continue
+            symbols.append(symbol)
+            for statement_types, frequency in stock.statement_groups():
+                if not all(self.cache.peek(symbol, statement_type, frequency) is not None
+                           for statement_type in statement_types):
+                    groups.setdefault((statement_types, frequency), []).append(symbol)
+
+        requests = [PlannedRequest('statements', statement_types, frequency, batch)
+                    for (statement_types, frequency), group_symbols in groups.items()
+                    for batch in self._batches(group_symbols)]
+        requests += [PlannedRequest('quotes', (quote_type,), None, batch)
+                     for quote_type in self.QUOTE_TYPES for batch in self._batches(symbols)]
+        return(requests)
+
+    def execute(self, request):
+        '''
+        run one PlannedRequest, keeping its results
+        '''
+        with self._lock:
+            self.requests += 1
+        if request.kind == 'statements':
+            payloads = self.provider.fetch_statements(request.symbols, request.request_types, request.frequency)
+            for (symbol, statement_type), payload in payloads.items():
+                self.cache.store(symbol, statement_type, request.frequency, payload)
+        else:
+            quote_type, = request.request_types
+            quotes = self.provider.fetch_quotes(request.symbols, quote_type)
+            with self._lock:
+                self._quotes[quote_type].update(quotes)
+        return(len(request.symbols))
+
+    def _statements(self, symbol, statement_groups):
+        # {code: {symbol: data}}, as MyYahooFinancials.get_financial_stmts
+        statements = {}
+        for statement_types, frequency in statement_groups:
+            for statement_type in statement_types:
+                payload = self.cache.peek(symbol, statement_type, frequency)
+                if payload is None:
+                    payload = self.cache.get(symbol, statement_type, frequency)
+                for code, data in payload.items():
+                    statements.setdefault(code, {})[symbol] = data
+        return(statements)
+
+    def load(self, stocks, workers = 1, rate_limiter = None, retries = 0):
+        '''
+        plan and run the requests for stocks, with workers threads (see FetchStage), then
+        load every stock's fundamentals and profile. A request takes one rate_limiter token
+        per symbol, Yahoo may serve a multi-ticker call with one HTTP call per ticker. The
+        stocks of a failed request are left unloaded (Stock.fundamentals fetches them on its
+        own later); the failed requests, as FetchResults, are returned.
+        '''
+        stage = FetchStage(self.execute, workers = workers, rate_limiter = rate_limiter, retries = retries,
+                           tokens_per_fetch = lambda request: len(request.symbols))
+        failures = [result for result in stage.run(self.plan(stocks)) if result.error is not None]
+        failed = {symbol for result in failures for symbol in result.symbol.symbols}
+
+        for stock in stocks:
+            symbol = stock.yfinancial.ticker
+            if symbol in failed:
+                continue
+            stock.load_fundamentals(self._statements(symbol, stock.statement_groups()),
+                                    self._quotes['summary'].get(symbol), self._quotes['price'].get(symbol))
+            stock.profile = self._quotes['profile'].get(symbol) or {}
+        return(failures)
+
+
+def _record_universe(provider, symbols):
+    # small but complete payloads for every request the planner makes
+    for i, symbol in enumerate(symbols):
+        provider.record(symbol, 'balance', 'annual', {'balanceSheetHistory': [{'2021-09-25': {
+            'cash': 1.0e9 + i, 'shortTermInvestments': 2.0e8, 'longTermDebt': 5.0e9, 'totalCurrentLiabilities': 3.0e9,
+            'accountsPayable': 1.0e9, 'otherCurrentLiab': 5.0e8}}]})
+        provider.record(symbol, 'cash', 'annual', {'cashflowStatementHistory': [{'2021-09-25': {
+            'totalCashFromOperatingActivities': 4.0e9 + i, 'capitalExpenditures': -1.0e9}}]})
+        provider.record(symbol, 'income', 'annual', {'incomeStatementHistory': [{'2021-09-25': {
+            'totalRevenue': 2.5e10 + i}}]})
+        provider.record(symbol, 'balance', 'quarterly', {'balanceSheetHistoryQuarterly': [{'2021-09-25': {
+            'totalAssets': 2.0e10 + i}}]})
+        provider.record(symbol, 'summary', None, {'beta': 1.1, 'trailingPE': 25.0, 'marketCap': 1.0e11})
+        provider.record(symbol, 'price', None, {'regularMarketPrice': 100.0 + i, 'marketCap': 1.0e11})
+        provider.record(symbol, 'profile', None, {'sector': 'Technology'})
+
+
+def _example(n_symbols = 120, batch_size = 50):
+    import os
+    import tempfile
+    from fundamentals_cache import FundamentalsCache, RecordedStatementProvider
+    from stock import Stock, Fundamentals
+
+    symbols = [f"S{i:03d}" for i in range(n_symbols)]
+    with tempfile.TemporaryDirectory() as path:
+        provider = RecordedStatementProvider(os.path.join(path, "recorded"))
+        _record_universe(provider, symbols)
+
+        # one symbol at a time: each statement and each quote is its own call
+        expected = {}
+        for symbol in symbols:
+            statements = {}
+            for statement_types, frequency in Stock(symbol, freq = 'annual').statement_groups():
+                for statement_type in statement_types:
+                    for code, data in provider.fetch(symbol, statement_type, frequency).items():
+                        statements.setdefault(code, {})[symbol] = data
+            quotes = {quote_type: provider.fetch_quotes([symbol], quote_type)[symbol]
+                      for quote_type in RequestPlanner.QUOTE_TYPES}
+            expected[symbol] = Fundamentals.from_payloads(symbol, statements, quotes['summary'],
+                                                          quotes['price']).as_dict()
+        per_symbol = provider.requests
+
+        cache = FundamentalsCache(os.path.join(path, "cache.sqlite"), provider)
+        planner = RequestPlanner(cache, batch_size = batch_size)
+        # a universe listing some symbols twice
+        stocks = [Stock(symbol, freq = 'annual') for symbol in symbols + symbols[:10]]
+        provider.requests = 0
+        failures = planner.load(stocks, workers = 4)
+        print(f"{n_symbols} symbols: {per_symbol} requests one symbol at a time, "
+              f"{provider.requests} planned in batches of {batch_size}")
+        assert(failures == [] and planner.requests == provider.requests)
+        assert(provider.requests == 5 * math.ceil(n_symbols / batch_size))
+        assert(all(stock.fundamentals().as_dict() == expected[stock.symbol] for stock in stocks))
+        assert(stocks[0].profile['sector'] == 'Technology' and stocks[0].fundamentals().ps_ratio == 4.0)
+
+        # statements in the cache are not requested again, only the quotes
+        provider.requests = 0
+        planner.load([Stock(symbol) for symbol in symbols])
+        assert(provider.requests == 3 * math.ceil(n_symbols / batch_size))
+
+        # a failing batch leaves its stocks unloaded and the others loaded
+        provider.forget(symbols[-1], 'price', None)
+        stocks = [Stock(symbol) for symbol in symbols]
+        failures = RequestPlanner(cache, batch_size = batch_size).load(stocks)
+        assert(len(failures) == 1 and isinstance(failures[0].error, KeyError))
+        assert(stocks[0].fundamentals_loaded and not stocks[-1].fundamentals_loaded)
+        cache.close()
+
+
+def _test():
+    _example()
+
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,295 @@
+import numpy as np
+
+
+class RootFindingError(Exception):
+    '''
+    Raised when a root cannot be bracketed or found and the caller asked for an exception
+    '''
+    pass
+
+
+class RootResult(object):
+    '''
+    Output of the solvers in this module, one entry per problem
+
+    root            the root, nan where the problem did not converge
+    converged       True where |f(root)| <= eps or the bracket shrank below xtol
+    bracketed       False where f had the same sign at both ends of the bracket
+    iterations      number of iterations spent on each problem
+    function_calls  number of evaluations of f spent on each problem
+    '''
+    def __init__(self, root, converged, bracketed, iterations, function_calls):
+        self.root = root
+        self.converged = converged
+        self.bracketed = bracketed
+        self.iterations = iterations
+        self.function_calls = function_calls
+
+    def failed(self):
+        '''
+        indices of the problems that did not converge
+        '''
+        return(np.flatnonzero(~self.converged))
+
+    def check(self):
+        '''
+        raise RootFindingError if any problem did not converge, otherwise return self
+        '''
+        n_unbracketed = int(np.sum(~self.bracketed))
+        n_failed = len(self.failed())
+        if n_unbracketed > 0:
+            raise RootFindingError("Function does not have opposite signs at interval endpoints "
+                                   "for {} of {} problems".format(n_unbracketed, len(self.root)))
+        if n_failed > 0:
+            raise RootFindingError("Root did not converge for {} of {} problems".format(n_failed, len(self.root)))
+        return(self)
+
+
+class _Solver(object):
+    '''
+    Book keeping shared by the solvers: the full size outputs and the index of the problems
+    still being worked on. f is always called as f(x, index) where index holds the positions
+    in the original arrays of the values in x, so callers can evaluate only the live problems.
+    '''
+    def __init__(self, f, n):
+        self.f = f
+        self.root = np.full(n, np.nan)
+        self.converged = np.zeros(n, dtype = bool)
+        self.bracketed = np.ones(n, dtype = bool)
+        self.iterations = np.zeros(n, dtype = np.int64)
+        self.function_calls = np.zeros(n, dtype = np.int64)
+        self.index = np.arange(n)
+
+    def evaluate(self, x, index = None):
+        index = self.index if index is None else index
+        self.function_calls[index] += 1
+        return(self.f(x, index))
+
+    def finish(self, done, x):
+        '''
+        record x as the root of the live problems flagged in done and drop them
+        returns the mask of the problems that are still live, to compress the caller's state
+        '''
+        self.root[self.index[done]] = x[done]
+        self.converged[self.index[done]] = True
+        keep = ~done
+        self.index = self.index[keep]
+        return(keep)
+
+    def result(self, raise_on_failure):
+        result = RootResult(self.root, self.converged, self.bracketed, self.iterations, self.function_calls)
+        if raise_on_failure:
+            result.check()
+        return(result)
+
+
+def _as_float_arrays(*values):
+    arrays = np.broadcast_arrays(*[np.asarray(v, dtype = np.float64) for v in values])
+    return([np.array(a, dtype = np.float64).ravel() for a in arrays])
+
+
+def _start_bracket(solver, lower, upper, eps):
+    '''
+    evaluate f at both ends, settle the problems with a root at an end point and
+    flag the ones without a sign change. Returns the live lower, upper, f(lower), f(upper)
+    '''
+    f_lower = solver.evaluate(lower)
+    f_upper = solver.evaluate(upper)
+
+    at_lower = np.abs(f_lower) <= eps
+    solver.root[at_lower] = lower[at_lower]
+    solver.converged[at_lower] = True
+    at_upper = ~at_lower & (np.abs(f_upper) <= eps)
+    solver.root[at_upper] = upper[at_upper]
+    solver.converged[at_upper] = True
+
+    unbracketed = ~at_lower & ~at_upper & (np.sign(f_lower) == np.sign(f_upper))
+    solver.bracketed[unbracketed] = False
+
+    keep = ~(at_lower | at_upper | unbracketed)
+    solver.index = solver.index[keep]
+    return(lower[keep], upper[keep], f_lower[keep], f_upper[keep])
+
+
+def bisection(f, lower, upper, eps = 1.0e-6, xtol = 0.0, max_iterations = 200, raise_on_failure = False):
+    '''
+    Vectorized bisection: solve f(x) = 0 for every pair of lower and upper at once
+
+    f is called as f(x, index), see _Solver. A problem is converged once |f(x)| <= eps or
+    the bracket is narrower than xtol. Problems that are not bracketed or run out of
+    iterations are reported in the RootResult, or raise RootFindingError if raise_on_failure
+    '''
+    lower, upper = _as_float_arrays(lower, upper)
+    solver = _Solver(f, len(lower))
+    x_L, x_R, f_L, f_R = _start_bracket(solver, lower, upper, eps)
+
+    for iteration in range(max_iterations):
+        if len(solver.index) == 0:
+            break
+        x_M = (x_L + x_R) / 2
+        f_M = solver.evaluate(x_M)
+        solver.iterations[solver.index] += 1
+
+        same_sign = np.sign(f_M) == np.sign(f_L)
+        x_L = np.where(same_sign, x_M, x_L)
+        f_L = np.where(same_sign, f_M, f_L)
+        x_R = np.where(same_sign, x_R, x_M)
+
+        keep = solver.finish((np.abs(f_M) <= eps) | (np.abs(x_R - x_L) <= xtol), x_M)
+        x_L, x_R, f_L = x_L[keep], x_R[keep], f_L[keep]
+
+    return(solver.result(raise_on_failure))
+
+
+def brent(f, lower, upper, eps = 0.0, xtol = 2.0e-12, rtol = 4.0 * np.finfo(float).eps,
+          max_iterations = 100, raise_on_failure = False):
+    '''
+    Vectorized Brent's method (the brentq variant: bisection, secant and inverse quadratic
+    interpolation) for every pair of lower and upper at once
+
+    f is called as f(x, index), see _Solver. A problem is converged once |f(x)| <= eps or
+    the bracket is narrower than xtol + rtol * |x|
+    '''
+    lower, upper = _as_float_arrays(lower, upper)
+    solver = _Solver(f, len(lower))
+    x_pre, x_cur, f_pre, f_cur = _start_bracket(solver, lower, upper, eps)
+    n = len(x_cur)
+    x_blk, f_blk = np.zeros(n), np.zeros(n)
+    s_pre, s_cur = np.zeros(n), np.zeros(n)
+
+    for iteration in range(max_iterations):
+        if len(solver.index) == 0:
+            break
+        solver.iterations[solver.index] += 1
+
+        # keep the root between x_cur and x_blk
+        new_bracket = (f_pre != 0) & (f_cur != 0) & (np.signbit(f_pre) != np.signbit(f_cur))
+        x_blk = np.where(new_bracket, x_pre, x_blk)
+        f_blk = np.where(new_bracket, f_pre, f_blk)
+        s_pre = np.where(new_bracket, x_cur - x_pre, s_pre)
+        s_cur = np.where(new_bracket, x_cur - x_pre, s_cur)
+
+        # make x_cur the best estimate so far
+        swap = np.abs(f_blk) < np.abs(f_cur)
+        x_pre = np.where(swap, x_cur, x_pre)
+        f_pre = np.where(swap, f_cur, f_pre)
+        x_cur, x_blk = np.where(swap, x_blk, x_cur), np.where(swap, x_cur, x_blk)
+        f_cur, f_blk = np.where(swap, f_blk, f_cur), np.where(swap, f_cur, f_blk)
+
+        delta = (xtol + rtol * np.abs(x_cur)) / 2
+        s_bis = (x_blk - x_cur) / 2
+        keep = solver.finish((np.abs(f_cur) <= eps) | (np.abs(s_bis) < delta), x_cur)
+        if not keep.all():
+            x_pre, x_cur, x_blk = x_pre[keep], x_cur[keep], x_blk[keep]
+            f_pre, f_cur, f_blk = f_pre[keep], f_cur[keep], f_blk[keep]
+            s_pre, s_cur, delta, s_bis = s_pre[keep], s_cur[keep], delta[keep], s_bis[keep]
+        if len(solver.index) == 0:
+            break
+
+        # try interpolation where the last steps were large enough and f is decreasing
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            secant = -f_cur * (x_cur - x_pre) / (f_cur - f_pre)
+            d_pre = (f_pre - f_cur) / (x_pre - x_cur)
+            d_blk = (f_blk - f_cur) / (x_blk - x_cur)
+            quadratic = -f_cur * (f_blk * d_blk - f_pre * d_pre) / (d_blk * d_pre * (f_blk - f_pre))
+            s_try = np.where(x_pre == x_blk, secant, quadratic)
+        interpolate = (np.abs(s_pre) > delta) & (np.abs(f_cur) < np.abs(f_pre))
+        accept = interpolate & np.isfinite(s_try) & \
+                 (2 * np.abs(s_try) < np.minimum(np.abs(s_pre), 3 * np.abs(s_bis) - delta))
+        s_pre = np.where(accept, s_cur, s_bis)
+        s_cur = np.where(accept, s_try, s_bis)
+
+        x_pre, f_pre = x_cur, f_cur
+        x_cur = x_cur + np.where(np.abs(s_cur) > delta, s_cur, np.where(s_bis > 0, delta, -delta))
+        f_cur = solver.evaluate(x_cur)
+
+    return(solver.result(raise_on_failure))
+
+
+def newton(f, fprime, x0, lower = None, upper = None, eps = 1.0e-6, xtol = 0.0,
+           max_iterations = 100, raise_on_failure = False):
+    '''
+    Vectorized Newton's method for every starting point in x0 at once
+
+    fprime is the derivative hook, called like f as fprime(x, index). If fprime is True,
+    f returns the tuple (f(x), f'(x)) instead, for functions that get both from one pass.
+    If lower and upper are given the method is safeguarded: each problem keeps a bracket
+    and any step leaving it, or a zero derivative, is replaced by a bisection step.
+    A problem is converged once |f(x)| <= eps or the step is smaller than xtol
+    '''
+    if fprime is True:
+        evaluate = lambda x, index: f(x, index)
+    else:
+        evaluate = lambda x, index: (f(x, index), fprime(x, index))
+    safeguarded = lower is not None or upper is not None
+
+    if safeguarded:
+        lower = -np.inf if lower is None else lower
+        upper = np.inf if upper is None else upper
+        x0, lower, upper = _as_float_arrays(x0, lower, upper)
+        solver = _Solver(lambda x, index: evaluate(x, index)[0], len(x0))
+        x0 = np.clip(x0, lower, upper)
+        lo, hi, f_lo, f_hi = _start_bracket(solver, lower, upper, eps)
+        x = x0[solver.index]
+        sign_lo = np.sign(f_lo)
+    else:
+        (x0,) = _as_float_arrays(x0)
+        solver = _Solver(None, len(x0))
+        x = x0
+
+    for iteration in range(max_iterations):
+        if len(solver.index) == 0:
+            break
+        solver.function_calls[solver.index] += 1
+        solver.iterations[solver.index] += 1
+        f_x, fprime_x = evaluate(x, solver.index)
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            step = x - f_x / fprime_x
+        if safeguarded:
+            below = np.sign(f_x) == sign_lo
+            lo = np.where(below, x, lo)
+            hi = np.where(below, hi, x)
+            inside = np.isfinite(step) & (step > np.minimum(lo, hi)) & (step < np.maximum(lo, hi))
+            step = np.where(inside, step, (lo + hi) / 2)
+
+        done = (np.abs(f_x) <= eps) | (np.abs(step - x) <= xtol)
+        if safeguarded:
+            done |= np.abs(hi - lo) <= xtol
+        keep = solver.finish(done, x)
+        x = step[keep]
+        if safeguarded:
+            lo, hi, sign_lo = lo[keep], hi[keep], sign_lo[keep]
+
+    return(solver.result(raise_on_failure))
+
+
+def _test():
+    # a few problems at once: x**2 = target, the last one bracketed on the wrong side
+    target = np.array([9.0, 2.0, 1.0e4, 0.25, 4.0])
+    lower = np.array([0.0, 0.0, 0.0, 0.0, 3.0])
+    upper = np.array([1000.0, 1000.0, 1000.0, 1000.0, 1000.0])
+
+    def f(x, index):
+        return(x**2 - target[index])
+
+    def fprime(x, index):
+        return(2 * x)
+
+    for name, result in [("bisection", bisection(f, lower, upper, eps = 1.0e-6)),
+                         ("brent", brent(f, lower, upper)),
+                         ("newton", newton(f, fprime, 1.0, lower, upper))]:
+        print(name, "roots:", result.root)
+        print(name, "iterations:", result.iterations, "function calls:", result.function_calls)
+        assert(np.allclose(result.root[:4], np.sqrt(target[:4]), atol = 1.0e-6))
+        assert(list(result.failed()) == [4] and not result.bracketed[4])
+
+    try:
+        bisection(f, lower, upper, raise_on_failure = True)
+        assert(False)
+    except RootFindingError as e:
+        print("Expected error:", e)
+
+
+if __name__ == "__main__":
+    _test()
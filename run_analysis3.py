@@ -4,11 +4,62 @@ import datetime
 
 from stock import Stock
 from DCF_model import DiscountedCashFlowModel
-from TA import SimpleMovingAverages
-from TA import ExponentialMovingAverages
-from TA import RSI
+from indicator_pipeline import IndicatorPipeline
+from fetch_stage import FetchStage, TokenBucket
+from price_store import get_default_store
+from fundamentals_cache import get_default_cache
+from checkpointed_output import CheckpointedOutput
+from request_planner import RequestPlanner
 
-def run():
+
+OUTPUT_COLUMNS = ['Symbol',
+                  'EPS Next 5Y in percent',
+                  'DCF value',
+                  'Current Price',
+                  'Sector',
+                  'Market Cap',
+                  'Beta',
+                  'Total Assets',
+                  'Total Debt',
+                  'Free Cash Flow',
+                  'P/E Ratio',
+                  'P/S Ratio',
+                  'RSI',
+                  '10 Day EMA',
+                  '20 day SMA',
+                  '50 day SMA',
+                  '200 day SMA']
+
+
+def fetch_symbol_requests(stock):
+    '''
+    Yahoo requests fetch_symbol makes for stock: the prices, plus when the fundamentals are not
+    loaded yet the summary and price data and one per statement not in the FundamentalsCache
+    (which fetches each statement type on its own), plus the profile when it is not loaded
+    '''
+    requests = 1
+    if not stock.fundamentals_loaded:
+        cache = stock.yfinancial.fundamentals_cache or get_default_cache()
+        requests += 2 + sum(cache.peek(stock.yfinancial.ticker, statement_type, frequency) is None
+                            for statement_types, frequency in stock.statement_groups()
+                            for statement_type in statement_types)
+    if not stock.profile:
+        requests += 1
+    return(requests)
+
+
+def fetch_symbol(stock, start_date = '2020-01-1', end_date = '2021-12-1'):
+    '''
+    everything the report needs from Yahoo for one stock: prices, and the fundamentals and
+    sector unless a RequestPlanner already loaded them
+    '''
+    stock.get_daily_hist_price(start_date, end_date)
+    stock.fundamentals()
+    sector = stock.profile['sector'] if stock.profile else yf.Ticker(stock.symbol).info['sector']
+    return(stock, sector)
+
+
+def run(workers = 8, requests_per_second = 4, retries = 3, flush_every = 25, batch_size = 50):
     ''' 
     Read in the input file. 
     Call the DCF to compute its DCF value and add the following columns to the output file.
@@ -32,6 +83,17 @@ def run():
     50 day SMA
     200 day SMA
 
+    The symbols are fetched concurrently by workers threads, at most requests_per_second
+    Yahoo requests per second with retries on errors; a symbol that still fails is reported
+    and skipped, the computations run as the fetches come in. The statements, summary, price
+    and profile data of all the symbols are first loaded by a RequestPlanner in multi-ticker
+    requests of batch_size symbols, so the per symbol fetches are down to the prices. Every
+    fetch is charged the requests it makes (see fetch_symbol_requests), one per symbol of a
+    multi-ticker request.
+
+    Each row is appended to the output as soon as it is computed, with a checkpoint every
+    flush_every rows (see CheckpointedOutput): a rerun for the same as-of date skips the
+    symbols already in the output with unchanged inputs, failed symbols are tried again.
     '''
     input_fname = "StockUniverse.csv"
     output_fname = "StockUniverseOutput.csv"
@@ -39,114 +101,103 @@ def run():
     
     as_of_date = datetime.date(2021, 12, 1)
     df = pd.read_csv(input_fname)
-    out_df = pd.read_csv(output_fname)
-    results = []
-    for index, row in df.iterrows():
-        
-        stock = Stock(row['Symbol'], 'annual')
-        model = DiscountedCashFlowModel(stock, as_of_date)
-        
-        stock.get_daily_hist_price('2020-01-1', '2021-12-1')
+    # the report's indicators as of the run date, from the trailing prices they need
+    indicator_specs = ['RSI14', 'EMA10', 'SMA20', 'SMA50', 'SMA200']
+    indicators = IndicatorPipeline(indicator_specs)
+    output = CheckpointedOutput(output_fname, OUTPUT_COLUMNS, flush_every = flush_every,
+                                run_key = {'as_of_date': as_of_date, 'indicators': indicator_specs}).open()
+    todo = [not output.done(row['Symbol'], row.to_dict()) for index, row in df.iterrows()]
+    print(f"{len(df) - sum(todo)} symbols already done")
+    df = df[todo]
+    # shared by the fetch threads, created once up front
+    get_default_store()
+    get_default_cache()
+    rate_limiter = TokenBucket(requests_per_second)
+    stocks = {symbol: Stock(symbol, freq = 'annual') for symbol in df['Symbol']}
+    planner = RequestPlanner(batch_size = batch_size)
+    for failure in planner.load(list(stocks.values()), workers = workers, rate_limiter = rate_limiter,
+                                retries = retries):
+        print(f"Batch request failed, its symbols are fetched one by one: {failure.error!r}")
+    print(f"Fundamentals of {len(stocks)} symbols in {planner.requests} requests")
+    stage = FetchStage(lambda symbol: fetch_symbol(stocks[symbol]), workers = workers, retries = retries,
+                       rate_limiter = rate_limiter,
+                       tokens_per_fetch = lambda symbol: fetch_symbol_requests(stocks[symbol]))
+    try:
+        for (index, row), fetched in zip(df.iterrows(), stage.run(df['Symbol'])):
+            if fetched.error is not None:
+                print(f"Skipping {fetched.symbol} after {fetched.attempts} attempts: {fetched.error!r}")
+                continue
+            stock, sector = fetched.value
+            model = DiscountedCashFlowModel(stock, as_of_date)
 
-        periods = [9, 10, 20, 50, 100, 200]
-        smas = SimpleMovingAverages(stock.ohlcv_df, periods)
-        emas = ExponentialMovingAverages(stock.ohlcv_df, periods)
-    
-        emas.run()
-        smas.run()
-    
-        e10 = emas.get_series(10)
-        date = '2021-12-1'
-        
-        s200 = smas.get_series(200)
-        s50 = smas.get_series(50)
-        s20 = smas.get_series(20)        
-        
-        sbux = yf.Ticker(stock.symbol)
+            date = '2021-12-1'
+            values = indicators.evaluate(stock.ohlcv_df, date)
         
-        balance = stock.yfinancial.get_financial_stmts('quarterly', 'balance')
-        balance = balance.get('balanceSheetHistoryQuarterly').get(stock.symbol)[0]
-        key = list(balance.keys())[0]
-        total_assets = balance.get(key).get('totalAssets')
+            fundamentals = stock.fundamentals()
+            total_assets = fundamentals.total_assets
         
-        relative_strength_index = RSI(stock.ohlcv_df, 14)       
-        relative_strength_index.run()
-        rsi = relative_strength_index.rsi.loc[date]
+            rsi = values['RSI14']
         
-        short_term_growth_rate = float(row['EPS Next 5Y in percent'])/100
-        medium_term_growth_rate = short_term_growth_rate/2
-        long_term_growth_rate = 0.04
+            short_term_growth_rate = float(row['EPS Next 5Y in percent'])/100
+            medium_term_growth_rate = short_term_growth_rate/2
+            long_term_growth_rate = 0.04
         
-        model.set_FCC_growth_rate(short_term_growth_rate, medium_term_growth_rate, long_term_growth_rate)
-        print(stock.symbol)
-        fair_value = model.calc_fair_value()
-        free_cashflow = stock.get_free_cashflow()
-        beta = stock.get_beta()
-        market_cap = stock.yfinancial.get_market_cap()
-        p_e_ratio = stock.yfinancial.get_pe_ratio()
-        p_s_ratio = stock.yfinancial.get_price_to_sales()
-        total_debt = stock.get_total_debt()
-        current_price = stock.yfinancial.get_current_price()
-        sector = sbux.info['sector']
-        print(f'The fair value is {fair_value}')
-        print(f"Free Cash Flow for {stock.symbol} is {free_cashflow}")
-        print(f'The beta is {beta}')
-        print(f'The market cap is {market_cap}')
-        print(f'The P/E ratio is {p_e_ratio}')
-        print(f'The P/S ratio is {p_s_ratio}')
-        print(f'The total debt is {total_debt}')
-        print(f'The current price is {current_price}')
-        print(f'The sector is {sector}')
-        print(f'The 10 day EMA is {e10[date]}')
-        print(f'The 200 day SMA is {s200[date]}')
-        print(f'The 50 day SMA is {s50[date]}')
-        print(f'The 20 day SMA is {s20[date]}')
-        print(f'The total assets is {total_assets}')
-        print(f'The RSI is {rsi}')
+            model.set_FCC_growth_rate(short_term_growth_rate, medium_term_growth_rate, long_term_growth_rate)
+            print(stock.symbol)
+            try:
+                fair_value = model.calc_fair_value()
+            except Exception as e:
+                # e.g. a statement without the line items the DCF needs
+                print(f"Skipping {stock.symbol}: {e}")
+                continue
+            free_cashflow = fundamentals.free_cashflow
+            beta = fundamentals.beta
+            market_cap = fundamentals.market_cap
+            p_e_ratio = fundamentals.pe_ratio
+            p_s_ratio = fundamentals.ps_ratio
+            total_debt = fundamentals.total_debt
+            current_price = fundamentals.current_price
+            print(f'The fair value is {fair_value}')
+            print(f"Free Cash Flow for {stock.symbol} is {free_cashflow}")
+            print(f'The beta is {beta}')
+            print(f'The market cap is {market_cap}')
+            print(f'The P/E ratio is {p_e_ratio}')
+            print(f'The P/S ratio is {p_s_ratio}')
+            print(f'The total debt is {total_debt}')
+            print(f'The current price is {current_price}')
+            print(f'The sector is {sector}')
+            print(f'The 10 day EMA is {values["EMA10"]}')
+            print(f'The 200 day SMA is {values["SMA200"]}')
+            print(f'The 50 day SMA is {values["SMA50"]}')
+            print(f'The 20 day SMA is {values["SMA20"]}')
+            print(f'The total assets is {total_assets}')
+            print(f'The RSI is {rsi}')
         
-        results.append([row['Symbol'], 
-                        row['EPS Next 5Y in percent'],
-                        fair_value,
-                        current_price,
-                        sector,
-                        market_cap,
-                        beta,
-                        total_assets,
-                        total_debt,
-                        free_cashflow,
-                        p_e_ratio,
-                        p_s_ratio,
-                        rsi,
-                        e10[date],
-                        s20[date],
-                        s50[date],
-                        s200[date]])
-        # pull additional fields
-        # ...
-    
+            output.write(row['Symbol'], row.to_dict(),
+                         [row['Symbol'], 
+                          row['EPS Next 5Y in percent'],
+                          fair_value,
+                          current_price,
+                          sector,
+                          market_cap,
+                          beta,
+                          total_assets,
+                          total_debt,
+                          free_cashflow,
+                          p_e_ratio,
+                          p_s_ratio,
+                          rsi,
+                          values['EMA10'],
+                          values['SMA20'],
+                          values['SMA50'],
+                          values['SMA200']])
+            # pull additional fields
+            # ...
+    finally:
+        # rows written so far are kept even when a symbol's computation raises
+        output.close()
     print('Done')
-    output_df = pd.DataFrame(results, columns = ['Symbol', 
-                                                 'EPS Next 5Y in percent',
-                                                 'DCF value',
-                                                 'Current Price',
-                                                 'Sector',
-                                                 'Market Cap',
-                                                 'Beta',
-                                                 'Total Assets',
-                                                 'Total Debt',
-                                                 'Free Cash Flow',
-                                                 'P/E Ratio',
-                                                 'P/S Ratio',
-                                                 'RSI',
-                                                 '10 Day EMA',
-                                                 '20 day SMA',
-                                                 '50 day SMA',
-                                                 '200 day SMA'])
-    print(output_df)
-    output_df.to_csv(output_fname, index = False)
-    # save the output into a StockUniverseOutput.csv file
-    
-    # ....
+    print(pd.read_csv(output_fname))
 
     
 if __name__ == "__main__":
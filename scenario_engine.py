@@ -0,0 +1,272 @@
+import time
+import numpy as np
+
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+from bond import Bond, DayCount, PaymentFrequency
+from bond_portfolio import BondPortfolio
+from yield_curve import ZeroCurve, bootstrap_zero_curve
+
+
+DEFAULT_KEY_RATE_TENORS = [0.25, 0.5, 1, 2, 3, 5, 7, 10, 20, 30]
+
+
+def parallel_shifts(shifts, tenors = DEFAULT_KEY_RATE_TENORS):
+    '''
+    scenario matrix moving every key rate by each of shifts (decimal, eg 0.0001 for 1bp)
+    '''
+    return(np.outer(shifts, np.ones(len(tenors))))
+
+
+def twists(amounts, tenors = DEFAULT_KEY_RATE_TENORS, pivot = 5):
+    '''
+    scenario matrix steepening the curve by each of amounts between the shortest and the
+    longest key rate, pivoting around the pivot tenor (negative amounts flatten)
+    '''
+    tenors = np.asarray(tenors, dtype = np.float64)
+    slope = (tenors - pivot) / (tenors[-1] - tenors[0])
+    return(np.outer(amounts, slope))
+
+
+def key_rate_bumps(bump = 0.0001, tenors = DEFAULT_KEY_RATE_TENORS):
+    '''
+    scenario matrix bumping one key rate at a time by bump
+    '''
+    return(bump * np.eye(len(tenors)))
+
+
+def key_rate_weights(times, tenors):
+    '''
+    weight of each key rate in the shock at times, shape times.shape + (len(tenors),)
+    the shock is interpolated linearly between key rates and flat beyond the first and last
+    '''
+    times = np.asarray(times, dtype = np.float64)
+    identity = np.eye(len(tenors))
+    return(np.stack([np.interp(times, tenors, identity[k]) for k in range(len(tenors))], axis = -1))
+
+
+def _price_chunk(present_values, group_bounds, group_times, tenors, scenarios, quantities = None):
+    '''
+    P&L of a block of bonds under a block of scenarios
+
+    present_values are the base present values of the cash flows of the bonds (bonds x periods),
+    sorted so that bonds sharing payment times are contiguous: group g covers the rows
+    group_bounds[g] to group_bounds[g + 1] and pays at group_times[g]. A scenario shifts the
+    continuously compounded zero rate at time t by the key rate shock interpolated at t.
+    Returns (scenarios x bonds) P&L, or the quantity weighted book P&L per scenario
+    '''
+    n_scenarios = len(scenarios)
+    n_bonds = present_values.shape[0]
+    result = np.empty((n_scenarios, n_bonds)) if quantities is None else np.zeros(n_scenarios)
+    for g in range(len(group_times)):
+        start, end = group_bounds[g], group_bounds[g + 1]
+        shock = scenarios @ key_rate_weights(group_times[g], tenors).T
+        growth = np.expm1(-shock * group_times[g])
+        pnl = growth @ present_values[start:end].T
+        if quantities is None:
+            result[:, start:end] = pnl
+        else:
+            result += pnl @ quantities[start:end]
+    return(result)
+
+
+def _price_chunk_star(args):
+    return(_price_chunk(*args))
+
+
+class ScenarioResult(object):
+    '''
+    Output of ScenarioEngine.run
+
+    book_pnl                    quantity weighted P&L of the book per scenario
+    base_prices                 price of each bond in the base scenario
+    key_rate_durations          (bonds x key rates) key rate durations of each bond
+    book_key_rate_durations     key rate durations of the book
+    '''
+    def __init__(self, book_pnl, base_prices, key_rate_durations, book_key_rate_durations):
+        self.book_pnl = book_pnl
+        self.base_prices = base_prices
+        self.key_rate_durations = key_rate_durations
+        self.book_key_rate_durations = book_key_rate_durations
+
+
+class ScenarioEngine(object):
+    '''
+    Reprice a book of bonds under many zero rate scenarios
+
+    base is either a ZeroCurve or the yields of the bonds (a scalar or one per bond, with the
+    BondCalculator compounding). A scenario is a row of shocks to the key rates at tenors, and
+    the shock to the zero rate at any time is interpolated between them. Results are streamed
+    in blocks of at most max_chunk_elements (scenario, bond) pairs, optionally computed on a
+    process pool, so memory stays bounded whatever the number of scenarios and bonds.
+    '''
+    def __init__(self, bonds, base, tenors = DEFAULT_KEY_RATE_TENORS, quantities = None):
+        portfolio = bonds if isinstance(bonds, BondPortfolio) else BondPortfolio(bonds)
+        self.portfolio = portfolio
+        self.tenors = np.asarray(tenors, dtype = np.float64)
+        n_bonds = len(portfolio)
+        n_cols = len(portfolio.active_rows)
+
+        # base present value of each cash flow, in the portfolio's sorted row order
+        if isinstance(base, ZeroCurve):
+            discount_factors = base.discount_factor(portfolio.group_times)[portfolio.time_group]
+        else:
+            periods_per_year = portfolio.to_sorted(portfolio.periods_per_year)
+            one_period_factor = 1 / (1 + (portfolio.to_sorted(base) / periods_per_year))
+            discount_factors = one_period_factor[:, np.newaxis] ** np.arange(1, n_cols + 1)
+        present_values = portfolio.cash_flows * discount_factors
+
+        # regroup the rows so that bonds paying at the same times are contiguous
+        self._order = np.argsort(portfolio.time_group, kind = 'stable')
+        self._present_values = np.ascontiguousarray(present_values[self._order])
+        groups = portfolio.time_group[self._order]
+        self._group_bounds = np.searchsorted(groups, np.arange(len(portfolio.group_times) + 1))
+        self._group_times = portfolio.group_times
+        self._bond_index = portfolio._order[self._order]
+
+        quantities = np.ones(n_bonds) if quantities is None else np.asarray(quantities, dtype = np.float64)
+        self._quantities = quantities[self._bond_index]
+        self.base_prices = self._present_values.sum(axis = 1)
+
+    def _chunks(self, scenarios, max_chunk_elements, quantities):
+        '''
+        work items of _price_chunk: bond blocks made of whole groups, times scenario blocks
+        '''
+        n_bonds = len(self._present_values)
+        bonds_per_chunk = max(1, min(n_bonds, max_chunk_elements // max(1, min(len(scenarios), 1024))))
+        scenarios_per_chunk = max(1, max_chunk_elements // bonds_per_chunk)
+
+        # cut the bonds at group boundaries, splitting only the groups larger than a block
+        cuts = [0]
+        for g in range(len(self._group_times)):
+            start, end = self._group_bounds[g], self._group_bounds[g + 1]
+            if end - cuts[-1] > bonds_per_chunk and start > cuts[-1]:
+                cuts.append(start)
+            while end - cuts[-1] > bonds_per_chunk:
+                cuts.append(cuts[-1] + bonds_per_chunk)
+        if cuts[-1] < n_bonds:
+            cuts.append(n_bonds)
+
+        for s in range(0, len(scenarios), scenarios_per_chunk):
+            scenario_slice = slice(s, min(s + scenarios_per_chunk, len(scenarios)))
+            for lo, hi in zip(cuts[:-1], cuts[1:]):
+                g_lo = np.searchsorted(self._group_bounds, lo, side = 'right') - 1
+                g_hi = np.searchsorted(self._group_bounds, hi, side = 'left')
+                bounds = np.clip(self._group_bounds[g_lo:g_hi + 1], lo, hi) - lo
+                args = (self._present_values[lo:hi], bounds, self._group_times[g_lo:g_hi], self.tenors,
+                        scenarios[scenario_slice], None if quantities is None else quantities[lo:hi])
+                yield(scenario_slice, slice(lo, hi), args)
+
+    def _map(self, chunks, n_workers):
+        if n_workers is None or n_workers <= 1:
+            for scenario_slice, bond_slice, args in chunks:
+                yield(scenario_slice, bond_slice, _price_chunk(*args))
+            return
+
+        # keep a bounded number of blocks in flight so the results stay memory bounded
+        with ProcessPoolExecutor(n_workers) as executor:
+            pending = []
+            for chunk in chunks:
+                pending.append((chunk[0], chunk[1], executor.submit(_price_chunk_star, chunk[2])))
+                if len(pending) >= 2 * n_workers:
+                    scenario_slice, bond_slice, future = pending.pop(0)
+                    yield(scenario_slice, bond_slice, future.result())
+            for scenario_slice, bond_slice, future in pending:
+                yield(scenario_slice, bond_slice, future.result())
+
+    def iter_pnl(self, scenarios, max_chunk_elements = 2**22, n_workers = None):
+        '''
+        stream the (scenarios x bonds) P&L matrix in blocks
+        yields (scenario slice, indices of the bonds in the input order, P&L block)
+        '''
+        scenarios = np.atleast_2d(np.asarray(scenarios, dtype = np.float64))
+        for scenario_slice, bond_slice, pnl in self._map(self._chunks(scenarios, max_chunk_elements, None),
+                                                         n_workers):
+            yield(scenario_slice, self._bond_index[bond_slice], pnl)
+
+    def key_rate_durations(self):
+        '''
+        (bonds x key rates) key rate durations, -dP/dshock / P, in the input bond order
+        '''
+        result = np.empty((len(self._present_values), len(self.tenors)))
+        for g in range(len(self._group_times)):
+            start, end = self._group_bounds[g], self._group_bounds[g + 1]
+            weights = key_rate_weights(self._group_times[g], self.tenors)
+            result[start:end] = (self._present_values[start:end] * self._group_times[g]) @ weights
+        result /= self.base_prices[:, np.newaxis]
+        return(result[np.argsort(self._bond_index)])
+
+    def run(self, scenarios, max_chunk_elements = 2**22, n_workers = None):
+        '''
+        quantity weighted book P&L for every scenario, with the key rate durations
+        '''
+        scenarios = np.atleast_2d(np.asarray(scenarios, dtype = np.float64))
+        book_pnl = np.zeros(len(scenarios))
+        chunks = self._chunks(scenarios, max_chunk_elements, self._quantities)
+        for scenario_slice, bond_slice, pnl in self._map(chunks, n_workers):
+            book_pnl[scenario_slice] += pnl
+
+        key_rate_durations = self.key_rate_durations()
+        base_prices = self.base_prices[np.argsort(self._bond_index)]
+        quantities = self._quantities[np.argsort(self._bond_index)]
+        book_value = quantities @ base_prices
+        book_key_rate_durations = (quantities * base_prices) @ key_rate_durations / book_value
+        return(ScenarioResult(book_pnl, base_prices, key_rate_durations, book_key_rate_durations))
+
+
+def _book(n_bonds):
+    # distinct Bond objects: issue dates over ten years, terms, frequencies and coupons vary
+    return([Bond(date(2011, 1, 1) + timedelta(days = i % 3650), term = 1 + i % 30, day_count = DayCount.DAYCOUNT_30360,
+                 payment_freq = [PaymentFrequency.ANNUAL, PaymentFrequency.SEMIANNUAL,
+                                 PaymentFrequency.QUARTERLY][i // 30 % 3], coupon = 0.0001 * (i % 997))
+            for i in range(n_bonds)])
+
+
+def _example():
+    bonds = _book(1000)
+    curve = bootstrap_zero_curve([Bond(date(2021, 1, 1), term = t, day_count = DayCount.DAYCOUNT_30360,
+                                       payment_freq = PaymentFrequency.SEMIANNUAL, coupon = 0.01 + 0.001 * t)
+                                  for t in [1, 2, 3, 5, 7, 10, 20, 30]])
+    engine = ScenarioEngine(bonds, curve)
+    scenarios = np.vstack([parallel_shifts([-0.01, 0.0, 0.01]), twists([0.005]), key_rate_bumps()])
+
+    result = engine.run(scenarios, max_chunk_elements = 5000)
+    print("Book P&L for -100bp, 0, +100bp:", result.book_pnl[:3])
+    print("Book key rate durations:", np.round(result.book_key_rate_durations, 4))
+
+    # the streamed per bond P&L adds up to the book P&L and matches a full reprice
+    book_pnl = np.zeros(len(scenarios))
+    for scenario_slice, bond_index, pnl in engine.iter_pnl(scenarios, max_chunk_elements = 5000):
+        book_pnl[scenario_slice] += pnl.sum(axis = 1)
+    assert(np.allclose(book_pnl, result.book_pnl))
+    shifted = ZeroCurve(curve.times[1:], curve.discount_factor(curve.times[1:]) * np.exp(-0.01 * curve.times[1:]))
+    assert(abs(result.book_pnl[2] - (shifted.price(bonds) - curve.price(bonds)).sum()) < 1e-6)
+
+    # sum of the key rate durations is the duration to a parallel shift
+    bumped = engine.run(parallel_shifts([0.0001, -0.0001])).book_pnl
+    duration = -(bumped[0] - bumped[1]) / 0.0002 / result.base_prices.sum()
+    assert(abs(duration - result.book_key_rate_durations.sum()) < 1e-4)
+
+
+def _benchmark(n_scenarios = 10000, n_bonds = 100000, n_workers = 4):
+    bonds = _book(n_bonds)
+    engine = ScenarioEngine(bonds, 0.03)
+    print(f"{n_bonds} distinct bonds in {len(engine._group_times)} payment time groups")
+    rng = np.random.default_rng(0)
+    scenarios = rng.normal(0, 0.005, (n_scenarios, len(DEFAULT_KEY_RATE_TENORS)))
+
+    start = time.perf_counter()
+    result = engine.run(scenarios, n_workers = n_workers)
+    elapsed = time.perf_counter() - start
+    print(f"{n_scenarios} scenarios x {n_bonds} bonds on {n_workers} workers: {elapsed:.1f}s, "
+          f"P&L 5%-quantile {np.quantile(result.book_pnl, 0.05):.0f}")
+
+
+def _test():
+    _example()
+    #_benchmark()
+
+
+if __name__ == "__main__":
+    _test()
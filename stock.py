@@ -3,7 +3,6 @@ import calendar
 import math
 import pandas as pd
 import numpy as np
-import pandas_datareader.data as web
 
 import datetime
 from scipy.stats import norm
@@ -11,29 +10,135 @@ from scipy.stats import norm
 from math import log, exp, sqrt
 
 from utils import MyYahooFinancials
+from price_store import get_default_store
+
+
+def _latest_statement(statements, statement_code, symbol):
+    '''
+    line items of the most recent statement of symbol in a get_financial_stmts payload,
+    an empty dict when there is none
+    '''
+    history = (statements.get(statement_code) or {}).get(symbol) or []
+    if len(history) == 0:
+        return {}
+    return next(iter(history[0].values())) or {}
+
+
+class Fundamentals(object):
+    '''
+    Snapshot of the fundamentals used by the DCF model and the analysis report, parsed once
+    from the statement, summary and price payloads of one symbol (see Stock.fundamentals)
+
+    every field is a float, or None when the data is not available. Line items missing from
+    a statement are listed in missing. A missing capital expenditure, short term investment,
+    long term debt, account payable or other current liability counts as zero in the derived
+    fields; a missing operating cash flow, cash or total current liabilities makes the
+    derived field None.
+    '''
+    FIELDS = ('operating_cashflow', 'capital_expenditures', 'free_cashflow',
+              'cash', 'short_term_investments', 'cash_and_cash_equivalent',
+              'long_term_debt', 'total_current_liabilities', 'account_payable', 'other_current_liabilities',
+              'total_debt', 'total_assets',
+              'current_price', 'market_cap', 'shares_outstanding', 'beta', 'pe_ratio', 'ps_ratio')
+
+    __slots__ = ('symbol', 'missing') + FIELDS
+
+    def __init__(self, symbol, missing = (), **values):
+        self.symbol = symbol
+        self.missing = tuple(missing)
+        for field in self.FIELDS:
+            value = values.get(field)
+            setattr(self, field, None if value is None else float(value))
+
+    @classmethod
+    def from_payloads(cls, symbol, statements, summary, price, frequency = 'annual'):
+        '''
+        statements holds the get_financial_stmts payloads of the Stock.statement_groups of the
+        stock merged into one {statement code: {symbol: history}} dict: the balance sheet and
+        cash flow statement at frequency, the quarterly balance sheet (for total assets) and the
+        annual income statement (for the revenue). summary and price are the per symbol
+        summaryDetail and price dicts.
+
+        market_cap, pe_ratio and ps_ratio are YahooFinancials' get_market_cap, get_pe_ratio
+        and get_price_to_sales: the summary marketCap, the summary trailingPE, and marketCap
+        over the annual total revenue
+        '''
+        suffix = 'Quarterly' if frequency == 'quarterly' else ''
+        balance = _latest_statement(statements, 'balanceSheetHistory' + suffix, symbol)
+        cash_flow = _latest_statement(statements, 'cashflowStatementHistory' + suffix, symbol)
+        quarterly = _latest_statement(statements, 'balanceSheetHistoryQuarterly', symbol)
+        income = _latest_statement(statements, 'incomeStatementHistory', symbol)
+        summary = summary or {}
+        price = price or {}
+
+        missing = []
+        def item(statement, name, field):
+            value = statement.get(name)
+            if value is None:
+                missing.append(field)
+            return value
+
+        values = {
+            'operating_cashflow': item(cash_flow, 'totalCashFromOperatingActivities', 'operating_cashflow'),
+            'capital_expenditures': item(cash_flow, 'capitalExpenditures', 'capital_expenditures'),
+            'cash': item(balance, 'cash', 'cash'),
+            'short_term_investments': item(balance, 'shortTermInvestments', 'short_term_investments'),
+            'long_term_debt': item(balance, 'longTermDebt', 'long_term_debt'),
+            'total_current_liabilities': item(balance, 'totalCurrentLiabilities', 'total_current_liabilities'),
+            'account_payable': item(balance, 'accountsPayable', 'account_payable'),
+            'other_current_liabilities': item(balance, 'otherCurrentLiab', 'other_current_liabilities'),
+            'total_assets': item(quarterly, 'totalAssets', 'total_assets'),
+            'current_price': price.get('regularMarketPrice'),
+            'market_cap': summary.get('marketCap'),
+            'beta': summary.get('beta'),
+            'pe_ratio': summary.get('trailingPE'),
+        }
+        revenue = income.get('totalRevenue')
+
+        zero = lambda field: values[field] or 0
+        if values['operating_cashflow'] is not None:
+            values['free_cashflow'] = values['operating_cashflow'] + zero('capital_expenditures')
+        if values['cash'] is not None:
+            values['cash_and_cash_equivalent'] = values['cash'] + zero('short_term_investments')
+        if values['total_current_liabilities'] is not None:
+            values['total_debt'] = zero('long_term_debt') + (values['total_current_liabilities']
+                                                             - zero('account_payable')
+                                                             - zero('other_current_liabilities'))
+        if values['market_cap'] is not None and revenue:
+            values['ps_ratio'] = values['market_cap'] / revenue
+        # as YahooFinancials.get_num_shares_outstanding: market cap over the current price
+        if values['market_cap'] is not None and values['current_price']:
+            values['shares_outstanding'] = values['market_cap'] / values['current_price']
+        return cls(symbol, missing, **values)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
 
 
 class Stock(object):
     '''
     Stock class for getting financial statements as well as pricing data
     '''
-    def __init__(self, symbol, spot_price = None, sigma = None, dividend_yield = 0, freq = 'annual'):
+    def __init__(self, symbol, spot_price = None, sigma = None, dividend_yield = 0, freq = 'annual',
+                 price_store = None):
         self.symbol = symbol
         self.spot_price = spot_price
         self.sigma = sigma
         self.dividend_yield = dividend_yield
         self.yfinancial = MyYahooFinancials(symbol, freq)
+        self.price_store = price_store
         self.ohlcv_df = None
+        self.profile = None
+        self._fundamentals = None
 
     def get_daily_hist_price(self, start_date, end_date):
         '''
-        Get daily historical OHLCV pricing dataframe
+        Get daily historical OHLCV pricing dataframe, through the PriceStore (by default the
+        shared one of price_store) so only the dates not stored yet are downloaded
         '''
-        data = self.yfinancial.get_historical_price_data(start_date, end_date, 'daily')
-        # create a OHLCV data frame
-        df = web.DataReader(self.symbol, 'yahoo', start_date, end_date)
-        self.ohlcv_df = df
-        return data
+        store = get_default_store() if self.price_store is None else self.price_store
+        self.ohlcv_df = store.load(self.symbol, start_date, end_date)
+        return self.ohlcv_df
         
     def calc_returns(self):
         '''
@@ -43,59 +148,77 @@ class Stock(object):
                                         self.ohlcv_df['prev_close']
 
     # financial statements related methods
+    def statement_groups(self):
+        '''
+        (statement types, frequency) pairs of the statements fundamentals() is parsed from,
+        one get_financial_stmts call each
+        '''
+        freq = self.yfinancial.freq
+        if freq == 'quarterly':
+            return [(('balance', 'cash'), 'quarterly'), (('income',), 'annual')]
+        return [(('balance', 'cash', 'income'), freq), (('balance',), 'quarterly')]
+
+    def fundamentals(self, refresh = False):
+        '''
+        Fundamentals snapshot of the company: the statements, summary and price data are
+        fetched and parsed once, later calls return the same record unless refresh is True
+        '''
+        if self._fundamentals is None or refresh:
+            yfinancial = self.yfinancial
+            symbol = yfinancial.ticker
+            statements = {}
+            for statement_types, frequency in self.statement_groups():
+                statements.update(yfinancial.get_financial_stmts(frequency, list(statement_types)))
+            summary = yfinancial.get_summary_data().get(symbol)
+            price = yfinancial.get_stock_price_data().get(symbol)
+            self.load_fundamentals(statements, summary, price)
+        return self._fundamentals
+
+    @property
+    def fundamentals_loaded(self):
+        '''
+        True when the fundamentals were fetched or loaded already
+        '''
+        return self._fundamentals is not None
+
+    def load_fundamentals(self, statements, summary, price):
+        '''
+        set the fundamentals from payloads fetched elsewhere, e.g. by a RequestPlanner for
+        many stocks at once (see Fundamentals.from_payloads for the payloads)
+        '''
+        self._fundamentals = Fundamentals.from_payloads(self.yfinancial.ticker, statements, summary, price,
+                                                        self.yfinancial.freq)
+        return self._fundamentals
+
     def get_total_debt(self):
         '''
         return Total debt of the company
         '''
-        result = None
-        try:
-            result = self.yfinancial.get_long_term_debt() + (self.yfinancial.get_total_current_liabilities()
-                                                         - self.yfinancial.get_account_payable()
-                                                         - self.yfinancial.get_other_current_liabilities())
-        except:
-            result = (self.yfinancial.get_total_current_liabilities()
-                                                         - self.yfinancial.get_account_payable()
-                                                         - self.yfinancial.get_other_current_liabilities())
-
-        return result
+        return self.fundamentals().total_debt
 
     def get_free_cashflow(self):
         '''
         return Free Cashflow of the company
         '''
-        result = None
-        try:
-            result = self.yfinancial.get_operating_cashflow() + self.yfinancial.get_capital_expenditures()
-        except:
-            result = self.yfinancial.get_operating_cashflow()
-        return result
+        return self.fundamentals().free_cashflow
 
     def get_cash_and_cash_equivalent(self):
         '''
         Return cash and cash equivalent of the company
         '''
-        result = None
-        try:
-            result = self.yfinancial.get_cash() + self.yfinancial.get_short_term_investments()
-        except:
-            result = self.yfinancial.get_cash()
-        return result
+        return self.fundamentals().cash_and_cash_equivalent
 
     def get_num_shares_outstanding(self):
         '''
         get current number of shares outstanding from Yahoo financial library
         '''
-        result = None
-        result = self.yfinancial.get_num_shares_outstanding()
-        return result
+        return self.fundamentals().shares_outstanding
 
     def get_beta(self):
         '''
         get beta from Yahoo financial
         '''
-        result = None
-        result = self.yfinancial.get_beta()
-        return result
+        return self.fundamentals().beta
 
     def lookup_wacc_by_beta(self, beta):
         '''
@@ -126,6 +249,8 @@ def _test():
     symbol = 'AAPL'
     stock = Stock(symbol)
     print(f"Free Cash Flow for {symbol} is {stock.get_free_cashflow()}")
+    print(stock.fundamentals().as_dict())
+    print("Missing line items:", stock.fundamentals().missing)
 
     # 
     start_date = datetime.date(2021, 10, 20)
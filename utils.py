@@ -1,13 +1,32 @@
 from yahoofinancials import YahooFinancials
 
+from fundamentals_cache import get_default_cache
+
 class MyYahooFinancials(YahooFinancials):
     '''
     Extended class based on YahooFinancial libary
 
+    financial statements are read through a FundamentalsCache (by default the shared one of
+    fundamentals_cache), so they are fetched once per TTL instead of once per accessor call
     '''
-    def __init__(self, symbol, freq = 'annual'):
+    def __init__(self, symbol, freq = 'annual', fundamentals_cache = None):
         YahooFinancials.__init__(self, symbol)
         self.freq = freq
+        self.fundamentals_cache = fundamentals_cache
+
+    def get_financial_stmts(self, frequency, statement_type, reformat = True):
+        if not reformat:
+            return YahooFinancials.get_financial_stmts(self, frequency, statement_type, reformat)
+
+        cache = get_default_cache() if self.fundamentals_cache is None else self.fundamentals_cache
+        symbols = [self.ticker] if isinstance(self.ticker, str) else self.ticker
+        statement_types = [statement_type] if isinstance(statement_type, str) else statement_type
+        data = {}
+        for stmt_type in statement_types:
+            for symbol in symbols:
+                for code, symbol_data in cache.get(symbol, stmt_type, frequency).items():
+                    data.setdefault(code, {})[symbol] = symbol_data
+        return data
 
     def get_operating_cashflow(self):
         return self._financial_statement_data('cash', 'cashflowStatementHistory', 'totalCashFromOperatingActivities', self.freq)
@@ -41,6 +60,8 @@ def _test():
     
     print("Getting Financial Data for {}".format(symbol))
     print("Long Term Debt: ", yfinance.get_long_term_debt())
+    print("Cash: ", yfinance.get_cash())
+    print("Fundamentals cache: ", get_default_cache().info())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,246 @@
+import enum
+import time
+import numpy as np
+
+from datetime import date
+
+from bond import Bond, DayCount, PaymentFrequency
+from bond_portfolio import BondPortfolio
+from root_finding import brent, RootFindingError
+
+
+class CurveInterpolation(enum.Enum):
+    LINEAR_LOG_DF = "Linear log discount factor"
+    MONOTONE_CUBIC = "Monotone cubic"
+
+
+def _pchip_slopes(x, y):
+    '''
+    Fritsch-Carlson slopes of the monotone cubic (PCHIP) interpolant through the knots
+    '''
+    h = np.diff(x)
+    delta = np.diff(y) / h
+    if len(x) == 2:
+        return(np.array([delta[0], delta[0]]))
+
+    slopes = np.zeros(len(x))
+    w1 = 2 * h[1:] + h[:-1]
+    w2 = h[1:] + 2 * h[:-1]
+    same_sign = delta[:-1] * delta[1:] > 0
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        harmonic = (w1 + w2) / (w1 / delta[:-1] + w2 / delta[1:])
+    slopes[1:-1] = np.where(same_sign, harmonic, 0.0)
+
+    def edge(h0, h1, delta0, delta1):
+        slope = ((2 * h0 + h1) * delta0 - h0 * delta1) / (h0 + h1)
+        if np.sign(slope) != np.sign(delta0):
+            return(0.0)
+        if np.sign(delta0) != np.sign(delta1) and abs(slope) > abs(3 * delta0):
+            return(3 * delta0)
+        return(slope)
+
+    slopes[0] = edge(h[0], h[1], delta[0], delta[1])
+    slopes[-1] = edge(h[-1], h[-2], delta[-1], delta[-2])
+    return(slopes)
+
+
+class ZeroCurve(object):
+    '''
+    Discount curve defined by discount factors at knot times (in years)
+
+    log discount factors are interpolated linearly or with a monotone cubic; a knot at t = 0
+    with discount factor 1 is always added, and beyond the last knot the curve is extended
+    with a flat forward rate. The interpolation coefficients are computed once in __init__,
+    so evaluating the curve is a binary search and a polynomial per point.
+    '''
+    def __init__(self, times, discount_factors, interpolation = CurveInterpolation.LINEAR_LOG_DF):
+        times = np.asarray(times, dtype = np.float64)
+        discount_factors = np.asarray(discount_factors, dtype = np.float64)
+        if np.any(np.diff(times) <= 0) or times[0] <= 0:
+            raise Exception("Curve times must be positive and increasing")
+
+        self.interpolation = interpolation
+        self.times = np.concatenate([[0.0], times])
+        self.log_discount_factors = np.concatenate([[0.0], np.log(discount_factors)])
+        self._precompute()
+
+    def _precompute(self):
+        x, y = self.times, self.log_discount_factors
+        self._h = np.diff(x)
+        self._delta = np.diff(y) / self._h
+        if self.interpolation == CurveInterpolation.LINEAR_LOG_DF:
+            self._slopes = None
+        elif self.interpolation == CurveInterpolation.MONOTONE_CUBIC:
+            self._slopes = _pchip_slopes(x, y)
+        else:
+            raise Exception("Unsupported curve interpolation")
+
+    def log_discount_factor(self, t):
+        '''
+        log discount factor at times t (any shape)
+        '''
+        t = np.asarray(t, dtype = np.float64)
+        x, y = self.times, self.log_discount_factors
+        k = np.clip(np.searchsorted(x, t, side = 'right') - 1, 0, len(x) - 2)
+        dt = t - x[k]
+
+        if self._slopes is None:
+            result = y[k] + self._delta[k] * dt
+        else:
+            h = self._h[k]
+            s = dt / h
+            result = (y[k] * (1 + 2 * s) * (1 - s)**2 + self._slopes[k] * h * s * (1 - s)**2 +
+                      y[k + 1] * s**2 * (3 - 2 * s) + self._slopes[k + 1] * h * s**2 * (s - 1))
+
+        # flat forward beyond the last knot
+        beyond = t > x[-1]
+        if np.any(beyond):
+            result = np.where(beyond, y[-1] + self._delta[-1] * (t - x[-1]), result)
+        return(result)
+
+    def discount_factor(self, t):
+        return(np.exp(self.log_discount_factor(t)))
+
+    def zero_rate(self, t):
+        '''
+        continuously compounded zero rate at times t
+        '''
+        t = np.asarray(t, dtype = np.float64)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            result = -self.log_discount_factor(t) / t
+        # the short rate at t = 0 is the slope of the first segment
+        return(np.where(t > 0, result, -self._delta[0]))
+
+    def price(self, bonds):
+        '''
+        price a list of Bond or a BondPortfolio against the curve, one numpy pass over
+        payment_times_in_year; returns the prices in the order of bonds
+        '''
+        portfolio = bonds if isinstance(bonds, BondPortfolio) else BondPortfolio(bonds)
+        # the curve is evaluated once per distinct schedule, then gathered per bond
+        discount_factors = self.discount_factor(portfolio.group_times)[portfolio.time_group]
+        result = np.einsum('ij,ij->i', portfolio.cash_flows, discount_factors)
+        return(portfolio.from_sorted(result))
+
+
+def bootstrap_zero_curve(bonds, prices = None, interpolation = CurveInterpolation.LINEAR_LOG_DF,
+                         tol = 1.0e-10, max_iterations = 20):
+    '''
+    Bootstrap a ZeroCurve from a strip of bonds, by default par bonds (price = principal)
+
+    the knots are the bond maturities. With linear interpolation of log discount factors each
+    knot only moves the bonds maturing up to the next knot, so the knots are solved one at a
+    time, shortest bond first. A monotone cubic knot also bends the curve before the previous
+    knot, so the linear curve is then refined with Newton steps on all knots together until
+    every bond reprices within tol.
+    '''
+    portfolio = BondPortfolio(bonds)
+    if prices is None:
+        prices = portfolio.principal
+    prices = np.broadcast_to(np.asarray(prices, dtype = np.float64), (len(portfolio),))
+
+    maturities = np.array([b.payment_times_in_year[-1] for b in portfolio.bonds])
+    order = np.argsort(maturities)
+    if np.any(np.diff(maturities[order]) <= 0):
+        raise Exception("Bootstrap needs one bond per maturity")
+    knot_times = maturities[order]
+
+    # sequential solve of the linear curve, on zero rates bracketed in [-50%, 200%]
+    log_discount_factors = np.zeros(len(order))
+    for k, i in enumerate(order):
+        bond = portfolio.bonds[i]
+        cash_flows = np.array(bond.coupon_payment, dtype = np.float64)
+        cash_flows[-1] += bond.principal
+        payment_times = np.asarray(bond.payment_times_in_year)
+
+        def price_error(rates, index):
+            errors = np.empty(len(rates))
+            for j, rate in enumerate(rates):
+                log_discount_factors[k] = -rate * knot_times[k]
+                curve = ZeroCurve(knot_times[:k + 1], np.exp(log_discount_factors[:k + 1]))
+                errors[j] = cash_flows @ curve.discount_factor(payment_times) - prices[i]
+            return(errors)
+
+        result = brent(price_error, -0.5, 2.0, eps = tol * prices[i])
+        if not result.converged[0]:
+            raise RootFindingError("Could not bootstrap the curve at {} years".format(knot_times[k]))
+        log_discount_factors[k] = -result.root[0] * knot_times[k]
+
+    curve = ZeroCurve(knot_times, np.exp(log_discount_factors), CurveInterpolation.LINEAR_LOG_DF)
+    if interpolation == CurveInterpolation.LINEAR_LOG_DF:
+        return(curve)
+
+    # global Newton refinement for the other interpolations
+    def price_errors(x):
+        return((ZeroCurve(knot_times, np.exp(x), interpolation).price(portfolio) - prices)[order])
+
+    x = log_discount_factors
+    errors = price_errors(x)
+    bump = 1.0e-7
+    for iteration in range(max_iterations):
+        if np.max(np.abs(errors) / prices[order]) <= tol:
+            return(ZeroCurve(knot_times, np.exp(x), interpolation))
+        jacobian = np.empty((len(x), len(x)))
+        for j in range(len(x)):
+            bumped = x.copy()
+            bumped[j] += bump
+            jacobian[:, j] = (price_errors(bumped) - errors) / bump
+        x = x - np.linalg.solve(jacobian, errors)
+        errors = price_errors(x)
+
+    if np.max(np.abs(errors) / prices[order]) > tol:
+        raise RootFindingError("Curve bootstrap did not converge")
+    return(ZeroCurve(knot_times, np.exp(x), interpolation))
+
+
+def _par_strip(terms = [(k + 1) / 2 for k in range(50)]):
+    # semi-annual par bonds on an upward sloping curve, by default 50 bonds from 6 months to 25 years
+    issue_date = date(2021, 1, 1)
+    bonds = []
+    for term in terms:
+        coupon = 0.01 + 0.03 * (1 - np.exp(-term / 8))
+        bonds.append(Bond(issue_date, term = term, day_count = DayCount.DAYCOUNT_30360,
+                          payment_freq = PaymentFrequency.SEMIANNUAL, coupon = round(coupon, 6)))
+    return(bonds)
+
+
+def _example():
+    # knots further apart than the coupons, so the interpolation matters
+    bonds = _par_strip([0.5, 1, 2, 3, 5, 7, 10, 15, 20, 30])
+    for interpolation in CurveInterpolation:
+        curve = bootstrap_zero_curve(bonds, interpolation = interpolation)
+        repriced = curve.price(bonds)
+        print(interpolation.value, "max repricing error", np.max(np.abs(repriced - 100)))
+        print("  zero rates at 4, 6, 12, 25Y:", curve.zero_rate([4, 6, 12, 25]))
+        assert(np.max(np.abs(repriced - 100)) < 1.0e-6)
+
+
+def _benchmark(n_bonds = 100000):
+    '''
+    bootstrap a 50 bond par curve and reprice a book of n_bonds against it
+    '''
+    strip = _par_strip()
+    templates = [Bond(date(2021, 1, 1), term = 1 + i % 25, day_count = DayCount.DAYCOUNT_30360,
+                      payment_freq = [PaymentFrequency.ANNUAL, PaymentFrequency.SEMIANNUAL,
+                                      PaymentFrequency.QUARTERLY][i % 3], coupon = 0.005 * (i % 12))
+                 for i in range(200)]
+    portfolio = BondPortfolio([templates[i % len(templates)] for i in range(n_bonds)])
+
+    for interpolation in CurveInterpolation:
+        start = time.perf_counter()
+        curve = bootstrap_zero_curve(strip, interpolation = interpolation)
+        t_bootstrap = time.perf_counter() - start
+
+        start = time.perf_counter()
+        curve.price(portfolio)
+        t_price = time.perf_counter() - start
+        print(f"{interpolation.value}: bootstrap {t_bootstrap:.3f}s, price {n_bonds} bonds {t_price:.3f}s")
+
+
+def _test():
+    _example()
+    #_benchmark()
+
+
+if __name__ == "__main__":
+    _test()